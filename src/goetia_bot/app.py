@@ -1,87 +1,223 @@
 import asyncio
-import logging
-from logging.handlers import RotatingFileHandler
-from pathlib import Path
+import signal
+from typing import Iterable, Optional
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
-from .client_manager import ClientManager
-from .config import load_config
+from .client_manager import ClientManager, ClientState
+from .config import Config, load_config
 from .context import AppContext
-from .db import Database
+from .db import AsyncDatabase, Database, UserRecord
+from .delivery import DeliveryQueue
+from .fsm_storage import SQLiteStorage
 from .handlers import setup_router
+from .lanes import UpdateLimitMiddleware, UserLanes
+from .logins import PendingLogins
+from .logs import log_stats, setup_logging, stop_logging
+from .metrics import REGISTRY
+from .metrics_server import BotApiMetricsMiddleware, HandlerMetricsMiddleware, MetricsServer
+from .restore import RestoreReport, restore_sessions
 from .scheduler import BuffScheduler
-
-
-def setup_logging(log_level: str, log_dir: Path) -> None:
-    log_dir.mkdir(parents=True, exist_ok=True)
-    level = getattr(logging, log_level.upper(), logging.INFO)
-    fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-
-    root = logging.getLogger()
-    root.setLevel(level)
-    root.handlers.clear()
-
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(fmt)
-    stream_handler.setLevel(level)
-    root.addHandler(stream_handler)
-
-    file_handler = RotatingFileHandler(log_dir / "bot.log", maxBytes=2_000_000, backupCount=3, encoding="utf-8")
-    file_handler.setFormatter(fmt)
-    file_handler.setLevel(level)
-    root.addHandler(file_handler)
-
-    logging.getLogger("telethon").setLevel(max(level, logging.INFO))
-    logging.getLogger("aiogram.event").setLevel(max(level, logging.INFO))
-
-
-async def create_app() -> tuple[Dispatcher, AppContext]:
-    config = load_config()
-    setup_logging(config.log_level, config.logs_dir)
+from .sharding import ShardedClientManager
+from .tracing import TRACER
+from .webhook import WebhookServer
+
+
+async def create_app(config: Optional[Config] = None) -> tuple[Dispatcher, AppContext]:
+    config = config or load_config()
+    setup_logging(
+        config.log_level,
+        config.logs_dir,
+        json_format=config.log_json,
+        rate_limits=config.log_rate_limits,
+        sample=config.log_sample,
+        queue_size=config.log_queue_size,
+    )
 
     config.data_dir.mkdir(parents=True, exist_ok=True)
     config.sessions_dir.mkdir(parents=True, exist_ok=True)
     config.logs_dir.mkdir(parents=True, exist_ok=True)
 
-    db = Database(config.data_dir / "goetia.db")
-    bot = Bot(token=config.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
-    clients = ClientManager(config, db)
+    TRACER.configure(config.trace_sample_rate, config.trace_max)
+    db = AsyncDatabase(Database(config.data_dir / "goetia.db"))
+    session = None
+    if config.bot_api_url:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(config.bot_api_url))
+    bot = Bot(token=config.bot_token, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    if config.shards > 1:
+        clients = ShardedClientManager(config, db)
+    else:
+        clients = ClientManager(config, db)
     scheduler = BuffScheduler(config, db, clients)
-    ctx = AppContext(config=config, db=db, clients=clients, scheduler=scheduler, bot=bot)
-
-    dp = Dispatcher(storage=MemoryStorage())
+    delivery = DeliveryQueue(
+        bot,
+        global_rate=config.delivery_global_rate,
+        chat_rate=config.delivery_chat_rate,
+        max_queue=config.delivery_max_queue,
+        workers=config.delivery_workers,
+        coalesce_window=config.coalesce_window_ms / 1000,
+    )
+    logins = PendingLogins(clients.cancel_login, max_pending=config.login_max_pending, ttl=config.login_ttl)
+    ctx = AppContext(
+        config=config, db=db, clients=clients, scheduler=scheduler, bot=bot, delivery=delivery, logins=logins
+    )
+
+    storage = SQLiteStorage(db, ttl=config.fsm_ttl)
+    await storage.load()
+    lanes = UserLanes()
+    dp = Dispatcher(storage=storage, events_isolation=lanes)
     dp.include_router(setup_router(ctx))
-
-    await restore_clients(ctx)
+    limit = UpdateLimitMiddleware(config.update_concurrency)
+    dp.update.outer_middleware(limit)
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(BotApiMetricsMiddleware())
+    register_metrics(ctx)
+    REGISTRY.gauge_func("goetia_update_lanes", "Пользователи с апдейтами в обработке или в очереди", lambda: lanes.lanes)
+    REGISTRY.gauge_func("goetia_updates_waiting", "Апдейты, ждущие своей очереди или общего лимита", lambda: lanes.waiting + limit.waiting)
+    REGISTRY.gauge_func("goetia_updates_inflight", "Апдейты в обработке", lambda: limit.inflight)
+    REGISTRY.gauge_func("goetia_fsm_states", "Непустые FSM-состояния пользователей", lambda: storage.size)
+    REGISTRY.counter_func("goetia_fsm_expired_total", "FSM-состояния, удалённые по FSM_TTL", lambda: storage.expired)
+
+    # Сессии поднимаются в фоне из run(), чтобы бот отвечал сразу после старта
     scheduler.start()
 
     return dp, ctx
 
 
-async def restore_clients(ctx: AppContext) -> None:
-    users = ctx.db.list_users().values()
+def register_metrics(ctx: AppContext) -> None:
+    """Метрики, которые снимаются с объектов приложения при каждом запросе /metrics."""
+    clients = ctx.clients
+    REGISTRY.gauge_func(
+        "goetia_clients_connected", "Подключённые Telethon-клиенты", lambda: clients.state_counts()[ClientState.CONNECTED]
+    )
+    REGISTRY.gauge_func(
+        "goetia_clients_hibernated", "Усыплённые Telethon-клиенты", lambda: clients.state_counts()[ClientState.HIBERNATED]
+    )
+    if isinstance(clients, ClientManager):
+        # в режиме шардов эти счётчики живут в процессах воркеров
+        relay, sends = clients.relay_stats, clients.send_stats
+        REGISTRY.counter_func(
+            "goetia_relay_events_total", "События Telethon из диалогов аккаунтов", lambda: relay.handled + relay.dropped
+        )
+        REGISTRY.counter_func("goetia_relay_dropped_total", "События, отброшенные фильтром агента", lambda: relay.dropped)
+        REGISTRY.counter_func("goetia_agent_sent_total", "Сообщения, отправленные агенту", lambda: sends.sent)
+        REGISTRY.counter_func("goetia_agent_failed_total", "Неудачные отправки агенту", lambda: sends.failed)
+        REGISTRY.counter_func("goetia_flood_waits_total", "FloodWait при отправке агенту", lambda: sends.flood_waits)
+    delivery = ctx.delivery
+    REGISTRY.gauge_func("goetia_delivery_depth", "Сообщения в очереди доставки бота", lambda: delivery.depth)
+    REGISTRY.counter_func("goetia_delivery_sent_total", "Доставленные ботом сообщения", lambda: delivery.stats.sent)
+    REGISTRY.counter_func("goetia_delivery_dropped_total", "Отброшенные сообщения бота", lambda: delivery.stats.dropped)
+    REGISTRY.counter_func("goetia_delivery_retries_total", "Повторы отправки ботом", lambda: delivery.stats.retries)
+    cache = ctx.db.db.cache_stats
+    REGISTRY.counter_func("goetia_db_cache_hits_total", "Попадания в кэш пользователей", lambda: cache.hits)
+    REGISTRY.counter_func("goetia_db_cache_misses_total", "Промахи кэша пользователей", lambda: cache.misses)
+    REGISTRY.counter_func("goetia_log_dropped_total", "Записи лога, потерянные при полной очереди", lambda: log_stats()["dropped"])
+    REGISTRY.counter_func(
+        "goetia_log_suppressed_total", "Записи лога, отсеянные LOG_RATE_LIMITS/LOG_SAMPLE", lambda: log_stats()["suppressed"]
+    )
+    if ctx.logins is not None:
+        logins = ctx.logins
+        REGISTRY.gauge_func("goetia_logins_pending", "Незавершённые входы с открытым соединением", lambda: len(logins))
+        REGISTRY.counter_func("goetia_logins_evicted_total", "Входы, закрытые по LOGIN_TTL", lambda: logins.stats.evicted)
+        REGISTRY.counter_func(
+            "goetia_logins_rejected_total", "Входы, отклонённые по LOGIN_MAX_PENDING", lambda: logins.stats.rejected
+        )
+    REGISTRY.gauge_func("goetia_buff_scheduled", "Пользователи с авто-/buff", ctx.scheduler.scheduled_count)
+
+
+async def restore_clients(ctx: AppContext) -> RestoreReport:
+    schedule_users(ctx, await ctx.db.scheduled_users())
+    return await restore_sessions(ctx.config, ctx.clients, ctx.db.iter_user_pages(with_session=True))
+
+
+def schedule_users(ctx: AppContext, users: Iterable[UserRecord]) -> None:
     for user in users:
-        if user.session_path and Path(user.session_path).exists():
-            try:
-                await ctx.clients.start_from_session(user.tg_id, Path(user.session_path))
-            except Exception as e:  # noqa: BLE001
-                logging.getLogger(__name__).warning("Не удалось поднять сессию %s: %s", user.tg_id, e)
         if user.schedule_enabled:
             ctx.scheduler.schedule_user(user)
 
 
+async def warm_up(ctx: AppContext) -> None:
+    if isinstance(ctx.clients, ShardedClientManager):
+        # сессии поднимают воркеры шардов, здесь только расписание
+        schedule_users(ctx, await ctx.db.scheduled_users())
+        return
+    await restore_clients(ctx)
+    await ctx.clients.prewarm_agent_peers()
+
+
+def create_webhook(dp: Dispatcher, ctx: AppContext) -> WebhookServer:
+    config = ctx.config
+    return WebhookServer(
+        dp,
+        ctx.bot,
+        host=config.webhook_host,
+        port=config.webhook_port,
+        path=config.webhook_path,
+        url=config.webhook_url,
+        secret=config.webhook_secret,
+        concurrency=config.webhook_concurrency,
+        max_connections=config.webhook_max_connections,
+    )
+
+
+async def wait_for_signal() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+
 async def run() -> None:
     dp, ctx = await create_app()
+    if isinstance(ctx.clients, ShardedClientManager):
+        await ctx.clients.start()
+    restore_task = asyncio.create_task(warm_up(ctx))
+    hibernation_task = asyncio.create_task(ctx.clients.run_hibernation())
+    flush_task = asyncio.create_task(ctx.clients.run_session_flush())
+    login_task = asyncio.create_task(ctx.logins.run_eviction())
+    fsm_task = asyncio.create_task(dp.storage.run_eviction())
+    tasks = (restore_task, hibernation_task, flush_task, login_task, fsm_task)
+    metrics = None
+    webhook = None
+    if ctx.config.metrics_port:
+        metrics = MetricsServer(ctx.config.metrics_host, ctx.config.metrics_port)
+        await metrics.start()
     try:
-        await dp.start_polling(ctx.bot)
+        if ctx.config.bot_mode == "webhook":
+            webhook = create_webhook(dp, ctx)
+            await webhook.start()
+            await wait_for_signal()
+        else:
+            # webhook мог остаться от прошлого запуска: с ним getUpdates отвечает 409 Conflict
+            await ctx.bot.delete_webhook()
+            await dp.start_polling(ctx.bot, close_bot_session=False)
     finally:
+        if webhook is not None:
+            await webhook.close()
+        if metrics is not None:
+            await metrics.close()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await ctx.delivery.close()
         await ctx.bot.session.close()
         ctx.scheduler.shutdown()
-        for tg_id in list(ctx.clients.clients.keys()):
-            await ctx.clients.stop(tg_id)
+        await ctx.logins.close()
+        await ctx.clients.close()
+        ctx.db.close()
+        if ctx.config.trace_dump:
+            TRACER.dump(ctx.config.trace_dump, ctx.config.trace_format)
+        stop_logging()
 
 
 def main() -> None:
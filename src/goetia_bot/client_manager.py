@@ -1,9 +1,13 @@
 import asyncio
 import logging
+import time
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from typing import Awaitable, Callable, Dict, Optional
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
 
 from telethon import TelegramClient, events
+from telethon.tl.types import InputPeerUser
 from telethon.errors import (
     SessionPasswordNeededError,
     PhoneCodeExpiredError,
@@ -13,41 +17,111 @@ from telethon.errors import (
 )
 
 from .config import Config
-from .db import Database, UserRecord
+from .db import AsyncDatabase, UserRecord
+from .metrics import AGENT_SEND_SECONDS, HANDLER_SECONDS, RELAY_FORWARDED
+from .outbox import AccountOutbox, OutboxStats, SendResult
+from .ratelimit import TokenBucket
+from .session_store import SessionStore
+from .tracing import TRACER, span
 
 logger = logging.getLogger(__name__)
 
 AgentUsername = "Agent_essence_bot"
 MessageCallback = Callable[[int, str, str], Awaitable[None]]  # tg_id, sender, text
+StateListener = Callable[[int, "ClientState"], None]
+
+
+class ClientState(str, Enum):
+    CONNECTED = "connected"
+    HIBERNATED = "hibernated"  # сессия есть, соединение закрыто до первого обращения
+    RESTORING = "restoring"
+    ABSENT = "absent"
+
+
+@dataclass
+class RelayStats:
+    handled: int = 0  # события, прошедшие фильтр и попавшие в обработчик
+    dropped: int = 0  # события, отброшенные фильтром Telethon до обработчика
+
+
+class AgentMessages(events.NewMessage):
+    """Входящие сообщения только из диалога с агентом, с подсчётом отброшенных событий."""
+
+    def __init__(self, agent_peer, stats: RelayStats):
+        super().__init__(chats=agent_peer, incoming=True)
+        self._stats = stats
+
+    def filter(self, event):
+        result = super().filter(event)
+        if result:
+            self._stats.handled += 1
+        else:
+            self._stats.dropped += 1
+        return result
 
 
 class ClientManager:
-    def __init__(self, config: Config, db: Database):
+    def __init__(self, config: Config, db: AsyncDatabase):
         self.config = config
         self.db = db
         self.clients: Dict[int, TelegramClient] = {}
         self._message_callback: Optional[MessageCallback] = None
+        # вызывается при каждой смене ClientState аккаунта (нужно воркеру шарда)
+        self.state_listener: Optional[StateListener] = None
+        self.relay_stats = RelayStats()
+        # аккаунты, чьи сессии ещё поднимаются в фоне после старта
+        self.restoring: Set[int] = set()
+        # усыплённые аккаунты: tg_id -> путь к сессии для пробуждения
+        self.hibernated: Dict[int, Path] = {}
+        self._session_paths: Dict[int, Path] = {}
+        self._last_used: Dict[int, float] = {}
+        self._wake_locks: Dict[int, asyncio.Lock] = {}
+        self._outboxes: Dict[int, AccountOutbox] = {}
+        self.send_stats = OutboxStats()
+        self._agent_filters: Dict[int, AgentMessages] = {}
+        # аккаунты без резолвленного агента: дорезолвим при первой отправке или в prewarm
+        self._unresolved_peers: Set[int] = set()
+        self._resolve_rate = TokenBucket(config.agent_resolve_rate)
+        # общее хранилище сессий Telethon вместо файла на каждый аккаунт
+        self.sessions: Optional[SessionStore] = None
+        if config.session_store:
+            self.sessions = SessionStore(
+                config.data_dir / "sessions.db", config.session_flush_interval, executor=db.executor
+            )
 
     def set_message_callback(self, cb: MessageCallback) -> None:
         self._message_callback = cb
 
-    async def start_from_session(self, tg_id: int, session_path: Path) -> Optional[TelegramClient]:
-        client = TelegramClient(str(session_path), self.config.api_id, self.config.api_hash)
-        await client.connect()
-
-        if not await client.is_user_authorized():
-            logger.warning("Сессия для %s не авторизована", tg_id)
+    async def start_from_session(
+        self, tg_id: int, session_path: Path, resolve_peer: bool = True
+    ) -> Optional[TelegramClient]:
+        client = TelegramClient(await self._session(tg_id, session_path), self.config.api_id, self.config.api_hash)
+        try:
+            await client.connect()
+            if not await client.is_user_authorized():
+                logger.warning("Сессия для %s не авторизована", tg_id)
+                await client.disconnect()
+                return None
+            await self._activate(client, tg_id, session_path, resolve_peer=resolve_peer)
+        except (Exception, asyncio.CancelledError):
+            # в том числе отмена по таймауту восстановления, даже посреди _activate:
+            # клиент регистрируется только после последнего await, так что достаточно закрыть сокет
             await client.disconnect()
-            return None
-
-        self._register_handlers(client, tg_id)
-        self.clients[tg_id] = client
+            raise
         logger.info("Telethon клиент поднят для %s", tg_id)
         return client
 
     async def start_with_code(self, tg_id: int, phone: str) -> tuple[TelegramClient, Optional[str]]:
         session_path = self._session_path_for(tg_id)
-        client = TelegramClient(str(session_path), self.config.api_id, self.config.api_hash)
+        client = TelegramClient(await self._session(tg_id, session_path), self.config.api_id, self.config.api_hash)
+        try:
+            return await self._send_code(client, tg_id, phone)
+        except (Exception, asyncio.CancelledError):
+            # вход не начался: клиент никуда не передан, закрываем соединение здесь
+            await client.disconnect()
+            raise
+
+    async def _send_code(self, client: TelegramClient, tg_id: int, phone: str) -> tuple[TelegramClient, Optional[str]]:
         await client.connect()
         logger.info("Отправляем код на %s (tg_id=%s)", phone, tg_id)
         last_exc: Optional[Exception] = None
@@ -114,9 +188,8 @@ class ClientManager:
             logger.warning("Не авторизован после sign_in tg_id=%s", tg_id)
             return False, password_needed
 
-        self._register_handlers(client, tg_id)
-        self.clients[tg_id] = client
-        self.db.set_session_path(tg_id, str(self._session_path_for(tg_id)))
+        await self._activate(client, tg_id, self._session_path_for(tg_id))
+        await self.db.set_session_path(tg_id, str(self._session_path_for(tg_id)))
         logger.info("Пользователь %s авторизован, сессия сохранена", tg_id)
         return True, password_needed
 
@@ -129,58 +202,328 @@ class ClientManager:
         await client.sign_in(password=password)
         if not await client.is_user_authorized():
             return False
-        self._register_handlers(client, tg_id)
-        self.clients[tg_id] = client
-        self.db.set_session_path(tg_id, str(self._session_path_for(tg_id)))
+        await self._activate(client, tg_id, self._session_path_for(tg_id))
+        await self.db.set_session_path(tg_id, str(self._session_path_for(tg_id)))
         logger.info("Пользователь %s авторизован после 2FA", tg_id)
         return True
 
+    async def cancel_login(self, tg_id: int, client: TelegramClient) -> None:
+        """Брошенный вход: закрываем соединение, если клиент так и не стал рабочим."""
+        if self.clients.get(tg_id) is client:
+            return
+        await client.disconnect()
+        logger.info("Незавершённый вход %s отменён", tg_id)
+
+    async def _activate(
+        self, client: TelegramClient, tg_id: int, session_path: Path, resolve_peer: bool = True
+    ) -> None:
+        peer = await self._agent_peer(client, tg_id, resolve=resolve_peer)
+        self._agent_filters[tg_id] = self._register_handlers(client, tg_id, peer)
+        self.clients[tg_id] = client
+        self._outboxes[tg_id] = AccountOutbox(
+            tg_id, client, peer or AgentUsername, self.send_stats, on_unauthorized=self._session_revoked
+        )
+        if peer is None:
+            self._unresolved_peers.add(tg_id)
+        else:
+            self._unresolved_peers.discard(tg_id)
+        self.hibernated.pop(tg_id, None)
+        self._session_paths[tg_id] = session_path
+        self._touch(tg_id)
+        self._notify(tg_id)
+
+    def _notify(self, tg_id: int) -> None:
+        if self.state_listener is not None:
+            self.state_listener(tg_id, self.client_state(tg_id))
+
+    def _touch(self, tg_id: int) -> None:
+        self._last_used[tg_id] = time.monotonic()
+
     async def stop(self, tg_id: int) -> None:
+        self.hibernated.pop(tg_id, None)
+        self._session_paths.pop(tg_id, None)
+        self._last_used.pop(tg_id, None)
+        self._agent_filters.pop(tg_id, None)
+        self._unresolved_peers.discard(tg_id)
+        outbox = self._outboxes.pop(tg_id, None)
+        if outbox:
+            outbox.cancel()
         client = self.clients.pop(tg_id, None)
+        self._notify(tg_id)
         if client:
             await client.disconnect()
             logger.info("Клиент %s остановлен", tg_id)
 
+    async def _session_revoked(self, tg_id: int) -> None:
+        """Сессию отозвали (вышли со всех устройств, сброс ключа): клиент больше не рабочий."""
+        await self.stop(tg_id)
+        await self.db.set_session_path(tg_id, None)
+        await self.forget_session(tg_id)
+        logger.warning("Сессия %s отозвана, клиент остановлен", tg_id)
+
+    async def close(self) -> None:
+        for tg_id in list(self.clients):
+            await self.stop(tg_id)
+        if self.sessions is not None:
+            await self.db.run(self.sessions.close)
+
     def _session_path_for(self, tg_id: int) -> Path:
         self.config.sessions_dir.mkdir(parents=True, exist_ok=True)
         return self.config.sessions_dir / f"user_{tg_id}.session"
 
-    async def send_to_agent(self, tg_id: int, text: str) -> bool:
-        client = self.clients.get(tg_id)
-        if not client or not await client.is_user_authorized():
+    async def _session(self, tg_id: int, session_path: Path):
+        if self.sessions is None:
+            return str(session_path)
+        return await self.db.run(self.sessions.open, tg_id)
+
+    async def has_session(self, tg_id: int, session_path: Path) -> bool:
+        if self.sessions is None:
+            return session_path.exists()
+        return await self.db.run(self.sessions.has, tg_id)
+
+    async def migrate_session_files(self, users: Iterable[UserRecord]) -> int:
+        """Переносит старые .session-файлы в общее хранилище (один раз на аккаунт)."""
+        if self.sessions is None:
+            return 0
+        store = self.sessions
+        pending = [
+            (user.tg_id, Path(user.session_path))
+            for user in users
+            if user.session_path and Path(user.session_path).exists() and not await self.db.run(store.has, user.tg_id)
+        ]
+        if not pending:
+            return 0
+        imported = 0
+        for tg_id, session_file in pending:
+            if await self.db.run(store.import_file, tg_id, session_file):
+                imported += 1
+        logger.info("Перенесено сессий в %s: %s из %s", store.path, imported, len(pending))
+        return imported
+
+    async def forget_session(self, tg_id: int) -> None:
+        if self.sessions is not None:
+            self.sessions.discard(tg_id)
+            await self.db.run(self.sessions.delete, tg_id)
+        session_path = self._session_path_for(tg_id)
+        if session_path.exists():
+            try:
+                session_path.unlink()
+            except OSError as e:  # noqa: BLE001
+                logger.warning("Не смог удалить сессию %s: %s", session_path, e)
+
+    async def run_session_flush(self) -> None:
+        if self.sessions is not None:
+            await self.sessions.run_flusher()
+
+    async def send_to_agent(self, tg_id: int, text: str) -> SendResult:
+        """Ставит сообщение в очередь аккаунта; саму отправку не ждёт."""
+        with AGENT_SEND_SECONDS.time(), span("send_to_agent"):
+            if tg_id not in self.clients and not await self.wake(tg_id):
+                return SendResult.FAILED
+            if tg_id in self._unresolved_peers:
+                await self.ensure_agent_peer(tg_id)
+            outbox = self._outboxes.get(tg_id)
+            if not outbox:
+                return SendResult.FAILED
+            self._touch(tg_id)
+            return outbox.submit(text)
+
+    def send_backlog(self) -> Dict[int, int]:
+        return {tg_id: outbox.backlog for tg_id, outbox in self._outboxes.items() if outbox.backlog}
+
+    def flood_waits(self) -> Dict[int, float]:
+        """Аккаунты, чья очередь сейчас стоит на FloodWait, и сколько секунд осталось."""
+        result = {}
+        for tg_id, outbox in self._outboxes.items():
+            left = outbox.flood_wait_left()
+            if left > 0:
+                result[tg_id] = left
+        return result
+
+    def has_client(self, tg_id: int) -> bool:
+        # усыплённый аккаунт считается подключённым: он поднимется при первом обращении
+        return tg_id in self.clients or tg_id in self.hibernated
+
+    def state_counts(self) -> Dict[ClientState, int]:
+        return {ClientState.CONNECTED: len(self.clients), ClientState.HIBERNATED: len(self.hibernated)}
+
+    def client_state(self, tg_id: int) -> ClientState:
+        if tg_id in self.clients:
+            return ClientState.CONNECTED
+        if tg_id in self.hibernated:
+            return ClientState.HIBERNATED
+        if tg_id in self.restoring:
+            return ClientState.RESTORING
+        return ClientState.ABSENT
+
+    def register_hibernated(self, tg_id: int, session_path: Path) -> None:
+        """Учитывает сессию как усыплённую, не открывая соединение."""
+        if tg_id not in self.clients:
+            self.hibernated[tg_id] = session_path
+            self._notify(tg_id)
+
+    async def hibernate(self, tg_id: int) -> bool:
+        outbox = self._outboxes.get(tg_id)
+        if outbox and outbox.backlog:
+            return False  # не усыпляем аккаунт с неотправленными сообщениями
+        client = self.clients.pop(tg_id, None)
+        if not client:
             return False
-        await client.send_message(AgentUsername, text)
+        self._outboxes.pop(tg_id, None)
+        self._agent_filters.pop(tg_id, None)
+        self._unresolved_peers.discard(tg_id)
+        self.hibernated[tg_id] = self._session_paths.get(tg_id, self._session_path_for(tg_id))
+        self._last_used.pop(tg_id, None)
+        self._notify(tg_id)
+        await client.disconnect()
+        logger.info("Клиент %s усыплён", tg_id)
         return True
 
-    def has_client(self, tg_id: int) -> bool:
-        return tg_id in self.clients
+    async def wake(self, tg_id: int) -> Optional[TelegramClient]:
+        if tg_id in self.clients:
+            return self.clients[tg_id]
+        if tg_id not in self.hibernated:
+            return None
+        lock = self._wake_locks.setdefault(tg_id, asyncio.Lock())
+        try:
+            async with lock:
+                # пока ждали блокировку, клиента мог поднять параллельный запрос
+                if tg_id in self.clients:
+                    return self.clients[tg_id]
+                session_path = self.hibernated.get(tg_id)
+                if session_path is None:
+                    return None
+                try:
+                    client = await self.start_from_session(tg_id, session_path)
+                except Exception as e:  # noqa: BLE001
+                    # сеть или DC недоступны: аккаунт остаётся усыплённым до следующей попытки
+                    logger.warning("Не удалось разбудить клиента %s: %s", tg_id, e)
+                    return None
+                if client is None:
+                    self.hibernated.pop(tg_id, None)
+                    self._notify(tg_id)
+                else:
+                    logger.info("Клиент %s разбужен", tg_id)
+                return client
+        finally:
+            self._wake_locks.pop(tg_id, None)
 
-    def _register_handlers(self, client: TelegramClient, tg_id: int) -> None:
-        @client.on(events.NewMessage)
-        async def handler(event):  # type: ignore
-            if not self._message_callback:
-                return
+    async def hibernate_idle(self) -> int:
+        """Усыпляет клиентов без passthrough и расписания, а также простаивающих дольше TTL."""
+        ttl = self.config.hibernate_idle_ttl
+        now = time.monotonic()
+        count = 0
+        for tg_id in list(self.clients):
+            user = await self.db.get_user(tg_id)
+            inactive = self.config.hibernate_inactive and not (user and (user.passthrough or user.schedule_enabled))
+            idle = ttl > 0 and now - self._last_used.get(tg_id, now) > ttl
+            if (inactive or idle) and await self.hibernate(tg_id):
+                count += 1
+        return count
 
-            if event.out:
-                return
+    async def run_hibernation(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.hibernate_interval)
+            try:
+                count = await self.hibernate_idle()
+            except Exception as e:  # noqa: BLE001
+                logger.warning("Ошибка при усыплении клиентов: %s", e)
+                continue
+            if count:
+                logger.info("Усыплено клиентов: %s, активных: %s", count, len(self.clients))
 
-            user = self.db.get_user(tg_id)
-            if not user:
-                return
+    def begin_restore(self, tg_ids: Iterable[int]) -> None:
+        for tg_id in tg_ids:
+            self.restoring.add(tg_id)
+            self._notify(tg_id)
 
-            sender = await event.get_sender()
-            username = (getattr(sender, "username", "") or "").lower()
-            text = event.message.message or ""
+    def end_restore(self, tg_id: int) -> None:
+        self.restoring.discard(tg_id)
+        self._notify(tg_id)
 
-            if username != AgentUsername.lower():
-                return
+    def is_restoring(self, tg_id: int) -> bool:
+        return tg_id in self.restoring
+
+    async def _agent_peer(self, client: TelegramClient, tg_id: int, resolve: bool) -> Optional[InputPeerUser]:
+        """InputPeerUser агента для аккаунта: из goetia.db, из кэша сессии или через ResolveUsername."""
+        user = await self.db.get_user(tg_id)
+        if user and user.agent_peer_id and user.agent_access_hash is not None:
+            return InputPeerUser(user.agent_peer_id, user.agent_access_hash)
+
+        # таблица сущностей сессии — локальная, без запроса в сеть
+        try:
+            peer = client.session.get_input_entity(AgentUsername)
+        except ValueError:
+            peer = None
+        if peer is None and resolve:
+            await self._resolve_rate.acquire()
+            try:
+                peer = await client.get_input_entity(AgentUsername)
+            except (ValueError, RPCError) as e:
+                logger.warning("Не удалось получить peer агента для %s: %s", tg_id, e)
+                return None
+        if not isinstance(peer, InputPeerUser):
+            return None
+        await self.db.set_agent_peer(tg_id, peer.user_id, peer.access_hash)
+        return peer
+
+    async def ensure_agent_peer(self, tg_id: int) -> bool:
+        client = self.clients.get(tg_id)
+        if client is None:
+            self._unresolved_peers.discard(tg_id)
+            return False
+        peer = await self._agent_peer(client, tg_id, resolve=True)
+        if peer is None:
+            return False
+        self._unresolved_peers.discard(tg_id)
+        builder = self._agent_filters.get(tg_id)
+        if builder is not None:
+            builder.chats = {peer.user_id}
+        outbox = self._outboxes.get(tg_id)
+        if outbox is not None:
+            outbox.peer = peer
+        return True
+
+    async def prewarm_agent_peers(self) -> int:
+        """Резолвит агента для поднятых аккаунтов, у которых его нет в БД, с ограничением частоты."""
+        resolved = 0
+        for tg_id in list(self._unresolved_peers):
+            if await self.ensure_agent_peer(tg_id):
+                resolved += 1
+        if resolved:
+            logger.info("Резолвлен агент для %s аккаунтов", resolved)
+        return resolved
 
-            if not user.passthrough:
+    def _register_handlers(
+        self, client: TelegramClient, tg_id: int, agent_peer: Optional[InputPeerUser]
+    ) -> AgentMessages:
+        # Пока агент не резолвлен, фильтр пустой: ResolveUsername при первом же
+        # событии случился бы без ограничения частоты, поэтому ждём prewarm/отправки.
+        builder = AgentMessages(agent_peer.user_id if agent_peer else [], self.relay_stats)
+
+        @client.on(builder)
+        async def handler(event):  # type: ignore
+            if not self._message_callback:
                 return
 
-            if not text:
-                text = "<сообщение без текста или с медиа>"
+            with (
+                TRACER.trace("agent_to_user", tg_id=tg_id),
+                span("telethon.event"),
+                HANDLER_SECONDS.time(source="telethon", handler="agent_message"),
+            ):
+                with span("db.get_user"):
+                    user = await self.db.get_user(tg_id)
+                if not user or not user.passthrough:
+                    return
+
+                self._touch(tg_id)
+                text = event.message.message or ""
+                if not text:
+                    text = "<сообщение без текста или с медиа>"
 
-            await self._message_callback(tg_id, username or "unknown", text)
+                RELAY_FORWARDED.inc()
+                with span("message_callback"):
+                    # фильтр пропускает только чат агента, отправитель известен заранее
+                    await self._message_callback(tg_id, AgentUsername.lower(), text)
 
-        # nothing else; handler registration is enough
+        return builder
@@ -1,7 +1,7 @@
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
 from dotenv import load_dotenv
 
@@ -16,6 +16,56 @@ class Config:
     sessions_dir: Path = Path("sessions")
     logs_dir: Path = Path("logs")
     log_level: str = "INFO"
+    log_json: bool = False
+    log_rate_limits: Dict[str, float] = field(default_factory=dict)
+    log_sample: Dict[str, float] = field(default_factory=dict)
+    log_queue_size: int = 10_000
+    bot_api_url: Optional[str] = None
+    bot_mode: str = "polling"
+    webhook_url: Optional[str] = None
+    webhook_path: str = "/webhook"
+    webhook_host: str = "127.0.0.1"
+    webhook_port: int = 8080
+    webhook_secret: Optional[str] = None
+    webhook_concurrency: int = 100
+    webhook_max_connections: int = 40
+    update_concurrency: int = 100
+    fsm_ttl: float = 3600.0
+    login_max_pending: int = 100
+    login_ttl: float = 600.0
+    restore_concurrency: int = 20
+    restore_timeout: float = 30.0
+    hibernate_inactive: bool = True
+    hibernate_idle_ttl: float = 0.0
+    hibernate_interval: float = 60.0
+    buff_concurrency: int = 8
+    buff_jitter: float = 30.0
+    buff_rate: float = 5.0
+    delivery_global_rate: float = 25.0
+    delivery_chat_rate: float = 1.0
+    delivery_max_queue: int = 10_000
+    delivery_workers: int = 8
+    coalesce_window_ms: int = 0
+    agent_resolve_rate: float = 5.0
+    shards: int = 1
+    session_store: bool = True
+    session_flush_interval: float = 5.0
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    trace_sample_rate: float = 0.0
+    trace_max: int = 10_000
+    trace_dump: Optional[Path] = None
+    trace_format: str = "json"
+
+
+def _parse_log_rules(value: str) -> Dict[str, float]:
+    """«goetia_bot.scheduler=20,telethon=5» -> {логгер: число}."""
+    rules = {}
+    for item in value.split(","):
+        name, sep, number = item.partition("=")
+        if sep and name.strip() and number.strip():
+            rules[name.strip()] = float(number)
+    return rules
 
 
 def load_config(env_file: str = ".env") -> Config:
@@ -27,11 +77,53 @@ def load_config(env_file: str = ".env") -> Config:
     timezone = os.getenv("TZ", "Europe/Moscow").strip() or "Europe/Moscow"
     log_level = os.getenv("LOG_LEVEL", "INFO").strip().upper() or "INFO"
     logs_dir_env = os.getenv("LOG_DIR", "logs").strip() or "logs"
+    log_json = os.getenv("LOG_JSON", "0").strip().lower() in ("1", "true", "yes", "on")
+    log_rate_limits = os.getenv("LOG_RATE_LIMITS", "").strip()
+    log_sample = os.getenv("LOG_SAMPLE", "").strip()
+    log_queue_size = os.getenv("LOG_QUEUE_SIZE", "10000").strip() or "10000"
+    bot_api_url = os.getenv("BOT_API_URL", "").strip().rstrip("/")
+    bot_mode = os.getenv("BOT_MODE", "polling").strip().lower() or "polling"
+    webhook_url = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+    webhook_path = os.getenv("WEBHOOK_PATH", "/webhook").strip() or "/webhook"
+    webhook_host = os.getenv("WEBHOOK_HOST", "127.0.0.1").strip() or "127.0.0.1"
+    webhook_port = os.getenv("WEBHOOK_PORT", "8080").strip() or "8080"
+    webhook_secret = os.getenv("WEBHOOK_SECRET", "").strip()
+    webhook_concurrency = os.getenv("WEBHOOK_CONCURRENCY", "100").strip() or "100"
+    webhook_max_connections = os.getenv("WEBHOOK_MAX_CONNECTIONS", "40").strip() or "40"
+    update_concurrency = os.getenv("UPDATE_CONCURRENCY", "100").strip() or "100"
+    fsm_ttl = os.getenv("FSM_TTL", "3600").strip() or "3600"
+    login_max_pending = os.getenv("LOGIN_MAX_PENDING", "100").strip() or "100"
+    login_ttl = os.getenv("LOGIN_TTL", "600").strip() or "600"
+    restore_concurrency = os.getenv("RESTORE_CONCURRENCY", "20").strip() or "20"
+    restore_timeout = os.getenv("RESTORE_TIMEOUT", "30").strip() or "30"
+    hibernate_inactive = os.getenv("HIBERNATE_INACTIVE", "1").strip().lower() not in ("0", "false", "no", "off")
+    hibernate_idle_ttl = os.getenv("HIBERNATE_IDLE_TTL", "0").strip() or "0"
+    hibernate_interval = os.getenv("HIBERNATE_INTERVAL", "60").strip() or "60"
+    buff_concurrency = os.getenv("BUFF_CONCURRENCY", "8").strip() or "8"
+    buff_jitter = os.getenv("BUFF_JITTER", "30").strip() or "30"
+    buff_rate = os.getenv("BUFF_RATE", "5").strip() or "5"
+    delivery_global_rate = os.getenv("DELIVERY_GLOBAL_RATE", "25").strip() or "25"
+    delivery_chat_rate = os.getenv("DELIVERY_CHAT_RATE", "1").strip() or "1"
+    delivery_max_queue = os.getenv("DELIVERY_MAX_QUEUE", "10000").strip() or "10000"
+    delivery_workers = os.getenv("DELIVERY_WORKERS", "8").strip() or "8"
+    coalesce_window_ms = os.getenv("COALESCE_WINDOW_MS", "0").strip() or "0"
+    agent_resolve_rate = os.getenv("AGENT_RESOLVE_RATE", "5").strip() or "5"
+    shards = os.getenv("SHARDS", "1").strip() or "1"
+    session_store = os.getenv("SESSION_STORE", "1").strip().lower() not in ("0", "false", "no", "off")
+    session_flush_interval = os.getenv("SESSION_FLUSH_INTERVAL", "5").strip() or "5"
+    metrics_host = os.getenv("METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1"
+    metrics_port = os.getenv("METRICS_PORT", "0").strip() or "0"
+    trace_sample_rate = os.getenv("TRACE_SAMPLE_RATE", "0").strip() or "0"
+    trace_max = os.getenv("TRACE_MAX", "10000").strip() or "10000"
+    trace_dump = os.getenv("TRACE_DUMP", "").strip()
+    trace_format = os.getenv("TRACE_FORMAT", "json").strip().lower() or "json"
 
     if not bot_token:
         raise RuntimeError("Не указан BOT_TOKEN в .env")
     if not api_id or not api_hash:
         raise RuntimeError("Не заданы API_ID / API_HASH (my.telegram.org/apps)")
+    if bot_mode not in ("polling", "webhook"):
+        raise RuntimeError("BOT_MODE должен быть polling или webhook")
 
     return Config(
         bot_token=bot_token,
@@ -42,4 +134,44 @@ def load_config(env_file: str = ".env") -> Config:
         sessions_dir=Path("sessions"),
         logs_dir=Path(logs_dir_env),
         log_level=log_level,
+        log_json=log_json,
+        log_rate_limits=_parse_log_rules(log_rate_limits),
+        log_sample=_parse_log_rules(log_sample),
+        log_queue_size=int(log_queue_size),
+        bot_api_url=bot_api_url or None,
+        bot_mode=bot_mode,
+        webhook_url=webhook_url or None,
+        webhook_path=webhook_path if webhook_path.startswith("/") else "/" + webhook_path,
+        webhook_host=webhook_host,
+        webhook_port=int(webhook_port),
+        webhook_secret=webhook_secret or None,
+        webhook_concurrency=int(webhook_concurrency),
+        webhook_max_connections=min(100, max(1, int(webhook_max_connections))),
+        update_concurrency=int(update_concurrency),
+        fsm_ttl=float(fsm_ttl),
+        login_max_pending=int(login_max_pending),
+        login_ttl=float(login_ttl),
+        restore_concurrency=int(restore_concurrency),
+        restore_timeout=float(restore_timeout),
+        hibernate_inactive=hibernate_inactive,
+        hibernate_idle_ttl=float(hibernate_idle_ttl),
+        hibernate_interval=float(hibernate_interval),
+        buff_concurrency=int(buff_concurrency),
+        buff_jitter=float(buff_jitter),
+        buff_rate=float(buff_rate),
+        delivery_global_rate=float(delivery_global_rate),
+        delivery_chat_rate=float(delivery_chat_rate),
+        delivery_max_queue=int(delivery_max_queue),
+        delivery_workers=int(delivery_workers),
+        coalesce_window_ms=int(coalesce_window_ms),
+        agent_resolve_rate=float(agent_resolve_rate),
+        shards=max(1, int(shards)),
+        session_store=session_store,
+        session_flush_interval=float(session_flush_interval),
+        metrics_host=metrics_host,
+        metrics_port=int(metrics_port),
+        trace_sample_rate=float(trace_sample_rate),
+        trace_max=int(trace_max),
+        trace_dump=Path(trace_dump) if trace_dump else None,
+        trace_format=trace_format,
     )
@@ -1,17 +1,23 @@
 from dataclasses import dataclass
+from typing import Optional, Union
 
 from aiogram import Bot
 
 from .client_manager import ClientManager
 from .config import Config
-from .db import Database
+from .db import AsyncDatabase
+from .delivery import DeliveryQueue
+from .logins import PendingLogins
 from .scheduler import BuffScheduler
+from .sharding import ShardedClientManager
 
 
 @dataclass
 class AppContext:
     config: Config
-    db: Database
-    clients: ClientManager
+    db: AsyncDatabase
+    clients: Union[ClientManager, ShardedClientManager]
     scheduler: BuffScheduler
     bot: Bot
+    delivery: DeliveryQueue
+    logins: Optional[PendingLogins] = None
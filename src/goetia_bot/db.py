@@ -1,48 +1,206 @@
+import asyncio
 import sqlite3
-from dataclasses import dataclass
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
+from .metrics import DB_QUERY_SECONDS
 
-@dataclass
+
+# slots: без __dict__ запись в несколько раз меньше, а в LRU-кэше их десятки тысяч
+@dataclass(slots=True)
 class UserRecord:
     tg_id: int
     passthrough: bool = False
     schedule_enabled: bool = False
     schedule_time: str = "10:00"
     session_path: Optional[str] = None
+    # резолвленный @Agent_essence_bot для этого аккаунта (InputPeerUser)
+    agent_peer_id: Optional[int] = None
+    agent_access_hash: Optional[int] = None
+
+
+T = TypeVar("T")
+
+SQLITE_STATEMENT_CACHE = 64
+SQLITE_CACHE_KIB = 8192
+USER_COLUMNS = (
+    "tg_id, passthrough, schedule_enabled, schedule_time, session_path, agent_peer_id, agent_access_hash"
+)
+SELECT_USER = f"SELECT {USER_COLUMNS} FROM users WHERE tg_id = ?"
+# страница по уникальному индексу tg_id: курсор — последний tg_id предыдущей страницы
+SELECT_USERS_PAGE = f"SELECT {USER_COLUMNS} FROM users WHERE tg_id > ? ORDER BY tg_id LIMIT ?"
+# то же по частичному индексу idx_users_session; при одном шарде tg_id % 1 = 0 выполняется всегда
+SELECT_SESSION_USERS_PAGE = (
+    f"SELECT {USER_COLUMNS} FROM users WHERE session_path IS NOT NULL AND tg_id > ? AND tg_id % ? = ? "
+    "ORDER BY tg_id LIMIT ?"
+)
+USERS_PAGE_SIZE = 1000
+MIN_TG_ID = -(2**63)
+SELECT_SCHEDULED_USERS = f"SELECT {USER_COLUMNS} FROM users WHERE schedule_enabled = 1"
+
+
+def _migrate_users(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER UNIQUE NOT NULL,
+            passthrough INTEGER DEFAULT 0,
+            schedule_enabled INTEGER DEFAULT 0,
+            schedule_time TEXT DEFAULT '10:00',
+            session_path TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+
+
+def _migrate_agent_peer(conn: sqlite3.Connection) -> None:
+    # базы до версионирования (user_version = 0) уже могут содержать эти колонки
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+    if "agent_peer_id" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN agent_peer_id INTEGER")
+    if "agent_access_hash" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN agent_access_hash INTEGER")
+
+
+def _migrate_fsm_state(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state (updated_at)")
+
+
+def _migrate_user_indexes(conn: sqlite3.Connection) -> None:
+    # частичные индексы: их размер и стоимость обхода зависят от числа
+    # активных пользователей, а не от всех, кто когда-либо нажал /start
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_session ON users (tg_id) WHERE session_path IS NOT NULL")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_schedule ON users (schedule_time) WHERE schedule_enabled = 1"
+    )
+
+
+# Номер миграции — её позиция в списке (PRAGMA user_version). Новые добавляются
+# только в конец; уже выпущенные не меняются.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_users,
+    _migrate_agent_peer,
+    _migrate_fsm_state,
+    _migrate_user_indexes,
+]
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
 
 
 class Database:
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, cache_size: int = 10_000):
         self.path = path
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        # LRU-кэш записей пользователей; все set_* обновляют его сразу после записи в БД
+        self.cache_size = cache_size
+        self.cache_stats = CacheStats()
+        self._cache: "OrderedDict[int, UserRecord]" = OrderedDict()
+        # кэш читается и из потока БД, и из event loop (AsyncDatabase.get_user)
+        self._cache_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
         self._init_db()
 
+    def _cache_put(self, user: UserRecord) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[user.tg_id] = user
+            self._cache.move_to_end(user.tg_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.cache_stats.evictions += 1
+
+    def _cache_update(self, tg_id: int, **changes: Any) -> None:
+        with self._cache_lock:
+            user = self._cache.get(tg_id)
+            if user is not None:
+                self._cache[tg_id] = replace(user, **changes)
+
+    def invalidate(self, tg_id: int) -> None:
+        """Сбрасывает запись из кэша, если её изменил другой процесс."""
+        with self._cache_lock:
+            self._cache.pop(tg_id, None)
+
+    def cached_user(self, tg_id: int) -> Optional[UserRecord]:
+        with self._cache_lock:
+            user = self._cache.get(tg_id)
+            if user is not None:
+                self._cache.move_to_end(tg_id)
+                self.cache_stats.hits += 1
+            return user
+
     def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        # Одно долгоживущее соединение: sqlite3 кэширует подготовленные выражения
+        # по тексту запроса, поэтому все запросы ниже — неизменные строки.
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KIB}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._conn = conn
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def _init_db(self) -> None:
         with self._connect() as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tg_id INTEGER UNIQUE NOT NULL,
-                    passthrough INTEGER DEFAULT 0,
-                    schedule_enabled INTEGER DEFAULT 0,
-                    schedule_time TEXT DEFAULT '10:00',
-                    session_path TEXT,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-                );
-                """
-            )
-            conn.commit()
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+                migrate(conn)
+                # PRAGMA не принимает параметры; target — номер из списка MIGRATIONS
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+
+    @property
+    def schema_version(self) -> int:
+        return self._connect().execute("PRAGMA user_version").fetchone()[0]
+
+    @staticmethod
+    def _row_to_user(row: sqlite3.Row) -> UserRecord:
+        # порядок колонок — USER_COLUMNS
+        tg_id, passthrough, schedule_enabled, schedule_time, session_path, agent_peer_id, agent_access_hash = row
+        return UserRecord(
+            tg_id,
+            bool(passthrough),
+            bool(schedule_enabled),
+            schedule_time,
+            session_path,
+            agent_peer_id,
+            agent_access_hash,
+        )
 
     def upsert_user(self, tg_id: int) -> UserRecord:
+        cached = self.cached_user(tg_id)
+        if cached is not None:
+            # запись в кэше означает, что строка уже есть в БД
+            return cached
         with self._connect() as conn:
             conn.execute(
                 """
@@ -55,20 +213,20 @@ class Database:
         return self.get_user(tg_id)
 
     def get_user(self, tg_id: int) -> Optional[UserRecord]:
+        cached = self.cached_user(tg_id)
+        if cached is not None:
+            return cached
+        self.cache_stats.misses += 1
         with self._connect() as conn:
             row = conn.execute(
-                "SELECT tg_id, passthrough, schedule_enabled, schedule_time, session_path FROM users WHERE tg_id = ?",
+                SELECT_USER,
                 (tg_id,),
             ).fetchone()
             if not row:
                 return None
-            return UserRecord(
-                tg_id=row["tg_id"],
-                passthrough=bool(row["passthrough"]),
-                schedule_enabled=bool(row["schedule_enabled"]),
-                schedule_time=row["schedule_time"],
-                session_path=row["session_path"],
-            )
+            user = self._row_to_user(row)
+        self._cache_put(user)
+        return user
 
     def set_session_path(self, tg_id: int, session_path: Optional[str]) -> None:
         with self._connect() as conn:
@@ -77,6 +235,7 @@ class Database:
                 (session_path, tg_id),
             )
             conn.commit()
+        self._cache_update(tg_id, session_path=session_path)
 
     def set_passthrough(self, tg_id: int, enabled: bool) -> None:
         with self._connect() as conn:
@@ -85,6 +244,7 @@ class Database:
                 (int(enabled), tg_id),
             )
             conn.commit()
+        self._cache_update(tg_id, passthrough=enabled)
 
     def set_schedule(self, tg_id: int, enabled: bool, time_str: Optional[str] = None) -> None:
         with self._connect() as conn:
@@ -99,31 +259,213 @@ class Database:
                     (int(enabled), tg_id),
                 )
             conn.commit()
+        if time_str:
+            self._cache_update(tg_id, schedule_enabled=enabled, schedule_time=time_str)
+        else:
+            self._cache_update(tg_id, schedule_enabled=enabled)
 
     def set_schedule_time(self, tg_id: int, time_str: str) -> None:
         user = self.get_user(tg_id)
         self.set_schedule(tg_id, user.schedule_enabled if user else False, time_str)
 
+    def users_page(self, after: int = MIN_TG_ID, limit: int = USERS_PAGE_SIZE) -> List[UserRecord]:
+        with self._connect() as conn:
+            rows = conn.execute(SELECT_USERS_PAGE, (after, limit)).fetchall()
+        return [self._row_to_user(row) for row in rows]
+
+    def session_users_page(
+        self, after: int = MIN_TG_ID, limit: int = USERS_PAGE_SIZE, shards: int = 1, shard: int = 0
+    ) -> List[UserRecord]:
+        """Страница пользователей с сохранённой сессией (при shards > 1 — только шарда shard)."""
+        with self._connect() as conn:
+            rows = conn.execute(SELECT_SESSION_USERS_PAGE, (after, shards, shard, limit)).fetchall()
+        return [self._row_to_user(row) for row in rows]
+
+    def iter_users(self, page_size: int = USERS_PAGE_SIZE) -> Iterator[UserRecord]:
+        """Все пользователи по порядку tg_id, в памяти не больше одной страницы.
+
+        Между страницами курсор SQLite не держится открытым, поэтому остальные
+        запросы на общем соединении можно выполнять прямо во время обхода.
+        """
+        after = MIN_TG_ID
+        while True:
+            page = self.users_page(after, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1].tg_id
+
     def list_users(self) -> Dict[int, UserRecord]:
-        result: Dict[int, UserRecord] = {}
+        return {user.tg_id: user for user in self.iter_users()}
+
+    def scheduled_users(self) -> List[UserRecord]:
+        """Пользователи с авто-/buff; по минутам их раскладывает BuffScheduler в памяти."""
         with self._connect() as conn:
-            rows = conn.execute(
-                "SELECT tg_id, passthrough, schedule_enabled, schedule_time, session_path FROM users"
-            ).fetchall()
-            for row in rows:
-                result[row["tg_id"]] = UserRecord(
-                    tg_id=row["tg_id"],
-                    passthrough=bool(row["passthrough"]),
-                    schedule_enabled=bool(row["schedule_enabled"]),
-                    schedule_time=row["schedule_time"],
-                    session_path=row["session_path"],
-                )
-        return result
+            rows = conn.execute(SELECT_SCHEDULED_USERS).fetchall()
+        return [self._row_to_user(row) for row in rows]
+
+    def set_agent_peer(self, tg_id: int, peer_id: Optional[int], access_hash: Optional[int]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE users SET agent_peer_id = ?, agent_access_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE tg_id = ?",
+                (peer_id, access_hash, tg_id),
+            )
+            conn.commit()
+        self._cache_update(tg_id, agent_peer_id=peer_id, agent_access_hash=access_hash)
 
     def clear_user(self, tg_id: int) -> None:
+        # access_hash привязан к аккаунту: после повторного входа аккаунт может быть другим
         with self._connect() as conn:
             conn.execute(
-                "UPDATE users SET session_path = NULL, passthrough = 0, schedule_enabled = 0, updated_at = CURRENT_TIMESTAMP WHERE tg_id = ?",
+                "UPDATE users SET session_path = NULL, passthrough = 0, schedule_enabled = 0, "
+                "agent_peer_id = NULL, agent_access_hash = NULL, updated_at = CURRENT_TIMESTAMP WHERE tg_id = ?",
                 (tg_id,),
             )
             conn.commit()
+        self._cache_update(
+            tg_id,
+            session_path=None,
+            passthrough=False,
+            schedule_enabled=False,
+            agent_peer_id=None,
+            agent_access_hash=None,
+        )
+
+    def load_fsm(self, since: float) -> List[Tuple[str, Optional[str], str, float]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT key, state, data, updated_at FROM fsm_state WHERE updated_at >= ?", (since,)
+            ).fetchall()
+        return [(row["key"], row["state"], row["data"], row["updated_at"]) for row in rows]
+
+    def save_fsm(self, key: str, state: Optional[str], data: str, updated_at: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                (key, state, data, updated_at),
+            )
+            conn.commit()
+
+    def delete_fsm(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM fsm_state WHERE key = ?", (key,))
+            conn.commit()
+
+    def expire_fsm(self, before: float) -> int:
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,)).rowcount
+            conn.commit()
+        return deleted
+
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database.
+
+    Все обращения к SQLite выполняются по очереди в одном выделенном потоке,
+    поэтому медленный диск или блокировка файла не останавливают event loop.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="goetia-db")
+        # уведомление о записи в профиль пользователя: в шардированном режиме
+        # так соседний процесс узнаёт, что его кэш устарел
+        self.on_user_changed: Optional[Callable[[int], None]] = None
+
+    def _changed(self, tg_id: int) -> None:
+        if self.on_user_changed is not None:
+            self.on_user_changed(tg_id)
+
+    async def _call(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        with DB_QUERY_SECONDS.time(op=func.__name__):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Выполняет func в потоке БД: так же работают другие SQLite-хранилища процесса (сессии Telethon)."""
+        return await self._call(func, *args)
+
+    async def upsert_user(self, tg_id: int) -> UserRecord:
+        # запись в кэше означает, что строка уже есть: поток БД не нужен
+        cached = self.db.cached_user(tg_id)
+        if cached is not None:
+            return cached
+        return await self._call(self.db.upsert_user, tg_id)
+
+    async def get_user(self, tg_id: int) -> Optional[UserRecord]:
+        # попадание в кэш отдаём сразу, без перехода в поток БД
+        cached = self.db.cached_user(tg_id)
+        if cached is not None:
+            return cached
+        return await self._call(self.db.get_user, tg_id)
+
+    async def set_session_path(self, tg_id: int, session_path: Optional[str]) -> None:
+        await self._call(self.db.set_session_path, tg_id, session_path)
+        self._changed(tg_id)
+
+    async def set_passthrough(self, tg_id: int, enabled: bool) -> None:
+        await self._call(self.db.set_passthrough, tg_id, enabled)
+        self._changed(tg_id)
+
+    async def set_schedule(self, tg_id: int, enabled: bool, time_str: Optional[str] = None) -> None:
+        await self._call(self.db.set_schedule, tg_id, enabled, time_str)
+        self._changed(tg_id)
+
+    async def set_schedule_time(self, tg_id: int, time_str: str) -> None:
+        await self._call(self.db.set_schedule_time, tg_id, time_str)
+        self._changed(tg_id)
+
+    async def list_users(self) -> Dict[int, UserRecord]:
+        return await self._call(self.db.list_users)
+
+    async def iter_user_pages(
+        self, page_size: int = USERS_PAGE_SIZE, with_session: bool = False, shards: int = 1, shard: int = 0
+    ) -> AsyncIterator[List[UserRecord]]:
+        # каждая страница — отдельный вызов в потоке БД: между ними проходят другие запросы
+        after = MIN_TG_ID
+        while True:
+            if with_session:
+                page = await self._call(self.db.session_users_page, after, page_size, shards, shard)
+            else:
+                page = await self._call(self.db.users_page, after, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = page[-1].tg_id
+
+    async def scheduled_users(self) -> List[UserRecord]:
+        return await self._call(self.db.scheduled_users)
+
+    async def set_agent_peer(self, tg_id: int, peer_id: Optional[int], access_hash: Optional[int]) -> None:
+        await self._call(self.db.set_agent_peer, tg_id, peer_id, access_hash)
+        self._changed(tg_id)
+
+    async def clear_user(self, tg_id: int) -> None:
+        await self._call(self.db.clear_user, tg_id)
+        self._changed(tg_id)
+
+    async def load_fsm(self, since: float) -> List[Tuple[str, Optional[str], str, float]]:
+        return await self._call(self.db.load_fsm, since)
+
+    async def save_fsm(self, key: str, state: Optional[str], data: str, updated_at: float) -> None:
+        await self._call(self.db.save_fsm, key, state, data, updated_at)
+
+    async def delete_fsm(self, key: str) -> None:
+        await self._call(self.db.delete_fsm, key)
+
+    async def expire_fsm(self, before: float) -> int:
+        return await self._call(self.db.expire_fsm, before)
+
+    def invalidate(self, tg_id: int) -> None:
+        self.db.invalidate(tg_id)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.db.close()
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+import time
+from typing import Deque, Dict, List, Optional, Sequence, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from .ratelimit import TokenBucket
+from .tracing import Trace, current_trace
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+
+
+def pack_messages(texts: List[str], header: str = "", limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Склеивает тексты через пустую строку в сообщения не длиннее limit.
+
+    header ставится в начало каждого сообщения; текст, который сам не
+    помещается в лимит, режется на части.
+    """
+    room = limit - len(header)
+    pieces: List[str] = []
+    for text in texts:
+        if len(text) <= room:
+            pieces.append(text)
+        else:
+            pieces.extend(text[i : i + room] for i in range(0, len(text), room))
+
+    result: List[str] = []
+    current = ""
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if len(candidate) > room:
+            result.append(header + current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        result.append(header + current)
+    return result
+
+
+@dataclass
+class DeliveryStats:
+    enqueued: int = 0
+    sent: int = 0
+    dropped: int = 0
+    retries: int = 0
+    retry_after: int = 0
+    merged: int = 0  # сообщений агента, ушедших внутри чужой пачки
+
+
+@dataclass
+class _Outgoing:
+    text: str
+    attempts: int = 0
+    traces: Sequence[Trace] = ()
+    queued_at: float = 0.0
+
+
+@dataclass
+class _Burst:
+    header: str
+    texts: List[str]
+    timer: asyncio.TimerHandle
+    traces: List[Trace] = field(default_factory=list)
+    started: float = 0.0
+
+
+@dataclass
+class _ChatLane:
+    bucket: TokenBucket
+    pending: Deque[_Outgoing] = field(default_factory=deque)
+
+
+class DeliveryQueue:
+    """Очередь исходящих сообщений бота с глобальным и початовым лимитами.
+
+    Каждый чат — отдельная полоса: сообщения чата уходят строго по порядку,
+    чат с исчерпанным лимитом или под TelegramRetryAfter откладывается через
+    call_later и не занимает воркера. enqueue не ждёт Bot API.
+
+    При coalesce_window > 0 submit собирает сообщения, пришедшие в чат за
+    окно, в одно (или несколько, если не влезают в 4096 символов).
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = 25.0,
+        chat_rate: float = 1.0,
+        max_queue: int = 10_000,
+        max_attempts: int = 5,
+        workers: int = 8,
+        coalesce_window: float = 0.0,
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.stats = DeliveryStats()
+        self.depth = 0
+        self._global = TokenBucket(global_rate)
+        self._lanes: Dict[int, _ChatLane] = {}
+        # чаты, уже стоящие в _ready или ждущие таймера; второй раз их не ставим
+        self._scheduled: Set[int] = set()
+        self._ready: "asyncio.Queue[int]" = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._timers: Set[asyncio.TimerHandle] = set()
+        self._bursts: Dict[int, _Burst] = {}
+
+    def submit(self, chat_id: int, text: str, header: str = "") -> None:
+        trace = current_trace()
+        if self.coalesce_window <= 0:
+            self.enqueue(chat_id, header + text, traces=(trace,) if trace else ())
+            return
+        if trace is not None:
+            trace.hold()  # трасса закроется после отправки пачки
+        burst = self._bursts.get(chat_id)
+        if burst is not None and burst.header == header:
+            burst.texts.append(text)
+            if trace is not None:
+                burst.traces.append(trace)
+            self.stats.merged += 1
+            return
+        if burst is not None:
+            self.flush(chat_id)
+        timer = asyncio.get_running_loop().call_later(self.coalesce_window, self.flush, chat_id)
+        self._bursts[chat_id] = _Burst(header, [text], timer, [trace] if trace else [], time.perf_counter())
+
+    def flush(self, chat_id: int) -> None:
+        burst = self._bursts.pop(chat_id, None)
+        if burst is None:
+            return
+        burst.timer.cancel()
+        now = time.perf_counter()
+        for trace in burst.traces:
+            trace.add_span("delivery.coalesce", burst.started, now)
+        for message in pack_messages(burst.texts, burst.header):
+            self.enqueue(chat_id, message, traces=burst.traces)
+        for trace in burst.traces:
+            trace.release()
+
+    def enqueue(self, chat_id: int, text: str, traces: Sequence[Trace] = ()) -> bool:
+        if self.depth >= self.max_queue:
+            self.stats.dropped += 1
+            logger.warning("Очередь доставки переполнена (%s), сообщение для %s отброшено", self.depth, chat_id)
+            return False
+        self._ensure_workers()
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = _ChatLane(TokenBucket(self.chat_rate))
+        for trace in traces:
+            trace.hold()
+        lane.pending.append(_Outgoing(text, traces=traces, queued_at=time.perf_counter()))
+        self.depth += 1
+        self.stats.enqueued += 1
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+        return True
+
+    def _ensure_workers(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(max(1, self.workers))]
+
+    def _retry_later(self, chat_id: int, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        handle: asyncio.TimerHandle
+
+        def fire() -> None:
+            self._timers.discard(handle)
+            self._ready.put_nowait(chat_id)
+
+        handle = loop.call_later(delay, fire)
+        self._timers.add(handle)
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._deliver_next(chat_id)
+            except Exception as e:  # noqa: BLE001
+                logger.exception("Сбой очереди доставки для %s: %s", chat_id, e)
+                self._finish_turn(chat_id)
+
+    async def _deliver_next(self, chat_id: int) -> None:
+        lane = self._lanes.get(chat_id)
+        if lane is None or not lane.pending:
+            self._finish_turn(chat_id)
+            return
+        wait = lane.bucket.try_acquire()
+        if wait > 0:
+            self._retry_later(chat_id, wait)
+            return
+        await self._global.acquire()
+
+        item = lane.pending[0]
+        sent_at = time.perf_counter()
+        try:
+            await self.bot.send_message(chat_id, item.text)
+        except TelegramRetryAfter as e:
+            self.stats.retry_after += 1
+            logger.warning("Flood control для %s, ждём %s с", chat_id, e.retry_after)
+            self._retry_later(chat_id, e.retry_after)
+            return
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # бот заблокирован или сообщение некорректно — повтор не поможет
+            self._drop_head(lane)
+            logger.error("Не удалось доставить сообщение %s: %s", chat_id, e)
+        except Exception as e:  # noqa: BLE001
+            item.attempts += 1
+            if item.attempts >= self.max_attempts:
+                self._drop_head(lane)
+                logger.error("Не удалось доставить сообщение %s после %s попыток: %s", chat_id, item.attempts, e)
+            else:
+                self.stats.retries += 1
+                self._retry_later(chat_id, min(2 ** item.attempts, 60))
+                return
+        else:
+            lane.pending.popleft()
+            self.depth -= 1
+            self.stats.sent += 1
+            self._close_traces(item, sent_at)
+        self._finish_turn(chat_id)
+
+    def _drop_head(self, lane: _ChatLane) -> None:
+        item = lane.pending.popleft()
+        self.depth -= 1
+        self.stats.dropped += 1
+        self._close_traces(item, None)
+
+    @staticmethod
+    def _close_traces(item: _Outgoing, sent_at: Optional[float]) -> None:
+        now = time.perf_counter()
+        for trace in item.traces:
+            if sent_at is not None:
+                trace.add_span("delivery.queue", item.queued_at, sent_at)
+                trace.add_span("bot.send_message", sent_at, now)
+            trace.release()
+
+    def _finish_turn(self, chat_id: int) -> None:
+        lane = self._lanes.get(chat_id)
+        if lane is not None and lane.pending:
+            self._ready.put_nowait(chat_id)
+            return
+        if lane is not None and not lane.bucket.is_full():
+            # полосу держим, пока не восстановится лимит чата, иначе его можно обойти
+            self._retry_later(chat_id, 1 / self.chat_rate)
+            return
+        self._scheduled.discard(chat_id)
+        self._lanes.pop(chat_id, None)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        for chat_id in list(self._bursts):
+            self.flush(chat_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.depth and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            logger.warning("Очередь доставки закрыта, не доставлено сообщений: %s", self.depth)
+        for handle in self._timers:
+            handle.cancel()
+        self._timers.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
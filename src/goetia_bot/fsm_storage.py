@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from .db import AsyncDatabase
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    updated: float = 0.0
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM aiogram в таблице fsm_state с TTL.
+
+    Бот — единственный процесс, который пишет FSM, поэтому состояния в памяти
+    полные: чтения (фильтры состояний дёргают их на каждый апдейт) не ходят в БД,
+    а записи сразу уходят в SQLite через поток AsyncDatabase. Пустые записи не хранятся:
+    state.clear() у пользователя без состояния ничего не пишет. Записи без изменений
+    дольше ttl секунд (брошенный вход, забытый ввод времени) считаются пустыми
+    и удаляются из памяти и базы в run_eviction.
+    """
+
+    def __init__(self, db: AsyncDatabase, ttl: float = 3600.0):
+        self.db = db
+        self.ttl = ttl
+        self.expired = 0
+        self._records: Dict[str, _Record] = {}
+        self._keys = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+    @property
+    def size(self) -> int:
+        # не __len__: Dispatcher подставляет MemoryStorage, если storage ложно
+        return len(self._records)
+
+    async def load(self) -> None:
+        since = time.time() - self.ttl if self.ttl > 0 else 0.0
+        for key, state, data, updated in await self.db.load_fsm(since):
+            self._records[key] = _Record(state, json.loads(data), updated)
+        if self._records:
+            logger.info("Восстановлено FSM-состояний: %s", len(self._records))
+
+    def _expired(self, record: _Record, now: float) -> bool:
+        return self.ttl > 0 and now - record.updated > self.ttl
+
+    def _get(self, key: StorageKey) -> Optional[_Record]:
+        name = self._keys.build(key)
+        record = self._records.get(name)
+        if record is not None and self._expired(record, time.time()):
+            # из базы строку уберёт ближайший проход run_eviction
+            del self._records[name]
+            self.expired += 1
+            return None
+        return record
+
+    async def _save(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+        name = self._keys.build(key)
+        if state is None and not data:
+            if self._records.pop(name, None) is not None:
+                await self.db.delete_fsm(name)
+            return
+        record = self._records[name] = _Record(state, data, time.time())
+        await self.db.save_fsm(name, state, json.dumps(data, ensure_ascii=False), record.updated)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        value = state.state if isinstance(state, State) else state
+        if record is None and value is None:
+            return
+        await self._save(key, value, dict(record.data) if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key)
+        if record is None and not data:
+            return
+        await self._save(key, record.state if record else None, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return dict(record.data) if record else {}
+
+    async def evict_expired(self) -> int:
+        now = time.time()
+        stale = [name for name, record in self._records.items() if self._expired(record, now)]
+        for name in stale:
+            del self._records[name]
+        self.expired += len(stale)
+        if self.ttl > 0:
+            await self.db.expire_fsm(now - self.ttl)
+        return len(stale)
+
+    async def run_eviction(self, interval: float = 60.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_expired()
+            except Exception as e:  # noqa: BLE001
+                logger.warning("Не удалось очистить FSM-состояния: %s", e)
+
+    async def close(self) -> None:
+        # база закрывается вместе с AppContext
+        pass
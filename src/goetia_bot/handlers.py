@@ -1,20 +1,21 @@
 import asyncio
 import logging
-from typing import Dict
-
 from aiogram import F, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
-from telethon import TelegramClient
 from aiogram.exceptions import TelegramBadRequest
 
 from .client_manager import AgentUsername
 from .context import AppContext
 from .db import UserRecord
-from .keyboards import main_menu
+from .keyboards import menu
+from .logins import PendingLogins, TooManyLogins
+from .outbox import SendResult
 from .scheduler import parse_time
 from .states import ConnectStates, TimeState
+from .tracing import TRACER, span
+from .user_context import Profile, ProfileMiddleware
 
 logger = logging.getLogger(__name__)
 
@@ -22,64 +23,42 @@ logger = logging.getLogger(__name__)
 def setup_router(ctx: AppContext) -> Router:
     router = Router()
 
-    pending_clients: Dict[int, TelegramClient] = {}
+    if ctx.logins is None:
+        ctx.logins = PendingLogins(
+            ctx.clients.cancel_login, max_pending=ctx.config.login_max_pending, ttl=ctx.config.login_ttl
+        )
+    logins = ctx.logins
 
-    async def render_status(user_id: int) -> str:
-        user = ctx.db.get_user(user_id)
-        connected = ctx.clients.has_client(user_id)
-        lines = [
-            "⚙️ Goetia Bot",
-            f"Статус подключения: {'✅' if connected else '❌'}",
-        ]
-        if user:
-            lines.append(f"Passthrough: {'ON' if user.passthrough else 'OFF'}")
-            lines.append(
-                f"Авто /buff: {'ON' if user.schedule_enabled else 'OFF'} {user.schedule_time if user.schedule_enabled else ''}"
-            )
-        else:
-            lines.append("Профиль ещё не создан. Нажмите «Подключить».")
-        return "\n".join(lines)
+    router.message.outer_middleware(ProfileMiddleware(ctx.db))
+    router.callback_query.outer_middleware(ProfileMiddleware(ctx.db))
 
     async def show_menu(message: Message, user: UserRecord | None) -> None:
-        connected = ctx.clients.has_client(message.from_user.id)
-        kb = main_menu(
-            passthrough=user.passthrough if user else False,
-            schedule_enabled=user.schedule_enabled if user else False,
-        )
-        await message.answer(await render_status(message.from_user.id), reply_markup=kb.as_markup())
+        text, markup = menu(ctx.clients.client_state(message.from_user.id), user)
+        await message.answer(text, reply_markup=markup)
 
-    async def refresh_menu(target_message: Message, user_id: int) -> None:
-        user = ctx.db.get_user(user_id)
-        kb = main_menu(
-            passthrough=user.passthrough if user else False,
-            schedule_enabled=user.schedule_enabled if user else False,
-        )
-        text = await render_status(user_id)
+    async def refresh_menu(target_message: Message, user_id: int, user: UserRecord | None) -> None:
+        text, markup = menu(ctx.clients.client_state(user_id), user)
         try:
-            await target_message.edit_text(text, reply_markup=kb.as_markup())
+            await target_message.edit_text(text, reply_markup=markup)
         except TelegramBadRequest:
-            await target_message.answer(text, reply_markup=kb.as_markup())
+            await target_message.answer(text, reply_markup=markup)
 
     @router.message(CommandStart())
-    async def cmd_start(message: Message, state: FSMContext) -> None:
+    async def cmd_start(message: Message, state: FSMContext, profile: Profile) -> None:
         await state.clear()
-        user = ctx.db.upsert_user(message.from_user.id)
-        await show_menu(message, user)
+        await show_menu(message, await profile.ensure())
 
     @router.message(Command("menu"))
-    async def cmd_menu(message: Message, state: FSMContext) -> None:
+    async def cmd_menu(message: Message, state: FSMContext, profile: Profile) -> None:
         await state.clear()
-        user = ctx.db.upsert_user(message.from_user.id)
-        await show_menu(message, user)
+        await show_menu(message, await profile.ensure())
 
     @router.callback_query(F.data == "status")
-    async def cb_status(callback: CallbackQuery, state: FSMContext) -> None:
+    async def cb_status(callback: CallbackQuery, state: FSMContext, profile: Profile) -> None:
         await callback.answer()
         await state.clear()
-        text = await render_status(callback.from_user.id)
-        user = ctx.db.get_user(callback.from_user.id)
-        kb = main_menu(user.passthrough if user else False, user.schedule_enabled if user else False)
-        await callback.message.edit_text(text, reply_markup=kb.as_markup())
+        text, markup = menu(ctx.clients.client_state(callback.from_user.id), await profile.get())
+        await callback.message.edit_text(text, reply_markup=markup)
 
     @router.callback_query(F.data == "connect")
     @router.callback_query(F.data == "reconnect")
@@ -92,23 +71,32 @@ def setup_router(ctx: AppContext) -> Router:
     async def got_phone(message: Message, state: FSMContext) -> None:
         phone = message.text.strip()
         await state.update_data(phone=phone)
+        try:
+            logins.reserve(message.from_user.id)
+        except TooManyLogins as e:
+            await message.answer(str(e))
+            await state.clear()
+            return
         try:
             client, phone_code_hash = await ctx.clients.start_with_code(message.from_user.id, phone)
-            pending_clients[message.from_user.id] = client
+            await logins.add(message.from_user.id, client)
             await state.update_data(phone_code_hash=phone_code_hash)
         except Exception as e:  # noqa: BLE001
             logger.exception("Ошибка отправки кода: %s", e)
             await message.answer(f"Не удалось отправить код: {e}")
             await state.clear()
             return
+        finally:
+            # после add() слот уже занят клиентом, release ничего не меняет
+            logins.release(message.from_user.id)
         await state.set_state(ConnectStates.waiting_code)
         await message.answer("Код отправлен. Пришлите код из Telegram (5–6 цифр), как в сообщении.")
 
     @router.message(ConnectStates.waiting_code)
-    async def got_code(message: Message, state: FSMContext) -> None:
+    async def got_code(message: Message, state: FSMContext, profile: Profile) -> None:
         data = await state.get_data()
         phone = data.get("phone")
-        client = pending_clients.get(message.from_user.id)
+        client = logins.get(message.from_user.id)
         if not client or not phone:
             await message.answer("Сессия не найдена, попробуйте заново /start")
             await state.clear()
@@ -131,6 +119,7 @@ def setup_router(ctx: AppContext) -> Router:
                 e,
             )
             await message.answer(f"Не удалось авторизоваться: {e}")
+            await logins.discard(message.from_user.id)
             await state.clear()
             return
 
@@ -144,6 +133,7 @@ def setup_router(ctx: AppContext) -> Router:
             except Exception as e:  # noqa: BLE001
                 logger.exception("Не удалось запросить новый код: %s", e)
                 await message.answer(f"Не удалось запросить новый код: {e}")
+                await logins.discard(message.from_user.id)
                 await state.clear()
                 return
             return
@@ -155,19 +145,20 @@ def setup_router(ctx: AppContext) -> Router:
 
         if not ok:
             await message.answer("Не удалось авторизоваться, попробуйте заново /start.")
+            await logins.discard(message.from_user.id)
             await state.clear()
             return
 
-        pending_clients.pop(message.from_user.id, None)
-        user = ctx.db.upsert_user(message.from_user.id)
-        ctx.db.set_passthrough(message.from_user.id, True)
+        logins.complete(message.from_user.id)
+        await profile.ensure()
+        await profile.set_passthrough(True)
         await state.clear()
         await message.answer("✅ Подключено. Теперь все ваши сообщения пойдут в @Agent_essence_bot.")
-        await show_menu(message, user)
+        await show_menu(message, profile.record)
 
     @router.message(ConnectStates.waiting_password)
-    async def got_password(message: Message, state: FSMContext) -> None:
-        client = pending_clients.get(message.from_user.id)
+    async def got_password(message: Message, state: FSMContext, profile: Profile) -> None:
+        client = logins.get(message.from_user.id)
         if not client:
             await message.answer("Сессия не найдена, начните /start")
             await state.clear()
@@ -178,54 +169,55 @@ def setup_router(ctx: AppContext) -> Router:
         except Exception as e:  # noqa: BLE001
             logger.exception("Ошибка 2FA: %s", e)
             await message.answer(f"Не удалось авторизоваться: {e}")
+            await logins.discard(message.from_user.id)
             await state.clear()
             return
         if not ok:
             await message.answer("Пароль не подошёл. Попробуйте заново /start.")
+            await logins.discard(message.from_user.id)
             await state.clear()
             return
-        pending_clients.pop(message.from_user.id, None)
-        user = ctx.db.upsert_user(message.from_user.id)
-        ctx.db.set_passthrough(message.from_user.id, True)
+        logins.complete(message.from_user.id)
+        await profile.ensure()
+        await profile.set_passthrough(True)
         await state.clear()
         await message.answer("✅ Подключено с 2FA. Можно пользоваться.")
-        await show_menu(message, user)
+        await show_menu(message, profile.record)
 
     @router.callback_query(F.data == "disconnect")
-    async def cb_disconnect(callback: CallbackQuery, state: FSMContext) -> None:
+    async def cb_disconnect(callback: CallbackQuery, state: FSMContext, profile: Profile) -> None:
         await callback.answer()
         await state.clear()
         await ctx.clients.stop(callback.from_user.id)
-        ctx.db.clear_user(callback.from_user.id)
-        session_path = ctx.config.sessions_dir / f"user_{callback.from_user.id}.session"
-        if session_path.exists():
-            try:
-                session_path.unlink()
-            except OSError as e:  # noqa: BLE001
-                logger.warning("Не смог удалить сессию %s: %s", session_path, e)
+        await profile.get()
+        await profile.clear()
+        await ctx.clients.forget_session(callback.from_user.id)
         await callback.message.answer("Сессия отключена. Чтобы подключить снова — /start")
-        await refresh_menu(callback.message, callback.from_user.id)
+        await refresh_menu(callback.message, callback.from_user.id, profile.record)
 
     @router.callback_query(F.data == "toggle_passthrough")
-    async def cb_passthrough(callback: CallbackQuery, state: FSMContext) -> None:
+    async def cb_passthrough(callback: CallbackQuery, state: FSMContext, profile: Profile) -> None:
         await callback.answer()
         await state.clear()
-        user = ctx.db.upsert_user(callback.from_user.id)
+        user = await profile.ensure()
         new_state = not user.passthrough
-        ctx.db.set_passthrough(callback.from_user.id, new_state)
-        await refresh_menu(callback.message, callback.from_user.id)
+        await profile.set_passthrough(new_state)
+        if new_state:
+            # для passthrough нужен живой клиент, который слушает агента
+            try:
+                await ctx.clients.wake(callback.from_user.id)
+            except Exception as e:  # noqa: BLE001
+                logger.warning("Не удалось разбудить клиента %s: %s", callback.from_user.id, e)
+        await refresh_menu(callback.message, callback.from_user.id, profile.record)
 
     @router.callback_query(F.data == "toggle_schedule")
-    async def cb_schedule(callback: CallbackQuery, state: FSMContext) -> None:
+    async def cb_schedule(callback: CallbackQuery, state: FSMContext, profile: Profile) -> None:
         await callback.answer()
         await state.clear()
-        user = ctx.db.upsert_user(callback.from_user.id)
-        new_state = not user.schedule_enabled
-        ctx.db.set_schedule(callback.from_user.id, new_state)
-        user = ctx.db.get_user(callback.from_user.id)
-        if user:
-            ctx.scheduler.schedule_user(user)
-        await refresh_menu(callback.message, callback.from_user.id)
+        user = await profile.ensure()
+        await profile.set_schedule(not user.schedule_enabled)
+        ctx.scheduler.schedule_user(profile.record)
+        await refresh_menu(callback.message, callback.from_user.id, profile.record)
 
     @router.callback_query(F.data == "set_time")
     async def cb_set_time(callback: CallbackQuery, state: FSMContext) -> None:
@@ -234,36 +226,39 @@ def setup_router(ctx: AppContext) -> Router:
         await callback.message.answer("Пришлите время в формате HH:MM (по МСК). Пример: 10:30")
 
     @router.message(TimeState.waiting_time)
-    async def got_time(message: Message, state: FSMContext) -> None:
+    async def got_time(message: Message, state: FSMContext, profile: Profile) -> None:
         text = message.text.strip()
         try:
-            parse_time(text)
+            # в базе время всегда HH:MM, как его показывает меню
+            text = parse_time(text).strftime("%H:%M")
         except Exception as e:  # noqa: BLE001
             await message.answer(f"Неверный формат: {e}")
             return
-        ctx.db.set_schedule_time(message.from_user.id, text)
-        user = ctx.db.get_user(message.from_user.id)
-        if user:
-            ctx.scheduler.schedule_user(user)
+        await profile.set_schedule_time(text)
+        if profile.record:
+            ctx.scheduler.schedule_user(profile.record)
         await state.clear()
-        await refresh_menu(message, message.from_user.id)
+        await refresh_menu(message, message.from_user.id, profile.record)
 
     @router.message(F.text)
     async def forward_to_agent(message: Message, state: FSMContext) -> None:
         if await state.get_state():
             return  # в процессе ввода
         if not ctx.clients.has_client(message.from_user.id):
+            if ctx.clients.is_restoring(message.from_user.id):
+                await message.answer("⏳ Аккаунт переподключается после перезапуска, повторите через несколько секунд.")
             return
         text = message.text
-        sent = await ctx.clients.send_to_agent(message.from_user.id, text)
+        with TRACER.trace("user_to_agent", tg_id=message.from_user.id), span("aiogram.forward_to_agent"):
+            sent = await ctx.clients.send_to_agent(message.from_user.id, text)
         if not sent:
             await message.answer("Не удалось отправить, подключение к аккаунту отсутствует.")
+        elif sent is SendResult.PARKED:
+            await message.answer("⏳ Telegram временно ограничил отправку (FloodWait), сообщение уйдёт позже.")
 
     async def on_client_message(tg_id: int, sender: str, text: str) -> None:
-        try:
-            await ctx.bot.send_message(tg_id, f"[{sender}] {text}")
-        except Exception as e:  # noqa: BLE001
-            logger.error("Не удалось доставить сообщение %s: %s", tg_id, e)
+        # только ставим в очередь: лимиты Bot API и повторы — забота DeliveryQueue
+        ctx.delivery.submit(tg_id, text, header=f"[{sender}] ")
 
     ctx.clients.set_message_callback(on_client_message)
 
@@ -1,5 +1,18 @@
+from functools import lru_cache
+from typing import Optional
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from .client_manager import ClientState
+from .db import UserRecord
+
+CONNECTION_LABELS = {
+    ClientState.CONNECTED: "✅",
+    ClientState.HIBERNATED: "✅ (спящий режим)",
+    ClientState.RESTORING: "⏳ переподключение",
+}
+
 
 def main_menu(passthrough: bool, schedule_enabled: bool) -> InlineKeyboardBuilder:
     kb = InlineKeyboardBuilder()
@@ -18,3 +31,43 @@ def main_menu(passthrough: bool, schedule_enabled: bool) -> InlineKeyboardBuilde
     kb.button(text="ℹ️ Статус", callback_data="status")
     kb.adjust(2, 2, 2, 1)
     return kb
+
+
+# Модели aiogram изменяемы (frozen=False), поэтому кэшируем только кнопки в кортежах,
+# а разметку собираем заново: общий экземпляр на все сообщения можно случайно испортить
+@lru_cache(maxsize=None)
+def _main_menu_rows(passthrough: bool, schedule_enabled: bool) -> tuple[tuple[tuple[str, str], ...], ...]:
+    markup = main_menu(passthrough, schedule_enabled).as_markup()
+    return tuple(tuple((b.text, b.callback_data) for b in row) for row in markup.inline_keyboard)
+
+
+def main_menu_markup(passthrough: bool, schedule_enabled: bool) -> InlineKeyboardMarkup:
+    rows = _main_menu_rows(passthrough, schedule_enabled)
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in rows]
+    )
+
+
+@lru_cache(maxsize=4096)
+def _status_text(connection: str, profile: Optional[tuple[bool, bool, str]]) -> str:
+    lines = [
+        "⚙️ Goetia Bot",
+        f"Статус подключения: {connection}",
+    ]
+    if profile is not None:
+        passthrough, schedule_enabled, schedule_time = profile
+        lines.append(f"Passthrough: {'ON' if passthrough else 'OFF'}")
+        lines.append(f"Авто /buff: {'ON' if schedule_enabled else 'OFF'} {schedule_time if schedule_enabled else ''}")
+    else:
+        lines.append("Профиль ещё не создан. Нажмите «Подключить».")
+    return "\n".join(lines)
+
+
+def status_text(state: ClientState, user: Optional[UserRecord]) -> str:
+    profile = (user.passthrough, user.schedule_enabled, user.schedule_time) if user else None
+    return _status_text(CONNECTION_LABELS.get(state, "❌"), profile)
+
+
+def menu(state: ClientState, user: Optional[UserRecord]) -> tuple[str, InlineKeyboardMarkup]:
+    markup = main_menu_markup(user.passthrough if user else False, user.schedule_enabled if user else False)
+    return status_text(state, user), markup
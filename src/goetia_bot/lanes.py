@@ -0,0 +1,103 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.storage.base import BaseEventIsolation, StorageKey
+
+from .metrics import UPDATE_WAIT_SECONDS
+
+
+class _Lane:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # апдейты пользователя в обработке и в ожидании
+
+
+class UserLanes(BaseEventIsolation):
+    """Апдейты разных пользователей обрабатываются параллельно, одного пользователя — строго по очереди.
+
+    Передаётся в Dispatcher(events_isolation=...): FSMContextMiddleware берёт блокировку
+    до чтения состояния, поэтому каждый апдейт маршрутизируется по состоянию, которое
+    оставил предыдущий апдейт того же пользователя. asyncio.Lock отдаёт блокировку
+    в порядке ожидания, поэтому порядок апдейтов сохраняется.
+    """
+
+    def __init__(self):
+        self._lanes: Dict[int, _Lane] = {}
+        self._holding = 0
+
+    @property
+    def lanes(self) -> int:
+        return len(self._lanes)
+
+    @property
+    def waiting(self) -> int:
+        return sum(lane.users for lane in self._lanes.values()) - self._holding
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        lane = self._lanes.get(key.user_id)
+        if lane is None:
+            lane = self._lanes[key.user_id] = _Lane()
+        lane.users += 1
+        try:
+            started = time.perf_counter()
+            async with lane.lock:
+                UPDATE_WAIT_SECONDS.observe(time.perf_counter() - started, stage="lane")
+                self._holding += 1
+                try:
+                    yield
+                finally:
+                    self._holding -= 1
+        finally:
+            lane.users -= 1
+            if not lane.users:
+                del self._lanes[key.user_id]
+
+    async def close(self) -> None:
+        pass
+
+
+class UpdateLimitMiddleware(BaseMiddleware):
+    """Общий лимит апдейтов в обработке.
+
+    Outer-middleware на dp.update регистрируется после встроенного FSMContextMiddleware,
+    поэтому слот берётся уже после своей очереди в UserLanes: ждущие апдейты слоты не занимают.
+    """
+
+    def __init__(self, concurrency: int = 0):
+        self.concurrency = concurrency
+        self._limit: Optional[asyncio.Semaphore] = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.inflight = 0
+        self.waiting = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self._limit is None:
+            return await self._handle(handler, event, data)
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._limit.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            UPDATE_WAIT_SECONDS.observe(time.perf_counter() - started, stage="global")
+            return await self._handle(handler, event, data)
+        finally:
+            self._limit.release()
+
+    async def _handle(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        self.inflight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.inflight -= 1
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+CancelLogin = Callable[[int, Any], Awaitable[None]]
+
+
+class TooManyLogins(RuntimeError):
+    pass
+
+
+@dataclass
+class LoginStats:
+    started: int = 0
+    completed: int = 0
+    evicted: int = 0  # отключены по таймауту простоя
+    rejected: int = 0  # отказ из-за лимита незавершённых входов
+
+
+class PendingLogins:
+    """Незавершённые входы: TelegramClient между отправкой кода и вводом кода/пароля.
+
+    Каждый такой клиент держит MTProto-соединение. Реестр ограничивает их число
+    (новый вход сверх лимита отклоняется, чтобы поток брошенных входов не вытеснял
+    настоящих пользователей) и отключает клиентов, к которым не обращались ttl секунд.
+    """
+
+    def __init__(self, cancel: CancelLogin, max_pending: int = 100, ttl: float = 600.0):
+        self.cancel = cancel
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.stats = LoginStats()
+        # порядок — по последнему обращению: просроченные всегда в начале
+        self._clients: "OrderedDict[int, tuple[Any, float]]" = OrderedDict()
+        # слоты, занятые на время start_with_code: клиент ещё подключается
+        self._reserved: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._clients) + len(self._reserved)
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self._clients
+
+    def reserve(self, tg_id: int) -> None:
+        """Занимает слот до start_with_code, чтобы не открывать соединение сверх лимита.
+
+        Слот освобождает add() или release(); параллельные входы разных пользователей
+        видят уже занятые слоты, поэтому лимит не превышается.
+        """
+        if tg_id in self._clients or tg_id in self._reserved:
+            return
+        if self.max_pending > 0 and len(self) >= self.max_pending:
+            self.stats.rejected += 1
+            raise TooManyLogins("Слишком много незавершённых входов, попробуйте через несколько минут")
+        self._reserved.add(tg_id)
+
+    def release(self, tg_id: int) -> None:
+        self._reserved.discard(tg_id)
+
+    async def add(self, tg_id: int, client: Any) -> None:
+        self._reserved.discard(tg_id)
+        previous = self._clients.pop(tg_id, None)
+        if previous is not None:
+            await self._cancel(tg_id, previous[0])
+        self._clients[tg_id] = (client, time.monotonic())
+        self.stats.started += 1
+
+    def get(self, tg_id: int) -> Optional[Any]:
+        entry = self._clients.get(tg_id)
+        if entry is None:
+            return None
+        self._clients[tg_id] = (entry[0], time.monotonic())
+        self._clients.move_to_end(tg_id)
+        return entry[0]
+
+    def complete(self, tg_id: int) -> None:
+        """Вход завершён: клиент перешёл к ClientManager, отключать его не нужно."""
+        if self._clients.pop(tg_id, None) is not None:
+            self.stats.completed += 1
+
+    async def discard(self, tg_id: int) -> None:
+        entry = self._clients.pop(tg_id, None)
+        if entry is not None:
+            await self._cancel(tg_id, entry[0])
+
+    async def _cancel(self, tg_id: int, client: Any) -> None:
+        try:
+            await self.cancel(tg_id, client)
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Не удалось отключить незавершённый вход %s: %s", tg_id, e)
+
+    async def evict_expired(self) -> int:
+        if self.ttl <= 0:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        stale = []
+        for tg_id, (client, touched) in self._clients.items():
+            if touched > deadline:
+                break
+            stale.append((tg_id, client))
+        # сначала убираем из реестра: пока ждём отключения, пользователь может начать вход заново
+        for tg_id, _ in stale:
+            del self._clients[tg_id]
+        await asyncio.gather(*(self._cancel(tg_id, client) for tg_id, client in stale))
+        if stale:
+            self.stats.evicted += len(stale)
+            logger.info("Отключено брошенных входов: %s", len(stale))
+        return len(stale)
+
+    async def run_eviction(self, interval: float = 60.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.evict_expired()
+
+    async def close(self) -> None:
+        clients, self._clients = list(self._clients.items()), OrderedDict()
+        await asyncio.gather(*(self._cancel(tg_id, client) for tg_id, (client, _) in clients))
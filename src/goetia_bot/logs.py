@@ -0,0 +1,197 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Tuple
+
+from .ratelimit import TokenBucket
+
+# служебные атрибуты LogRecord, которые не попадают в JSON как extra
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_TRACEBACKS = logging.Formatter()
+
+_listener: Optional["_Listener"] = None
+_queue_handler: Optional["DroppingQueueHandler"] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка; поля из extra= добавляются как есть."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ThrottleFilter(logging.Filter):
+    """Лимит записей в секунду и сэмплинг DEBUG/INFO по префиксу имени логгера.
+
+    Правило для goetia_bot.scheduler действует и на goetia_bot.scheduler.*; берётся самый длинный префикс.
+    WARNING и выше не сэмплируются, но упираются в лимит частоты; число пропущенных
+    записей дописывается к первой записи, прошедшей после паузы.
+    """
+
+    def __init__(self, rate_limits: Mapping[str, float], sample: Mapping[str, float]):
+        super().__init__()
+        self.rate_limits = dict(rate_limits)
+        self.sample = dict(sample)
+        self.suppressed = 0
+        self._rules: Dict[str, Tuple[Optional[TokenBucket], float]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._skipped: Dict[str, int] = {}
+
+    @staticmethod
+    def _match(rules: Mapping[str, float], name: str) -> Optional[str]:
+        best = None
+        for prefix in rules:
+            if (name == prefix or name.startswith(prefix + ".")) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return best
+
+    def _rule(self, name: str) -> Tuple[Optional[TokenBucket], float]:
+        rule = self._rules.get(name)
+        if rule is None:
+            prefix = self._match(self.rate_limits, name)
+            bucket = None
+            if prefix is not None:
+                # один бакет на правило: всплеск в дочерних логгерах делит общий лимит
+                bucket = self._buckets.get(prefix)
+                if bucket is None:
+                    bucket = self._buckets[prefix] = TokenBucket(self.rate_limits[prefix])
+            sample_prefix = self._match(self.sample, name)
+            rule = self._rules[name] = (bucket, self.sample[sample_prefix] if sample_prefix is not None else 1.0)
+        return rule
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        bucket, ratio = self._rule(record.name)
+        if ratio < 1.0 and record.levelno < logging.WARNING and random.random() >= ratio:
+            return False
+        if bucket is None:
+            return True
+        if bucket.try_acquire() > 0:
+            self.suppressed += 1
+            self._skipped[record.name] = self._skipped.get(record.name, 0) + 1
+            return False
+        skipped = self._skipped.pop(record.name, 0)
+        if skipped:
+            record.msg = f"{record.msg} (пропущено записей: {skipped})"
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который при переполненной очереди теряет запись, а не блокирует цикл событий."""
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.throttle: Optional[ThrottleFilter] = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # как в QueueHandler, но текст исключения остаётся в exc_text, а не склеивается с сообщением
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # очередь ограничена: при остановке ждём место, а не падаем на queue.Full
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(
+    log_level: str,
+    log_dir: Path,
+    filename: str = "bot.log",
+    json_format: bool = False,
+    rate_limits: Optional[Mapping[str, float]] = None,
+    sample: Optional[Mapping[str, float]] = None,
+    queue_size: int = 10_000,
+) -> DroppingQueueHandler:
+    """Корневой логгер пишет в очередь, а поток QueueListener — в консоль и файл с ротацией."""
+    global _listener, _queue_handler
+    stop_logging()
+    log_dir.mkdir(parents=True, exist_ok=True)
+    level = getattr(logging, log_level.upper(), logging.INFO)
+    if json_format:
+        fmt: logging.Formatter = JsonFormatter()
+    else:
+        fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers.clear()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(fmt)
+    stream_handler.setLevel(level)
+
+    file_handler = RotatingFileHandler(log_dir / filename, maxBytes=2_000_000, backupCount=3, encoding="utf-8")
+    file_handler.setFormatter(fmt)
+    file_handler.setLevel(level)
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=max(0, queue_size))
+    handler = DroppingQueueHandler(log_queue)
+    handler.setLevel(level)
+    if rate_limits or sample:
+        handler.throttle = ThrottleFilter(rate_limits or {}, sample or {})
+        handler.addFilter(handler.throttle)
+    root.addHandler(handler)
+
+    _listener = _Listener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    _listener.start()
+    _queue_handler = handler
+
+    logging.getLogger("telethon").setLevel(max(level, logging.INFO))
+    logging.getLogger("aiogram.event").setLevel(max(level, logging.INFO))
+    return handler
+
+
+def log_stats() -> Dict[str, int]:
+    """Потерянные при переполнении очереди и отсеянные лимитами/сэмплингом записи."""
+    handler = _queue_handler
+    if handler is None:
+        return {"dropped": 0, "suppressed": 0}
+    return {"dropped": handler.dropped, "suppressed": handler.throttle.suppressed if handler.throttle else 0}
+
+
+def stop_logging() -> None:
+    """Дописывает очередь и закрывает обработчики; безопасно вызывать повторно."""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,184 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# от миллисекунд до таймаутов Bot API/MTProto
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FLOOD_WAIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.doc}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(f"{line}\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # по каждому набору меток: счётчики корзин (+Inf последним), сумма
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = entry
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Callback(_Metric):
+    """Значение, которое считается при каждом запросе /metrics (размеры очередей, счётчики *Stats)."""
+
+    def __init__(self, name: str, doc: str, func: Callable[[], float], kind: str = "gauge"):
+        super().__init__(name, doc)
+        self.func = func
+        self.kind = kind
+
+    def samples(self) -> Iterator[str]:
+        try:
+            value = self.func()
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Не удалось посчитать метрику %s: %s", self.name, e)
+            return
+        yield f"{self.name} {_format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        # повторная регистрация (новый AppContext в тестах) заменяет прежнюю метрику
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, doc, labels))  # type: ignore[return-value]
+
+    def histogram(self, name: str, doc: str, labels: Sequence[str] = (), **kwargs: Any) -> Histogram:
+        return self.register(Histogram(name, doc, labels, **kwargs))  # type: ignore[return-value]
+
+    def gauge_func(self, name: str, doc: str, func: Callable[[], float]) -> None:
+        self.register(Callback(name, doc, func))
+
+    def counter_func(self, name: str, doc: str, func: Callable[[], float]) -> None:
+        self.register(Callback(name, doc, func, kind="counter"))
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+REGISTRY = Registry()
+
+# Метрики, которые пишутся прямо в горячем пути
+RELAY_FORWARDED = REGISTRY.counter(
+    "goetia_relay_forwarded_total", "Сообщения агента, переданные в бот (после фильтра и проверки passthrough)"
+)
+HANDLER_SECONDS = REGISTRY.histogram(
+    "goetia_handler_seconds", "Время обработчиков Telethon и aiogram", labels=("source", "handler")
+)
+BOT_API_SECONDS = REGISTRY.histogram("goetia_bot_api_seconds", "Время запросов к Bot API", labels=("method",))
+BOT_API_ERRORS = REGISTRY.counter("goetia_bot_api_errors_total", "Ошибки запросов к Bot API", labels=("method", "error"))
+AGENT_SEND_SECONDS = REGISTRY.histogram(
+    "goetia_agent_send_seconds", "Время send_to_agent: пробуждение и постановка в очередь аккаунта"
+)
+FLOOD_WAIT_SECONDS = REGISTRY.histogram(
+    "goetia_flood_wait_seconds", "Длительность FloodWait при отправке агенту", buckets=FLOOD_WAIT_BUCKETS
+)
+BUFF_TOTAL = REGISTRY.counter(
+    "goetia_buff_total", "Авто-/buff по расписанию: ok, parked (ждёт FloodWait), failed, error", labels=("result",)
+)
+UPDATE_WAIT_SECONDS = REGISTRY.histogram(
+    "goetia_update_wait_seconds",
+    "Ожидание апдейта перед обработкой: очередь пользователя (lane) и общий лимит (global)",
+    labels=("stage",),
+)
+DB_QUERY_SECONDS = REGISTRY.histogram("goetia_db_query_seconds", "Запросы к SQLite через AsyncDatabase", labels=("op",))
@@ -0,0 +1,68 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+from .metrics import BOT_API_ERRORS, BOT_API_SECONDS, HANDLER_SECONDS, REGISTRY, Registry
+from .tracing import TRACER, Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время обработчиков aiogram по имени функции-хендлера."""
+
+    async def __call__(self, handler: Callable[..., Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        with HANDLER_SECONDS.time(source="aiogram", handler=name):
+            return await handler(event, data)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            BOT_API_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, method=name)
+
+
+class MetricsServer:
+    """Локальный HTTP: /metrics в текстовом формате Prometheus и /traces с сэмплированными трассами."""
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY, tracer: Tracer = TRACER):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.tracer = tracer
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def _handle_traces(self, request: web.Request) -> web.Response:
+        if request.query.get("format") == "chrome":
+            return web.json_response(self.tracer.to_trace_events())
+        return web.json_response(self.tracer.to_json())
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        app.router.add_get("/traces", self._handle_traces)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
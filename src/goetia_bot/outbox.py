@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Awaitable, Callable, Deque, Optional
+
+from telethon import TelegramClient
+from telethon.errors import AuthKeyError, FloodWaitError, UnauthorizedError
+
+from .metrics import FLOOD_WAIT_SECONDS
+from .tracing import Trace, current_trace
+
+logger = logging.getLogger(__name__)
+
+# команды, повтор которых в очереди ничего не добавляет
+DEDUP_COMMANDS = frozenset({"/buff"})
+
+
+@dataclass
+class OutboxStats:
+    sent: int = 0
+    failed: int = 0
+    deduplicated: int = 0
+    flood_waits: int = 0
+    flood_wait_seconds: float = 0.0
+
+
+class SendResult(str, Enum):
+    QUEUED = "queued"
+    PARKED = "parked"  # принято, но очередь аккаунта стоит на FloodWait
+    FAILED = "failed"
+
+    def __bool__(self) -> bool:
+        return self is not SendResult.FAILED
+
+
+@dataclass
+class _Queued:
+    text: str
+    trace: Optional[Trace] = None
+    queued_at: float = 0.0
+
+
+class AccountOutbox:
+    """Очередь отправки агенту для одного аккаунта.
+
+    submit() только ставит сообщение в очередь: ни вызывающий обработчик, ни воркер
+    авто-/buff не ждут ни отправки, ни FloodWait. Сообщения уходят по одному.
+    FloodWaitError паркует очередь на указанное время, ошибка авторизации гасит
+    очередь и сообщает владельцу через on_unauthorized. Состояние авторизации
+    кэшируется: клиент попадает сюда только после успешной проверки при подключении.
+    """
+
+    def __init__(
+        self,
+        tg_id: int,
+        client: TelegramClient,
+        peer: Any,
+        stats: OutboxStats,
+        on_unauthorized: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        self.tg_id = tg_id
+        self.client = client
+        self.peer = peer
+        self.stats = stats
+        self.on_unauthorized = on_unauthorized
+        self.authorized = True
+        self.parked_until = 0.0
+        self._pending: Deque[_Queued] = deque()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def backlog(self) -> int:
+        return len(self._pending)
+
+    def flood_wait_left(self) -> float:
+        return max(0.0, self.parked_until - time.monotonic())
+
+    def _accepted(self) -> SendResult:
+        return SendResult.PARKED if self.flood_wait_left() > 0 else SendResult.QUEUED
+
+    def submit(self, text: str) -> SendResult:
+        if not self.authorized:
+            return SendResult.FAILED
+        if text in DEDUP_COMMANDS and any(queued.text == text for queued in self._pending):
+            self.stats.deduplicated += 1
+            return self._accepted()
+        trace = current_trace()
+        if trace is not None:
+            trace.hold()  # трасса закроется, когда сообщение уйдёт
+        self._pending.append(_Queued(text, trace, time.perf_counter()))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+        return self._accepted()
+
+    async def join(self) -> None:
+        """Ждёт, пока очередь опустеет (для тестов и остановки)."""
+        while self._task is not None and not self._task.done():
+            await asyncio.wait({self._task})
+
+    async def _drain(self) -> None:
+        while self._pending:
+            item = self._pending[0]
+            sent_at = time.perf_counter()
+            if item.trace is not None:
+                item.trace.add_span("outbox.queue", item.queued_at, sent_at)
+            try:
+                await self.client.send_message(self.peer, item.text)
+            except FloodWaitError as e:
+                self.stats.flood_waits += 1
+                self.stats.flood_wait_seconds += e.seconds
+                FLOOD_WAIT_SECONDS.observe(e.seconds)
+                self.parked_until = time.monotonic() + e.seconds
+                logger.warning("FloodWait %s с для %s, очередь (%s) на паузе", e.seconds, self.tg_id, self.backlog)
+                await asyncio.sleep(e.seconds)
+                self.parked_until = 0.0
+                continue
+            except (UnauthorizedError, AuthKeyError) as e:
+                logger.warning("Сессия %s больше не авторизована: %s", self.tg_id, e)
+                self.authorized = False
+                self.cancel()
+                if self.on_unauthorized is not None:
+                    await self.on_unauthorized(self.tg_id)
+                return
+            except Exception as e:  # noqa: BLE001
+                self._pending.popleft()
+                self.stats.failed += 1
+                logger.warning("Не удалось отправить агенту для %s: %s", self.tg_id, e)
+                self._done(item)
+                continue
+            self._pending.popleft()
+            self.stats.sent += 1
+            if item.trace is not None:
+                item.trace.add_span("telethon.send_message", sent_at, time.perf_counter())
+            self._done(item)
+
+    @staticmethod
+    def _done(item: _Queued) -> None:
+        if item.trace is not None:
+            item.trace.release()
+
+    def cancel(self) -> None:
+        """Отбрасывает неотправленные сообщения."""
+        while self._pending:
+            self._done(self._pending.popleft())
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
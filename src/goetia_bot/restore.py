@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterable, List
+
+from .client_manager import ClientManager
+from .config import Config
+from .db import UserRecord
+from .stats import percentile
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RestoreReport:
+    total: int = 0
+    restored: int = 0
+    unauthorized: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    hibernated: int = 0
+    wall_time: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+
+
+async def restore_sessions(
+    config: Config, clients: ClientManager, pages: AsyncIterable[List[UserRecord]]
+) -> RestoreReport:
+    """Поднимает сохранённые сессии; pages — страницы AsyncDatabase.iter_user_pages(with_session=True).
+
+    В памяти остаются только клиенты, которые надо поднять сейчас: усыплённые
+    аккаунты регистрируются по ходу обхода и дальше не держатся.
+    """
+    report = RestoreReport()
+    semaphore = asyncio.Semaphore(max(1, config.restore_concurrency))
+
+    async def restore_one(user: UserRecord) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                client = await asyncio.wait_for(
+                    # агента резолвим потом, в prewarm, чтобы не слать ResolveUsername пачкой
+                    clients.start_from_session(user.tg_id, Path(user.session_path), resolve_peer=False),
+                    timeout=config.restore_timeout,
+                )
+            except asyncio.TimeoutError:
+                report.timed_out += 1
+                logger.warning("Таймаут подъёма сессии %s (%.0f с)", user.tg_id, config.restore_timeout)
+                return
+            except Exception as e:  # noqa: BLE001
+                report.failed += 1
+                logger.warning("Не удалось поднять сессию %s: %s", user.tg_id, e)
+                return
+            finally:
+                clients.end_restore(user.tg_id)
+            # в перцентили идут только завершённые подключения: таймауты прибили бы p95 к restore_timeout
+            report.latencies.append(time.perf_counter() - started)
+            if client is None:
+                report.unauthorized += 1
+            else:
+                report.restored += 1
+
+    started = time.perf_counter()
+    pending: List[UserRecord] = []
+    async for users in pages:
+        # polling уже идёт: пока страница проверяется, пользователь видит «переподключение», а не тишину
+        clients.begin_restore(u.tg_id for u in users)
+        await clients.migrate_session_files(users)
+        for user in users:
+            if not (user.session_path and await clients.has_session(user.tg_id, Path(user.session_path))):
+                clients.end_restore(user.tg_id)
+                continue
+            if config.hibernate_inactive and not (user.passthrough or user.schedule_enabled):
+                # клиент без passthrough и расписания не нужен до первого обращения
+                clients.register_hibernated(user.tg_id, Path(user.session_path))
+                clients.end_restore(user.tg_id)
+                report.hibernated += 1
+                continue
+            pending.append(user)
+    # Первыми поднимаем тех, кому клиент нужен прямо сейчас: passthrough и авто-/buff
+    pending.sort(key=lambda u: not (u.passthrough or u.schedule_enabled))
+    restores = [restore_one(user) for user in pending]
+    report.total = len(restores)
+    await asyncio.gather(*restores)
+    report.wall_time = time.perf_counter() - started
+
+    logger.info(
+        "Восстановлено сессий %s из %s за %.2f с (connect p50=%.2f с, p95=%.2f с); "
+        "не авторизовано: %s, ошибок: %s, таймаутов: %s, усыплено без подключения: %s",
+        report.restored,
+        report.total,
+        report.wall_time,
+        percentile(report.latencies, 50),
+        percentile(report.latencies, 95),
+        report.unauthorized,
+        report.failed,
+        report.timed_out,
+        report.hibernated,
+    )
+    return report
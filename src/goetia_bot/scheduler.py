@@ -1,5 +1,8 @@
+import asyncio
 import logging
-from datetime import time
+import random
+from datetime import datetime, time
+from typing import Dict, List, Optional, Set
 from zoneinfo import ZoneInfo
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -7,7 +10,10 @@ from apscheduler.triggers.cron import CronTrigger
 
 from .client_manager import ClientManager
 from .config import Config
-from .db import Database, UserRecord
+from .db import AsyncDatabase, UserRecord
+from .metrics import BUFF_TOTAL
+from .outbox import SendResult
+from .ratelimit import TokenBucket
 
 logger = logging.getLogger(__name__)
 
@@ -23,21 +29,52 @@ def parse_time(time_str: str) -> time:
     return time(hour=hour, minute=minute)
 
 
+MINUTES_PER_DAY = 24 * 60
+MAX_CATCH_UP_MINUTES = 60  # как misfire_grace_time=3600 у прежних cron-задач
+
+
 class BuffScheduler:
-    def __init__(self, config: Config, db: Database, clients: ClientManager):
+    """Диспетчер авто-/buff: пользователи индексируются по минуте суток.
+
+    Раз в минуту APScheduler будит один тик, который раскладывает команды
+    текущей минуты со случайным сдвигом в пределах buff_jitter в очередь;
+    её разбирает ограниченный пул воркеров с общим лимитом buff_rate в секунду.
+    """
+
+    def __init__(self, config: Config, db: AsyncDatabase, clients: ClientManager):
         self.config = config
         self.db = db
         self.clients = clients
         self.scheduler = AsyncIOScheduler(timezone=ZoneInfo(config.timezone))
+        self._buckets: Dict[int, Set[int]] = {}
+        self._user_minute: Dict[int, int] = {}
+        self._last_minute: Optional[int] = None
+        self._rate = TokenBucket(config.buff_rate)
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._feeders: Set[asyncio.Task] = set()
 
     def start(self) -> None:
         if not self.scheduler.running:
+            self.scheduler.add_job(
+                self._tick,
+                trigger=CronTrigger(second=0),
+                id="buff_dispatcher",
+                replace_existing=True,
+                misfire_grace_time=30,
+                coalesce=True,
+                max_instances=1,
+            )
             self.scheduler.start()
             logger.info("Планировщик запущен в TZ %s", self.config.timezone)
 
     def shutdown(self) -> None:
         if self.scheduler.running:
             self.scheduler.shutdown(wait=False)
+        for task in [*self._workers, *self._feeders]:
+            task.cancel()
+        self._workers.clear()
+        self._feeders.clear()
 
     def schedule_user(self, user: UserRecord) -> None:
         self.remove_job(user.tg_id)
@@ -49,25 +86,91 @@ class BuffScheduler:
             logger.error("Неверное время %s для %s: %s", user.schedule_time, user.tg_id, e)
             return
 
-        trigger = CronTrigger(hour=tt.hour, minute=tt.minute)
-        self.scheduler.add_job(
-            self._buff_job,
-            trigger=trigger,
-            id=str(user.tg_id),
-            args=[user.tg_id],
-            replace_existing=True,
-            misfire_grace_time=3600,
-        )
-        logger.info("Поставлена авто-/buff для %s на %s", user.tg_id, user.schedule_time)
+        minute = tt.hour * 60 + tt.minute
+        self._buckets.setdefault(minute, set()).add(user.tg_id)
+        self._user_minute[user.tg_id] = minute
+        logger.debug("Поставлена авто-/buff для %s на %s", user.tg_id, user.schedule_time)
 
     def remove_job(self, tg_id: int) -> None:
-        job_id = str(tg_id)
-        if self.scheduler.get_job(job_id):
-            self.scheduler.remove_job(job_id)
+        minute = self._user_minute.pop(tg_id, None)
+        if minute is None:
+            return
+        bucket = self._buckets.get(minute)
+        if bucket is not None:
+            bucket.discard(tg_id)
+            if not bucket:
+                del self._buckets[minute]
+
+    def scheduled_count(self) -> int:
+        return len(self._user_minute)
+
+    async def _tick(self) -> None:
+        now = datetime.now(ZoneInfo(self.config.timezone))
+        minute = now.hour * 60 + now.minute
+        if self._last_minute is None:
+            gap = 1
+        else:
+            gap = (minute - self._last_minute) % MINUTES_PER_DAY
+        self._last_minute = minute
+        if gap == 0:
+            return
+        if gap > MAX_CATCH_UP_MINUTES:
+            gap = 1
+        # если event loop подвис на границе минуты, досылаем пропущенные корзины
+        for back in range(gap - 1, -1, -1):
+            self._spawn_feeder((minute - back) % MINUTES_PER_DAY)
+
+    def _spawn_feeder(self, minute: int) -> None:
+        if not self._buckets.get(minute):
+            return
+        task = asyncio.create_task(self._dispatch(minute))
+        self._feeders.add(task)
+        task.add_done_callback(self._feeders.discard)
+
+    def _ensure_workers(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(self._queue)) for _ in range(max(1, self.config.buff_concurrency))
+            ]
+        return self._queue
+
+    async def _dispatch(self, minute: int) -> None:
+        queue = self._ensure_workers()
+        tg_ids = list(self._buckets.get(minute, ()))
+        jitter = max(0.0, self.config.buff_jitter)
+        plan = sorted((random.uniform(0, jitter), tg_id) for tg_id in tg_ids)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        logger.info("Авто-/buff %02d:%02d: %s пользователей", minute // 60, minute % 60, len(plan))
+        for offset, tg_id in plan:
+            delay = started + offset - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            queue.put_nowait(tg_id)
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            tg_id = await queue.get()
+            try:
+                await self._rate.acquire()
+                await self._buff_job(tg_id)
+            except Exception as e:  # noqa: BLE001
+                BUFF_TOTAL.inc(result="error")
+                logger.error("Ошибка авто-/buff для %s: %s", tg_id, e)
+            finally:
+                queue.task_done()
 
     async def _buff_job(self, tg_id: int) -> None:
-        success = await self.clients.send_to_agent(tg_id, "/buff")
-        if success:
-            logger.info("Отправлен /buff для %s", tg_id)
+        result = await self.clients.send_to_agent(tg_id, "/buff")
+        if result is SendResult.PARKED:
+            # ещё не отправлен: ждёт конца FloodWait в очереди аккаунта
+            BUFF_TOTAL.inc(result="parked")
+            logger.info("/buff для %s в очереди, аккаунт на FloodWait", tg_id)
+        elif result:
+            BUFF_TOTAL.inc(result="ok")
+            logger.info("Поставлен в очередь /buff для %s", tg_id)
         else:
+            BUFF_TOTAL.inc(result="failed")
             logger.warning("Не удалось отправить /buff, клиент %s неактивен", tg_id)
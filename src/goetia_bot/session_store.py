@@ -0,0 +1,393 @@
+import asyncio
+import datetime
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.tl import types
+from telethon.tl.types import PeerChannel, PeerChat, PeerUser
+
+logger = logging.getLogger(__name__)
+
+EntityRow = Tuple[int, int, Optional[str], Optional[str], Optional[str]]  # id, hash, username, phone, name
+StateRow = Tuple[int, int, float, int]  # pts, qts, date, seq
+
+
+@dataclass
+class FlushStats:
+    flushes: int = 0
+    sessions: int = 0  # сессий с изменениями, записанных батчами
+    entities: int = 0
+    update_states: int = 0
+
+
+class StoredSession(MemorySession):
+    """Сессия Telethon поверх общего SessionStore.
+
+    Ключ авторизации и DC пишутся сразу (меняются редко и их потеря означает
+    повторный вход), сущности и update state копятся в памяти и уходят в базу
+    батчем из SessionStore.flush. Telethon вызывает эти методы синхронно в event loop,
+    поэтому запись только ставится в поток БД и не ждётся. Telethon раз в минуту пересохраняет весь
+    кэш сущностей, поэтому в грязные попадают только реально изменившиеся строки.
+    """
+
+    def __init__(self, store: "SessionStore", tg_id: int):
+        super().__init__()
+        self.store = store
+        self.tg_id = tg_id
+        self._entities: Dict[int, EntityRow] = {}  # type: ignore[assignment]
+        self._usernames: Dict[str, int] = {}
+        self._phones: Dict[str, int] = {}
+        self._dirty_entities: Dict[int, EntityRow] = {}
+        self._dirty_states: Dict[int, StateRow] = {}
+        self._state_rows: Dict[int, StateRow] = {}
+
+    # --- данные авторизации: запись сразу ---
+
+    def set_dc(self, dc_id, server_address, port):
+        changed = (dc_id or 0, server_address, port) != (self._dc_id, self._server_address, self._port)
+        super().set_dc(dc_id, server_address, port)
+        if changed:
+            self.store.save_auth(self)
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self.store.save_auth(self)
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self.store.save_auth(self)
+
+    # --- update state и сущности: write-behind ---
+
+    def set_update_state(self, entity_id, state):
+        row = (state.pts, state.qts, state.date.timestamp(), state.seq)
+        if self._state_rows.get(entity_id) == row:
+            return
+        self._state_rows[entity_id] = row
+        self._update_states[entity_id] = state
+        self._dirty_states[entity_id] = row
+        self.store.mark_dirty(self)
+
+    def process_entities(self, tlo):
+        changed = False
+        for row in self._entities_to_rows(tlo):
+            if self._entities.get(row[0]) != row:
+                self._put_entity(row)
+                self._dirty_entities[row[0]] = row
+                changed = True
+        if changed:
+            self.store.mark_dirty(self)
+
+    def _put_entity(self, row: EntityRow) -> None:
+        entity_id, _, username, phone, _ = row
+        previous = self._entities.get(entity_id)
+        if previous is not None:
+            if previous[2] and self._usernames.get(previous[2]) == entity_id:
+                del self._usernames[previous[2]]
+            if previous[3] and self._phones.get(previous[3]) == entity_id:
+                del self._phones[previous[3]]
+        self._entities[entity_id] = row
+        if username:
+            self._usernames[username] = entity_id
+        if phone:
+            self._phones[phone] = entity_id
+
+    def get_entity_rows_by_phone(self, phone):
+        entity_id = self._phones.get(phone)
+        return None if entity_id is None else self._entities[entity_id][:2]
+
+    def get_entity_rows_by_username(self, username):
+        entity_id = self._usernames.get(username)
+        return None if entity_id is None else self._entities[entity_id][:2]
+
+    def get_entity_rows_by_name(self, name):
+        return next((row[:2] for row in self._entities.values() if row[4] == name), None)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        ids = (id,) if exact else (
+            utils.get_peer_id(PeerUser(id)),
+            utils.get_peer_id(PeerChat(id)),
+            utils.get_peer_id(PeerChannel(id)),
+        )
+        return next((self._entities[i][:2] for i in ids if i in self._entities), None)
+
+    def take_dirty(self) -> Tuple[Dict[int, EntityRow], Dict[int, StateRow]]:
+        entities, self._dirty_entities = self._dirty_entities, {}
+        states, self._dirty_states = self._dirty_states, {}
+        return entities, states
+
+    def clone(self, to_instance=None):
+        # сессии экспортированных DC живут только в памяти
+        return super().clone(to_instance or MemorySession())
+
+    def save(self):
+        # Telethon зовёт save() после каждого обновления; запись делает SessionStore
+        pass
+
+    def close(self):
+        self.store.flush_session(self)
+
+    def delete(self):
+        self.store.discard(self.tg_id)
+        self.store.submit(self.store.delete, self.tg_id)
+
+
+class SessionStore:
+    """Все сессии Telethon в одном SQLite-файле вместо sessions/user_{tg_id}.session.
+
+    has/open/delete/import_file/close — блокирующие и выполняются в потоке executor
+    (у ClientManager это поток AsyncDatabase); записи из колбэков Telethon уходят
+    туда же через submit. Без executor всё выполняется на месте. Очередь грязных
+    сессий (_dirty) трогается только в потоке цикла: перед delete зовут discard.
+    """
+
+    def __init__(self, path: Path, flush_interval: float = 5.0, executor: Optional[Executor] = None):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.executor = executor
+        self.stats = FlushStats()
+        self._dirty: Dict[int, StoredSession] = {}
+        # растёт при каждом discard: батч, снятый до удаления сессии, уже не пишется
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_db()
+
+    def _init_db(self) -> None:
+        with self._lock, self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS telethon_sessions (
+                    tg_id INTEGER PRIMARY KEY,
+                    dc_id INTEGER NOT NULL,
+                    server_address TEXT,
+                    port INTEGER,
+                    auth_key BLOB,
+                    takeout_id INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS telethon_entities (
+                    tg_id INTEGER NOT NULL,
+                    id INTEGER NOT NULL,
+                    hash INTEGER NOT NULL,
+                    username TEXT,
+                    phone TEXT,
+                    name TEXT,
+                    PRIMARY KEY (tg_id, id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS telethon_update_state (
+                    tg_id INTEGER NOT NULL,
+                    id INTEGER NOT NULL,
+                    pts INTEGER,
+                    qts INTEGER,
+                    date REAL,
+                    seq INTEGER,
+                    PRIMARY KEY (tg_id, id)
+                ) WITHOUT ROWID;
+                """
+            )
+
+    def submit(self, func: Callable[..., Any], *args: Any) -> None:
+        """Запускает запись в потоке executor, не дожидаясь её."""
+        if self.executor is not None:
+            try:
+                self.executor.submit(func, *args).add_done_callback(self._log_failure)
+                return
+            except RuntimeError:
+                pass  # executor уже остановлен при завершении: пишем на месте
+        func(*args)
+
+    @staticmethod
+    def _log_failure(future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Не удалось записать сессию Telethon: %s", future.exception())
+
+    def has(self, tg_id: int) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM telethon_sessions WHERE tg_id = ? AND length(auth_key) > 0", (tg_id,)
+            ).fetchone()
+        return row is not None
+
+    def open(self, tg_id: int) -> StoredSession:
+        session = StoredSession(self, tg_id)
+        with self._lock:
+            auth = self._conn.execute(
+                "SELECT dc_id, server_address, port, auth_key, takeout_id FROM telethon_sessions WHERE tg_id = ?",
+                (tg_id,),
+            ).fetchone()
+            entities = self._conn.execute(
+                "SELECT id, hash, username, phone, name FROM telethon_entities WHERE tg_id = ?", (tg_id,)
+            ).fetchall()
+            states = self._conn.execute(
+                "SELECT id, pts, qts, date, seq FROM telethon_update_state WHERE tg_id = ?", (tg_id,)
+            ).fetchall()
+        if auth:
+            dc_id, session._server_address, session._port, key, session._takeout_id = auth
+            session._dc_id = dc_id or 0
+            session._auth_key = AuthKey(data=key) if key else None
+        for row in entities:
+            session._put_entity(tuple(row))
+        for entity_id, pts, qts, date, seq in states:
+            session._state_rows[entity_id] = (pts, qts, date, seq)
+            session._update_states[entity_id] = types.updates.State(
+                pts, qts, datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc), seq, unread_count=0
+            )
+        return session
+
+    def save_auth(self, session: StoredSession) -> None:
+        key = session.auth_key.key if session.auth_key else b""
+        # значения снимаем сейчас: к моменту записи сессия может измениться снова
+        self.submit(
+            self._save_auth_row,
+            (session.tg_id, session.dc_id, session.server_address, session.port, key, session.takeout_id),
+        )
+
+    def _save_auth_row(self, row: tuple) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO telethon_sessions (tg_id, dc_id, server_address, port, auth_key, takeout_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                row,
+            )
+
+    def mark_dirty(self, session: StoredSession) -> None:
+        self._dirty[session.tg_id] = session
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    def _take_dirty(self, sessions: List[StoredSession]) -> list:
+        batch = []
+        for session in sessions:
+            entities, states = session.take_dirty()
+            if entities or states:
+                batch.append((session.tg_id, self._generations.get(session.tg_id, 0), entities, states))
+        return batch
+
+    def _write(self, batch: list) -> None:
+        with self._lock:
+            batch = [entry for entry in batch if self._generations.get(entry[0], 0) == entry[1]]
+            if not batch:
+                return
+            entity_rows = [(tg_id, *row) for tg_id, _, entities, _ in batch for row in entities.values()]
+            state_rows = [
+                (tg_id, entity_id, *row) for tg_id, _, _, states in batch for entity_id, row in states.items()
+            ]
+            self._store_rows(entity_rows, state_rows)
+        self.stats.flushes += 1
+        self.stats.sessions += len(batch)
+        self.stats.entities += len(entity_rows)
+        self.stats.update_states += len(state_rows)
+
+    def _store_rows(self, entity_rows: list, state_rows: list) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO telethon_entities (tg_id, id, hash, username, phone, name) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                entity_rows,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO telethon_update_state (tg_id, id, pts, qts, date, seq) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                state_rows,
+            )
+
+    def flush(self) -> int:
+        """Записывает все накопленные изменения одной транзакцией."""
+        sessions, self._dirty = list(self._dirty.values()), {}
+        batch = self._take_dirty(sessions)
+        self._write(batch)
+        return len(batch)
+
+    def flush_session(self, session: StoredSession) -> None:
+        self._dirty.pop(session.tg_id, None)
+        self.submit(self._write, self._take_dirty([session]))
+
+    async def run_flusher(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # изменения забираем в потоке цикла, а пишем в потоке БД, чтобы не блокировать апдейты
+            sessions, self._dirty = dict(self._dirty), {}
+            batch: list = []
+            try:
+                batch = self._take_dirty(list(sessions.values()))
+                await loop.run_in_executor(self.executor, self._write, batch)
+            except Exception as e:  # noqa: BLE001
+                # флашер не должен умирать: иначе write-behind молча встанет до перезапуска
+                logger.warning("Не удалось сбросить сессии Telethon: %s", e)
+                self._requeue(sessions, batch)
+
+    def _requeue(self, sessions: Dict[int, StoredSession], batch: list) -> None:
+        """Возвращает несохранённые изменения в очередь, более свежие значения не перетирая."""
+        taken = {tg_id: (generation, entities, states) for tg_id, generation, entities, states in batch}
+        for tg_id, session in sessions.items():
+            generation, entities, states = taken.get(tg_id, (self._generations.get(tg_id, 0), {}, {}))
+            if self._generations.get(tg_id, 0) != generation:
+                continue  # сессию удалили, пока шла запись
+            session._dirty_entities = {**entities, **session._dirty_entities}
+            session._dirty_states = {**states, **session._dirty_states}
+            if session._dirty_entities or session._dirty_states:
+                self.mark_dirty(session)
+
+    def discard(self, tg_id: int) -> None:
+        """Снимает несохранённые изменения сессии; вызывается в потоке цикла перед delete."""
+        self._dirty.pop(tg_id, None)
+        self._generations[tg_id] = self._generations.get(tg_id, 0) + 1
+
+    def delete(self, tg_id: int) -> None:
+        with self._lock, self._conn:
+            for table in ("telethon_sessions", "telethon_entities", "telethon_update_state"):
+                self._conn.execute(f"DELETE FROM {table} WHERE tg_id = ?", (tg_id,))
+
+    def import_file(self, tg_id: int, session_file: Path) -> bool:
+        """Переносит sessions/user_{tg_id}.session (формат SQLiteSession) в общее хранилище."""
+        if not session_file.exists():
+            return False
+        src = sqlite3.connect(f"file:{session_file}?mode=ro", uri=True)
+        try:
+            auth = src.execute("SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions").fetchone()
+            if not auth or not auth[3]:
+                return False
+            entities = src.execute("SELECT id, hash, username, phone, name FROM entities").fetchall()
+            states = src.execute("SELECT id, pts, qts, date, seq FROM update_state").fetchall()
+        except sqlite3.DatabaseError as e:
+            logger.warning("Не удалось прочитать сессию %s: %s", session_file, e)
+            return False
+        finally:
+            src.close()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO telethon_sessions (tg_id, dc_id, server_address, port, auth_key, takeout_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (tg_id, *auth),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO telethon_entities (tg_id, id, hash, username, phone, name) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(tg_id, *row) for row in entities],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO telethon_update_state (tg_id, id, pts, qts, date, seq) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(tg_id, *row) for row in states],
+            )
+        return True
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,480 @@
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+from dataclasses import dataclass
+from multiprocessing.process import BaseProcess
+from typing import Any, Dict, Optional, Set, Tuple
+
+from .client_manager import ClientManager, ClientState, MessageCallback
+from .config import Config
+from .db import AsyncDatabase, Database
+from .logs import setup_logging, stop_logging
+from .outbox import SendResult
+from .restore import restore_sessions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MANAGER = "goetia_bot.client_manager:ClientManager"
+STREAM_LIMIT = 1 << 20
+SHARD_READY_TIMEOUT = 10.0
+RESTART_DELAY = 2.0
+SHUTDOWN_TIMEOUT = 10.0
+
+
+class ShardUnavailable(RuntimeError):
+    pass
+
+
+class ShardError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class RemoteClient:
+    """Незавершённый вход: сам TelegramClient живёт в процессе шарда.
+
+    login — номер входа в шарде: повторный ввод телефона заменяет клиента,
+    и отмена старого RemoteClient не должна задеть новый.
+    """
+
+    tg_id: int
+    shard: int
+    login: int = 0
+
+
+def _encode(frame: Dict[str, Any]) -> bytes:
+    return json.dumps(frame, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+class ShardedClientManager:
+    """Заменяет ClientManager в процессе бота, раздавая аккаунты по N воркерам.
+
+    Аккаунт tg_id обслуживает воркер tg_id % N. Связь — JSON-строки через
+    Unix-сокет: бот шлёт запросы {"id", "op", "args"}, воркер отвечает
+    {"id", "result"|"error"} и сам присылает события message/state/invalidate.
+    Состояния клиентов зеркалируются локально, поэтому has_client и
+    client_state остаются синхронными. Упавший воркер перезапускается,
+    остальные шарды этого не замечают.
+    """
+
+    def __init__(self, config: Config, db: AsyncDatabase, manager_factory: str = DEFAULT_MANAGER):
+        self.config = config
+        self.db = db
+        self.shards = config.shards
+        self.manager_factory = manager_factory
+        self.socket_path = config.data_dir / "shards.sock"
+        self.restarts = 0
+        self._states: Dict[int, ClientState] = {}
+        self._links: Dict[int, asyncio.StreamWriter] = {}
+        self._ready: Dict[int, asyncio.Event] = {}
+        self._pending: Dict[int, Dict[int, asyncio.Future]] = {shard: {} for shard in range(self.shards)}
+        self._processes: Dict[int, BaseProcess] = {}
+        self._seq = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._watchdog: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._closing = False
+        self._message_callback: Optional[MessageCallback] = None
+        db.on_user_changed = self._invalidate_remote
+
+    def shard_of(self, tg_id: int) -> int:
+        return tg_id % self.shards
+
+    async def start(self) -> None:
+        self._ready = {shard: asyncio.Event() for shard in range(self.shards)}
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        self._server = await asyncio.start_unix_server(
+            self._on_connect, path=str(self.socket_path), limit=STREAM_LIMIT
+        )
+        for shard in range(self.shards):
+            self._spawn(shard)
+        self._watchdog = asyncio.create_task(self._watch())
+        logger.info("Запущено шардов: %s", self.shards)
+
+    def _spawn(self, shard: int) -> None:
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=run_worker,
+            args=(self.config, shard, str(self.socket_path), self.manager_factory),
+            name=f"goetia-shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[shard] = process
+
+    async def _watch(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(RESTART_DELAY)
+            for shard, process in list(self._processes.items()):
+                if self._closing or process.is_alive():
+                    continue
+                logger.error("Шард %s завершился с кодом %s, перезапуск", shard, process.exitcode)
+                process.join(timeout=0)
+                self.restarts += 1
+                self._spawn(shard)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        hello = json.loads(await reader.readline() or b"{}")
+        shard = hello.get("shard")
+        if shard not in self._ready:
+            writer.close()
+            return
+        # воркер пришлёт актуальные состояния своих аккаунтов заново
+        for tg_id in [t for t in self._states if self.shard_of(t) == shard]:
+            del self._states[tg_id]
+        self._links[shard] = writer
+        self._ready[shard].set()
+        logger.info("Шард %s подключён", shard)
+        try:
+            while line := await reader.readline():
+                self._on_frame(shard, json.loads(line))
+        except (ConnectionError, ValueError) as e:
+            logger.warning("Обрыв связи с шардом %s: %s", shard, e)
+        finally:
+            self._shard_lost(shard)
+            writer.close()
+
+    def _on_frame(self, shard: int, frame: Dict[str, Any]) -> None:
+        if "id" in frame:
+            future = self._pending[shard].pop(frame["id"], None)
+            if future is None or future.done():
+                return
+            if "error" in frame:
+                future.set_exception(ShardError(frame["error"]))
+            else:
+                future.set_result(frame.get("result"))
+            return
+        event = frame.get("event")
+        if event == "state":
+            state = ClientState(frame["state"])
+            if state is ClientState.ABSENT:
+                self._states.pop(frame["tg_id"], None)
+            else:
+                self._states[frame["tg_id"]] = state
+        elif event == "message" and self._message_callback is not None:
+            self._spawn_task(self._message_callback(frame["tg_id"], frame["sender"], frame["text"]))
+        elif event == "invalidate":
+            self.db.invalidate(frame["tg_id"])
+
+    def _spawn_task(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _shard_lost(self, shard: int) -> None:
+        self._links.pop(shard, None)
+        if shard in self._ready:
+            self._ready[shard].clear()
+        pending, self._pending[shard] = self._pending[shard], {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ShardUnavailable(f"Шард {shard} недоступен"))
+        if self._closing:
+            return
+        # после перезапуска воркер поднимет эти сессии заново
+        for tg_id in self._states:
+            if self.shard_of(tg_id) == shard:
+                self._states[tg_id] = ClientState.RESTORING
+
+    def _invalidate_remote(self, tg_id: int) -> None:
+        writer = self._links.get(self.shard_of(tg_id))
+        if writer is not None:
+            writer.write(_encode({"op": "invalidate", "args": {"tg_id": tg_id}}))
+
+    async def _call(self, tg_id: int, op: str, **args: Any) -> Any:
+        shard = self.shard_of(tg_id)
+        writer = self._links.get(shard)
+        if writer is None:
+            ready = self._ready.get(shard)
+            if ready is None:
+                raise ShardUnavailable(f"Шард {shard} не запущен")
+            try:
+                await asyncio.wait_for(ready.wait(), timeout=SHARD_READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise ShardUnavailable(f"Шард {shard} недоступен") from None
+            # связь могла оборваться сразу после готовности
+            writer = self._links.get(shard)
+            if writer is None:
+                raise ShardUnavailable(f"Шард {shard} недоступен")
+        req_id = next(self._seq)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[shard][req_id] = future
+        writer.write(_encode({"id": req_id, "op": op, "args": {"tg_id": tg_id, **args}}))
+        return await future
+
+    def set_message_callback(self, cb: MessageCallback) -> None:
+        self._message_callback = cb
+
+    def has_client(self, tg_id: int) -> bool:
+        return self.client_state(tg_id) in (ClientState.CONNECTED, ClientState.HIBERNATED)
+
+    def state_counts(self) -> Dict[ClientState, int]:
+        counts = {ClientState.CONNECTED: 0, ClientState.HIBERNATED: 0}
+        for state in self._states.values():
+            if state in counts:
+                counts[state] += 1
+        return counts
+
+    def client_state(self, tg_id: int) -> ClientState:
+        return self._states.get(tg_id, ClientState.ABSENT)
+
+    def is_restoring(self, tg_id: int) -> bool:
+        return self.client_state(tg_id) is ClientState.RESTORING
+
+    async def send_to_agent(self, tg_id: int, text: str) -> SendResult:
+        try:
+            return SendResult(await self._call(tg_id, "send_to_agent", text=text))
+        except ShardUnavailable as e:
+            logger.warning("Не удалось отправить агенту для %s: %s", tg_id, e)
+            return SendResult.FAILED
+
+    async def wake(self, tg_id: int) -> bool:
+        try:
+            return bool(await self._call(tg_id, "wake"))
+        except ShardUnavailable:
+            return False
+
+    async def stop(self, tg_id: int) -> None:
+        try:
+            await self._call(tg_id, "stop")
+        except (ShardUnavailable, ShardError) as e:
+            logger.warning("Не удалось остановить клиента %s: %s", tg_id, e)
+
+    async def forget_session(self, tg_id: int) -> None:
+        try:
+            await self._call(tg_id, "forget_session")
+        except (ShardUnavailable, ShardError) as e:
+            logger.warning("Не удалось удалить сессию %s: %s", tg_id, e)
+
+    async def start_with_code(self, tg_id: int, phone: str) -> tuple[RemoteClient, Optional[str]]:
+        login, phone_code_hash = await self._call(tg_id, "start_with_code", phone=phone)
+        return RemoteClient(tg_id, self.shard_of(tg_id), login), phone_code_hash
+
+    async def request_new_code(self, client: RemoteClient, tg_id: int, phone: str, force_sms: bool = False):
+        return await self._call(tg_id, "request_new_code", phone=phone, force_sms=force_sms)
+
+    async def finish_sign_in(
+        self,
+        tg_id: int,
+        client: RemoteClient,
+        phone: str,
+        code: str,
+        phone_code_hash: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> tuple[bool, bool]:
+        ok, password_needed = await self._call(
+            tg_id, "finish_sign_in", phone=phone, code=code, phone_code_hash=phone_code_hash, password=password
+        )
+        return bool(ok), bool(password_needed)
+
+    async def complete_with_password(self, tg_id: int, client: RemoteClient, password: str) -> bool:
+        return bool(await self._call(tg_id, "complete_with_password", password=password))
+
+    async def cancel_login(self, tg_id: int, client: RemoteClient) -> None:
+        await self._call(tg_id, "cancel_login", login=client.login)
+
+    async def run_hibernation(self) -> None:
+        # клиентов усыпляют и сессии сбрасывают сами воркеры
+        return None
+
+    async def prewarm_agent_peers(self) -> int:
+        return 0
+
+    async def run_session_flush(self) -> None:
+        return None
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+        for writer in self._links.values():
+            writer.write(_encode({"op": "shutdown"}))
+        loop = asyncio.get_running_loop()
+        for shard, process in self._processes.items():
+            await loop.run_in_executor(None, process.join, SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.warning("Шард %s не завершился вовремя, останавливаем принудительно", shard)
+                process.terminate()
+                await loop.run_in_executor(None, process.join, SHUTDOWN_TIMEOUT)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+
+class ShardWorker:
+    """Процесс шарда: свой ClientManager для аккаунтов tg_id % shards == shard."""
+
+    def __init__(self, config: Config, shard: int, db: AsyncDatabase, clients: ClientManager):
+        self.config = config
+        self.shard = shard
+        self.db = db
+        self.clients = clients
+        # tg_id -> (номер входа, TelegramClient)
+        self.pending_logins: Dict[int, Tuple[int, Any]] = {}
+        self._login_ids = itertools.count(1)
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _send(self, frame: Dict[str, Any]) -> None:
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_encode(frame))
+
+    async def _forward_message(self, tg_id: int, sender: str, text: str) -> None:
+        self._send({"event": "message", "tg_id": tg_id, "sender": sender, "text": text})
+
+    def _forward_state(self, tg_id: int, state: ClientState) -> None:
+        self._send({"event": "state", "tg_id": tg_id, "state": state.value})
+
+    def _forward_invalidate(self, tg_id: int) -> None:
+        self._send({"event": "invalidate", "tg_id": tg_id})
+
+    async def _startup(self) -> None:
+        pages = self.db.iter_user_pages(with_session=True, shards=self.config.shards, shard=self.shard)
+        await restore_sessions(self.config, self.clients, pages)
+        await self.clients.prewarm_agent_peers()
+
+    async def run(self, socket_path: str) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(socket_path, limit=STREAM_LIMIT)
+        self.clients.set_message_callback(self._forward_message)
+        self.clients.state_listener = self._forward_state
+        self.db.on_user_changed = self._forward_invalidate
+        self._send({"shard": self.shard})
+
+        background = [
+            asyncio.create_task(self._startup()),
+            asyncio.create_task(self.clients.run_hibernation()),
+            asyncio.create_task(self.clients.run_session_flush()),
+        ]
+        try:
+            while line := await reader.readline():
+                frame = json.loads(line)
+                if frame.get("op") == "shutdown":
+                    break
+                task = asyncio.create_task(self._handle(frame))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            for task in [*background, *self._tasks]:
+                task.cancel()
+            await asyncio.gather(*background, *self._tasks, return_exceptions=True)
+            for _, client in self.pending_logins.values():
+                await client.disconnect()
+            await self.clients.close()
+            self._writer.close()
+
+    async def _handle(self, frame: Dict[str, Any]) -> None:
+        handler = getattr(self, f"op_{frame.get('op')}", None)
+        req_id = frame.get("id")
+        try:
+            if handler is None:
+                raise ShardError(f"Неизвестная операция {frame.get('op')!r}")
+            result = await handler(**frame.get("args", {}))
+        except Exception as e:  # noqa: BLE001
+            if req_id is None:
+                logger.warning("Ошибка операции %s: %s", frame.get("op"), e)
+            else:
+                self._send({"id": req_id, "error": f"{type(e).__name__}: {e}"})
+            return
+        if req_id is not None:
+            self._send({"id": req_id, "result": result})
+
+    def _pending_login(self, tg_id: int):
+        entry = self.pending_logins.get(tg_id)
+        if entry is None:
+            raise ShardError("Вход не найден, начните заново /start")
+        return entry[1]
+
+    async def op_send_to_agent(self, tg_id: int, text: str) -> SendResult:
+        return await self.clients.send_to_agent(tg_id, text)
+
+    async def op_wake(self, tg_id: int) -> bool:
+        return await self.clients.wake(tg_id) is not None
+
+    async def op_stop(self, tg_id: int) -> None:
+        await self.clients.stop(tg_id)
+
+    async def op_forget_session(self, tg_id: int) -> None:
+        await self.clients.forget_session(tg_id)
+
+    async def op_invalidate(self, tg_id: int) -> None:
+        self.db.invalidate(tg_id)
+
+    async def op_start_with_code(self, tg_id: int, phone: str) -> list:
+        previous = self.pending_logins.pop(tg_id, None)
+        if previous is not None:
+            await previous[1].disconnect()
+        client, phone_code_hash = await self.clients.start_with_code(tg_id, phone)
+        login = next(self._login_ids)
+        self.pending_logins[tg_id] = (login, client)
+        return [login, phone_code_hash]
+
+    async def op_cancel_login(self, tg_id: int, login: int) -> None:
+        # вход уже заменён новым: тот клиент отключили в op_start_with_code
+        entry = self.pending_logins.get(tg_id)
+        if entry is None or entry[0] != login:
+            return
+        del self.pending_logins[tg_id]
+        await self.clients.cancel_login(tg_id, entry[1])
+
+    async def op_request_new_code(self, tg_id: int, phone: str, force_sms: bool = False) -> Optional[str]:
+        return await self.clients.request_new_code(self._pending_login(tg_id), tg_id, phone, force_sms=force_sms)
+
+    async def op_finish_sign_in(
+        self,
+        tg_id: int,
+        phone: str,
+        code: str,
+        phone_code_hash: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> list:
+        ok, password_needed = await self.clients.finish_sign_in(
+            tg_id, self._pending_login(tg_id), phone, code, phone_code_hash=phone_code_hash, password=password
+        )
+        if ok:
+            self.pending_logins.pop(tg_id, None)
+        return [ok, password_needed]
+
+    async def op_complete_with_password(self, tg_id: int, password: str) -> bool:
+        ok = await self.clients.complete_with_password(tg_id, self._pending_login(tg_id), password)
+        if ok:
+            self.pending_logins.pop(tg_id, None)
+        return ok
+
+
+def _import_factory(path: str):
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+async def _worker_main(config: Config, shard: int, socket_path: str, manager_factory: str) -> None:
+    db = AsyncDatabase(Database(config.data_dir / "goetia.db"))
+    clients = _import_factory(manager_factory)(config, db)
+    try:
+        await ShardWorker(config, shard, db, clients).run(socket_path)
+    finally:
+        db.close()
+
+
+def run_worker(config: Config, shard: int, socket_path: str, manager_factory: str = DEFAULT_MANAGER) -> None:
+    """Точка входа процесса шарда."""
+    setup_logging(
+        config.log_level,
+        config.logs_dir,
+        filename=f"shard{shard}.log",
+        json_format=config.log_json,
+        rate_limits=config.log_rate_limits,
+        sample=config.log_sample,
+        queue_size=config.log_queue_size,
+    )
+    logging.getLogger(__name__).info("Шард %s/%s запущен", shard, config.shards)
+    try:
+        asyncio.run(_worker_main(config, shard, socket_path, manager_factory))
+    finally:
+        stop_logging()
@@ -0,0 +1,188 @@
+import itertools
+import json
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from .stats import percentile
+
+_current: "ContextVar[Optional[Trace]]" = ContextVar("goetia_trace", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    end: float
+
+
+class Trace:
+    """Путь одного сообщения: от события Telethon до ответа Bot API или наоборот.
+
+    Трасса закрывается, когда завершился корневой блок и отпущены все hold():
+    очередь доставки и outbox держат трассу, пока сообщение не ушло.
+    """
+
+    def __init__(self, tracer: "Tracer", trace_id: int, name: str, attrs: Dict[str, Any]):
+        self.tracer = tracer
+        self.id = trace_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.spans: List[Span] = []
+        self._holds = 0
+        self._open = True
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append(Span(name, started, time.perf_counter()))
+
+    def add_span(self, name: str, start: float, end: float) -> None:
+        self.spans.append(Span(name, start, end))
+
+    def hold(self) -> None:
+        self._holds += 1
+
+    def release(self) -> None:
+        self._holds -= 1
+        self._maybe_finish()
+
+    def close(self) -> None:
+        self._open = False
+        self._maybe_finish()
+
+    def _maybe_finish(self) -> None:
+        if self._open or self._holds > 0 or self.end is not None:
+            return
+        self.end = time.perf_counter()
+        self.tracer.record(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "attrs": self.attrs,
+            "duration_ms": round(self.duration * 1000, 3),
+            "spans": [
+                {
+                    "name": s.name,
+                    "offset_ms": round((s.start - self.start) * 1000, 3),
+                    "duration_ms": round((s.end - s.start) * 1000, 3),
+                }
+                for s in self.spans
+            ],
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Спан в текущей трассе; без трассы (сэмплинг не выпал) ничего не делает."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+class Tracer:
+    """Сэмплирующий трассировщик с кольцевым буфером завершённых трасс."""
+
+    def __init__(self, sample_rate: float = 0.0, max_traces: int = 10_000):
+        self.sample_rate = sample_rate
+        self.finished: Deque[Trace] = deque(maxlen=max_traces)
+        self._ids = itertools.count(1)
+
+    def configure(self, sample_rate: float, max_traces: int) -> None:
+        self.sample_rate = sample_rate
+        self.finished = deque(self.finished, maxlen=max_traces)
+
+    @contextmanager
+    def trace(self, name: str, **attrs: Any) -> Iterator[Optional[Trace]]:
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            yield None
+            return
+        trace = Trace(self, next(self._ids), name, attrs)
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            trace.close()
+
+    def record(self, trace: Trace) -> None:
+        self.finished.append(trace)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """p50/p95/p99 в миллисекундах: по трассам целиком и по каждому спану."""
+        samples: Dict[str, List[float]] = {}
+        for trace in self.finished:
+            samples.setdefault(trace.name, []).append(trace.duration)
+            for s in trace.spans:
+                samples.setdefault(f"{trace.name}/{s.name}", []).append(s.end - s.start)
+        return {
+            name: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+            }
+            for name, values in sorted(samples.items())
+        }
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"summary": self.summary(), "traces": [trace.to_dict() for trace in self.finished]}
+
+    def to_trace_events(self) -> Dict[str, Any]:
+        """Формат Trace Event (chrome://tracing, Perfetto): трасса — отдельная дорожка."""
+        events: List[Dict[str, Any]] = []
+        for trace in self.finished:
+            events.append(
+                {
+                    "name": trace.name,
+                    "ph": "X",
+                    "ts": trace.start * 1_000_000,
+                    "dur": trace.duration * 1_000_000,
+                    "pid": 1,
+                    "tid": trace.id,
+                    "args": trace.attrs,
+                }
+            )
+            for s in trace.spans:
+                events.append(
+                    {
+                        "name": s.name,
+                        "ph": "X",
+                        "ts": s.start * 1_000_000,
+                        "dur": (s.end - s.start) * 1_000_000,
+                        "pid": 1,
+                        "tid": trace.id,
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: Path, fmt: str = "json") -> None:
+        data = self.to_trace_events() if fmt == "chrome" else self.to_json()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+
+TRACER = Tracer()
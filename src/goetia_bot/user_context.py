@@ -0,0 +1,81 @@
+from dataclasses import replace
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+
+from .db import AsyncDatabase, UserRecord
+
+
+class Profile:
+    """UserRecord на время одного апдейта.
+
+    Запись читается не больше одного раза и только если её попросил обработчик
+    (пересылка агенту профиль не трогает); set_* пишут в БД и сразу обновляют
+    локальную копию, поэтому перерисовка меню после изменения не перечитывает профиль.
+    """
+
+    def __init__(self, db: AsyncDatabase, tg_id: int):
+        self.db = db
+        self.tg_id = tg_id
+        self.record: Optional[UserRecord] = None
+        self.loaded = False
+        self.changed = False
+
+    async def get(self) -> Optional[UserRecord]:
+        if not self.loaded:
+            self.record = await self.db.get_user(self.tg_id)
+            self.loaded = True
+        return self.record
+
+    async def ensure(self) -> UserRecord:
+        record = await self.get()
+        if record is None:
+            record = self.record = await self.db.upsert_user(self.tg_id)
+        return record
+
+    def _update(self, **changes: Any) -> None:
+        self.changed = True
+        if self.record is not None:
+            self.record = replace(self.record, **changes)
+
+    async def set_passthrough(self, enabled: bool) -> None:
+        await self.db.set_passthrough(self.tg_id, enabled)
+        self._update(passthrough=enabled)
+
+    async def set_schedule(self, enabled: bool) -> None:
+        await self.db.set_schedule(self.tg_id, enabled)
+        self._update(schedule_enabled=enabled)
+
+    async def set_schedule_time(self, time_str: str) -> None:
+        record = await self.get()
+        enabled = record.schedule_enabled if record else False
+        await self.db.set_schedule(self.tg_id, enabled, time_str)
+        self._update(schedule_time=time_str)
+
+    async def clear(self) -> None:
+        await self.db.clear_user(self.tg_id)
+        self._update(
+            session_path=None,
+            passthrough=False,
+            schedule_enabled=False,
+            agent_peer_id=None,
+            agent_access_hash=None,
+        )
+
+
+class ProfileMiddleware(BaseMiddleware):
+    """Кладёт в data["profile"] ленивый профиль автора апдейта."""
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None:
+            data["profile"] = Profile(self.db, user.id)
+        return await handler(event, data)
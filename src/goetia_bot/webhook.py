@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import secrets
+from typing import Any, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Апдейты обрабатываются в фоне, но не больше concurrency одновременно.
+
+    Когда все слоты заняты, ответ Bot API задерживается: Telegram сам придерживает
+    следующие апдейты (не больше max_connections запросов в полёте), и очередь не растёт в памяти.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, concurrency: int = 0, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._limit = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self._limit is None:
+            return await super()._handle_request_background(bot, request)
+        await self._limit.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except BaseException:
+            # фоновая задача не создана (битый JSON, обрыв соединения) — слот возвращаем сразу
+            self._limit.release()
+            raise
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            if self._limit is not None:
+                self._limit.release()
+
+    async def close(self) -> None:
+        # сессию бота закрывает app.run() после очереди доставки
+        await asyncio.gather(*self._background_feed_update_tasks, return_exceptions=True)
+
+
+class WebhookServer:
+    """Приём апдейтов через webhook: локальный aiohttp-сервер, setWebhook при старте и deleteWebhook при остановке."""
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        path: str = "/webhook",
+        url: Optional[str] = None,
+        secret: Optional[str] = None,
+        concurrency: int = 0,
+        max_connections: int = 40,
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.public_url = url
+        # без заданного секрета генерируем свой: чужие POST на webhook получат 401
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.concurrency = concurrency
+        self.max_connections = max_connections
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        base = self.public_url or f"http://{self.host}:{self.port}"
+        return base + self.path
+
+    async def start(self) -> None:
+        app = web.Application()
+        LimitedRequestHandler(self.dp, self.bot, self.secret, self.concurrency).register(app, path=self.path)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+        await self.dp.emit_startup(bot=self.bot, dispatcher=self.dp, bots=[self.bot], **self.dp.workflow_data)
+        await self.bot.set_webhook(
+            self.url,
+            secret_token=self.secret,
+            max_connections=self.max_connections,
+            allowed_updates=self.dp.resolve_used_update_types(),
+        )
+        logger.info("Webhook установлен: %s", self.url)
+
+    async def close(self) -> None:
+        try:
+            await self.bot.delete_webhook()
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Не удалось снять webhook: %s", e)
+        if self._runner is not None:
+            await self._runner.cleanup()
+        await self.dp.emit_shutdown(bot=self.bot, dispatcher=self.dp, bots=[self.bot], **self.dp.workflow_data)
@@ -5,6 +5,27 @@ from pathlib import Path
 import pytest
 
 
+def pytest_addoption(parser):
+    parser.addoption("--bench", action="store_true", help="запускать бенчмарки и soak-тест")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "bench: бенчмарк, по умолчанию не запускается (--bench или -m bench)")
+    config.addinivalue_line("markers", "slow: долгий прогон, по умолчанию не запускается (--bench или -m slow)")
+
+
+def pytest_collection_modifyitems(config, items):
+    # явный -m сам решает, что запускать
+    if config.getoption("--bench") or config.option.markexpr:
+        return
+    kept, skipped = [], []
+    for item in items:
+        (skipped if "bench" in item.keywords or "slow" in item.keywords else kept).append(item)
+    if skipped:
+        config.hook.pytest_deselected(items=skipped)
+        items[:] = kept
+
+
 @pytest.fixture()
 def temp_dirs(tmp_path):
     data = tmp_path / "data"
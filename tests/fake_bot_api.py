@@ -0,0 +1,239 @@
+"""Локальная замена Bot API для soak-тестов и бенчмарков: без сети и без Telegram.
+
+Сервер отдаёт getUpdates из очереди, которую наполняет тест, принимает
+sendMessage/editMessageText/answerCallbackQuery и умеет имитировать задержку
+ответа и 429 Too Many Requests с retry_after. После setWebhook апдейты не копятся
+для getUpdates, а отправляются POST-запросами на webhook, как это делает Telegram.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+TOKEN = "123456:offline-soak-token"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Goetia", "username": "goetia_soak_bot"}
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        throttle_ratio: float = 0.0,
+        retry_after: int = 1,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.throttle_ratio = throttle_ratio
+        self.retry_after = retry_after
+        self.host = host
+        self.port = port
+        self.requests: Counter = Counter()
+        self.throttled = 0
+        self.sent: Dict[int, List[str]] = defaultdict(list)
+        self.updates_fed = 0
+        self.updates_delivered = 0
+        self.fed_at: Dict[int, float] = {}
+        self._updates: List[Dict[str, Any]] = []
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self._webhook: Optional[Dict[str, Any]] = None
+        self._webhook_queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self._webhook_senders: List[asyncio.Task] = []
+        self._http: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+
+    async def close(self) -> None:
+        self._new_updates.set()  # отпускаем висящие long poll getUpdates
+        await self._stop_webhook()
+        await asyncio.sleep(0.05)
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # --- наполнение getUpdates ---
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _message(self, chat_id: int, text: str, from_bot: bool = False) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER if from_bot else self._user(chat_id),
+            "text": text,
+        }
+
+    def push(self, update: Dict[str, Any]) -> None:
+        update["update_id"] = next(self._update_ids)
+        self.fed_at[update["update_id"]] = time.perf_counter()
+        self.updates_fed += 1
+        if self._webhook is not None:
+            self._webhook_queue.put_nowait(update)
+            return
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def push_message(self, user_id: int, text: str) -> None:
+        self.push({"message": self._message(user_id, text)})
+
+    def push_callback(self, user_id: int, data: str) -> None:
+        self.push(
+            {
+                "callback_query": {
+                    "id": str(next(self._update_ids)),
+                    "from": self._user(user_id),
+                    "chat_instance": str(user_id),
+                    "data": data,
+                    "message": self._message(user_id, "menu", from_bot=True),
+                }
+            }
+        )
+
+    @property
+    def backlog(self) -> int:
+        return len(self._updates) + self._webhook_queue.qsize()
+
+    # --- webhook ---
+
+    async def _set_webhook(self, params: Dict[str, Any]) -> None:
+        await self._stop_webhook()
+        self._webhook = {"url": params["url"], "secret": params.get("secret_token") or ""}
+        self._http = aiohttp.ClientSession()
+        connections = int(params.get("max_connections") or 40)
+        self._webhook_senders = [asyncio.create_task(self._webhook_sender()) for _ in range(connections)]
+        # накопленное для getUpdates тоже уходит на webhook
+        for update in self._updates:
+            self._webhook_queue.put_nowait(update)
+        self._updates = []
+
+    async def _stop_webhook(self) -> None:
+        self._webhook = None
+        for task in self._webhook_senders:
+            task.cancel()
+        await asyncio.gather(*self._webhook_senders, return_exceptions=True)
+        self._webhook_senders = []
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        # недоставленное возвращается в getUpdates
+        while not self._webhook_queue.empty():
+            self._updates.append(self._webhook_queue.get_nowait())
+        self._updates.sort(key=lambda u: u["update_id"])
+
+    async def _webhook_sender(self) -> None:
+        """Одно соединение Telegram -> webhook: следующий апдейт только после ответа на предыдущий."""
+        assert self._webhook is not None and self._http is not None
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self._webhook["secret"]}
+        while True:
+            update = await self._webhook_queue.get()
+            try:
+                await self._post_update(update, headers)
+            except asyncio.CancelledError:
+                self._webhook_queue.put_nowait(update)
+                raise
+
+    async def _post_update(self, update: Dict[str, Any], headers: Dict[str, str]) -> None:
+        assert self._webhook is not None and self._http is not None
+        while True:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            try:
+                async with self._http.post(self._webhook["url"], json=update, headers=headers) as resp:
+                    ok = resp.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            if ok:
+                self.updates_delivered += 1
+                return
+            await asyncio.sleep(0.1)
+
+    # --- HTTP ---
+
+    async def _params(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    def _ok(self, result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.requests[method] += 1
+        if method == "getUpdates":
+            if self._webhook is not None:
+                return web.json_response(
+                    {"ok": False, "error_code": 409, "description": "Conflict: can't use getUpdates while webhook is active"},
+                    status=409,
+                )
+            response = await self._get_updates(params)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return response
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "setWebhook":
+            await self._set_webhook(params)
+            return self._ok(True)
+        if method == "deleteWebhook":
+            await self._stop_webhook()
+            return self._ok(True)
+        if method in ("sendMessage", "editMessageText") and random.random() < self.throttle_ratio:
+            self.throttled += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                },
+                status=429,
+            )
+        if method == "getMe":
+            return self._ok(BOT_USER)
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            self.sent[chat_id].append(str(params.get("text", "")))
+            return self._ok(self._message(chat_id, str(params.get("text", "")), from_bot=True))
+        # answerCallbackQuery и прочее
+        return self._ok(True)
+
+    async def _get_updates(self, params: Dict[str, Any]) -> web.Response:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            # как в Bot API: offset подтверждает всё, что было раньше
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = self._updates[:limit]
+        self.updates_delivered += len(batch)
+        return web.Response(text=json.dumps({"ok": True, "result": batch}), content_type="application/json")
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from goetia_bot.app import restore_clients
+from goetia_bot.config import Config
+from goetia_bot.context import AppContext
+from goetia_bot.db import AsyncDatabase, Database
+
+
+class StubClients:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.started = []
+        self.restoring = set()
+        self.hibernated = {}
+
+    async def migrate_session_files(self, users):
+        return 0
+
+    async def has_session(self, tg_id, session_path):
+        # к проверке сессии пользователь уже помечен как восстанавливаемый
+        assert tg_id in self.restoring
+        return session_path.exists()
+
+    def register_hibernated(self, tg_id, session_path):
+        self.hibernated[tg_id] = session_path
+
+    def begin_restore(self, tg_ids):
+        self.restoring.update(tg_ids)
+
+    def end_restore(self, tg_id):
+        self.restoring.discard(tg_id)
+
+    async def start_from_session(self, tg_id, session_path, resolve_peer=True):
+        assert resolve_peer is False
+        assert tg_id in self.restoring
+        self.started.append(tg_id)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if tg_id == 3:
+                await asyncio.sleep(10)
+            await asyncio.sleep(0.01)
+            if tg_id == 2:
+                raise ConnectionError("boom")
+            return None if tg_id == 1 else object()
+        finally:
+            self.active -= 1
+
+
+class StubScheduler:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule_user(self, user):
+        self.scheduled.append(user.tg_id)
+
+
+@pytest.mark.asyncio
+async def test_restore_clients_report(temp_dirs):
+    data_dir, sessions_dir = temp_dirs
+    cfg = Config(
+        bot_token="t",
+        api_id=1,
+        api_hash="h",
+        data_dir=data_dir,
+        sessions_dir=sessions_dir,
+        restore_concurrency=2,
+        restore_timeout=0.2,
+        hibernate_inactive=False,
+    )
+    db = AsyncDatabase(Database(data_dir / "db.sqlite3"))
+    for tg_id in range(1, 7):
+        session = sessions_dir / f"user_{tg_id}.session"
+        session.touch()
+        await db.upsert_user(tg_id)
+        await db.set_session_path(tg_id, str(session))
+    await db.set_schedule(5, True, "09:00")
+    await db.set_passthrough(6, True)
+
+    clients = StubClients()
+    scheduler = StubScheduler()
+    ctx = AppContext(config=cfg, db=db, clients=clients, scheduler=scheduler, bot=None, delivery=None)
+    report = await restore_clients(ctx)
+
+    assert report.total == 6
+    assert report.restored == 3
+    assert report.unauthorized == 1
+    assert report.failed == 1
+    assert report.timed_out == 1
+    # таймаут и ошибка в задержки подключения не попадают
+    assert len(report.latencies) == 4
+    assert max(report.latencies) < cfg.restore_timeout
+    assert clients.max_active == 2
+    # пользователи с passthrough/расписанием поднимаются первыми
+    assert clients.started[:2] == [5, 6]
+    assert clients.restoring == set()
+    assert scheduler.scheduled == [5]
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_restore_clients_hibernates_inactive(temp_dirs):
+    data_dir, sessions_dir = temp_dirs
+    cfg = Config(bot_token="t", api_id=1, api_hash="h", data_dir=data_dir, sessions_dir=sessions_dir)
+    db = AsyncDatabase(Database(data_dir / "db.sqlite3"))
+    for tg_id in (5, 6):
+        session = sessions_dir / f"user_{tg_id}.session"
+        session.touch()
+        await db.upsert_user(tg_id)
+        await db.set_session_path(tg_id, str(session))
+    await db.set_passthrough(6, True)
+
+    clients = StubClients()
+    ctx = AppContext(config=cfg, db=db, clients=clients, scheduler=StubScheduler(), bot=None, delivery=None)
+    report = await restore_clients(ctx)
+
+    assert report.hibernated == 1
+    assert list(clients.hibernated) == [5]
+    assert clients.started == [6]
+    assert clients.restoring == set()
+    db.close()
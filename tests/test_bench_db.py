@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Optional
+
+import pytest
+
+from goetia_bot.db import USER_COLUMNS, Database
+
+# Масштаб микробенчмарка: GOETIA_BENCH_OPS=20000 pytest --bench -s tests/test_bench_db.py
+OPS = int(os.getenv("GOETIA_BENCH_OPS", "300"))
+
+pytestmark = pytest.mark.bench
+
+
+class LegacyDatabase(Database):
+    """Прежнее поведение: новое соединение на каждый запрос, журнал по умолчанию."""
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+def _ops_per_sec(func, ops: int) -> float:
+    started = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    elapsed = time.perf_counter() - started
+    return ops / elapsed if elapsed else float("inf")
+
+
+def _run(db: Database) -> dict:
+    return {
+        "upsert_user": _ops_per_sec(lambda i: db.upsert_user(i), OPS),
+        "get_user": _ops_per_sec(lambda i: db.get_user(i), OPS),
+        "set_passthrough": _ops_per_sec(lambda i: db.set_passthrough(i, bool(i % 2)), OPS),
+    }
+
+
+def test_bench_db_connection_modes(tmp_path):
+    # кэш записей отключён, чтобы мерить именно слой SQLite
+    legacy = _run(LegacyDatabase(tmp_path / "legacy.sqlite3", cache_size=0))
+    db = Database(tmp_path / "wal.sqlite3", cache_size=0)
+    current = _run(db)
+    db.close()
+
+    print(f"\n{'operation':<16}{'before ops/s':>14}{'after ops/s':>14}{'speedup':>10}")
+    for name in current:
+        print(f"{name:<16}{legacy[name]:>14.0f}{current[name]:>14.0f}{current[name] / legacy[name]:>9.1f}x")
+        assert current[name] > 0
+
+
+# Доля активных пользователей среди всех строк: GOETIA_BENCH_USERS=500000 pytest --bench -s tests/test_bench_db.py
+USERS = int(os.getenv("GOETIA_BENCH_USERS", "20000"))
+ACTIVE_EVERY = 100
+
+
+def test_bench_db_startup_queries(tmp_path):
+    db = Database(tmp_path / "startup.sqlite3", cache_size=0)
+    with db._connect() as conn:
+        conn.executemany(
+            "INSERT INTO users (tg_id, session_path, schedule_enabled) VALUES (?, ?, ?)",
+            (
+                (i, f"s{i}" if i % ACTIVE_EVERY == 0 else None, int(i % (ACTIVE_EVERY * 2) == 0))
+                for i in range(USERS)
+            ),
+        )
+        conn.commit()
+
+    started = time.perf_counter()
+    # прежний путь restore_clients: вся таблица, фильтр в Python
+    users = db.list_users().values()
+    legacy = ([u for u in users if u.session_path], [u for u in users if u.schedule_enabled])
+    legacy_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    current = (db.session_users_page(limit=USERS), db.scheduled_users())
+    current_time = time.perf_counter() - started
+    db.close()
+
+    assert [len(part) for part in current] == [len(part) for part in legacy]
+    print(
+        f"\nstartup queries for {USERS} users ({len(current[0])} with sessions): "
+        f"before {legacy_time * 1000:.1f} ms, after {current_time * 1000:.1f} ms, "
+        f"{legacy_time / current_time:.1f}x"
+    )
+
+
+# Пиковая память обхода таблицы: GOETIA_BENCH_MEMORY_ROWS=100000,1000000 pytest --bench -s tests/test_bench_db.py
+MEMORY_ROWS = [int(n) for n in os.getenv("GOETIA_BENCH_MEMORY_ROWS", "20000").split(",")]
+
+
+@dataclass
+class LegacyUserRecord:
+    tg_id: int
+    passthrough: bool = False
+    schedule_enabled: bool = False
+    schedule_time: str = "10:00"
+    session_path: Optional[str] = None
+    agent_peer_id: Optional[int] = None
+    agent_access_hash: Optional[int] = None
+
+
+def _legacy_list_users(db: Database) -> dict:
+    """Прежний list_users: fetchall всей таблицы в словарь обычных dataclass."""
+    result = {}
+    with db._connect() as conn:
+        for row in conn.execute(f"SELECT {USER_COLUMNS} FROM users").fetchall():
+            result[row["tg_id"]] = LegacyUserRecord(
+                tg_id=row["tg_id"],
+                passthrough=bool(row["passthrough"]),
+                schedule_enabled=bool(row["schedule_enabled"]),
+                schedule_time=row["schedule_time"],
+                session_path=row["session_path"],
+                agent_peer_id=row["agent_peer_id"],
+                agent_access_hash=row["agent_access_hash"],
+            )
+    return result
+
+
+def _peak_kib(func) -> float:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def test_bench_db_user_iteration_memory(tmp_path):
+    print(f"\n{'rows':>10}{'legacy dict KiB':>18}{'list_users KiB':>16}{'iter_users KiB':>16}")
+    for rows in MEMORY_ROWS:
+        db = Database(tmp_path / f"memory_{rows}.sqlite3", cache_size=0)
+        with db._connect() as conn:
+            conn.executemany(
+                "INSERT INTO users (tg_id, session_path) VALUES (?, ?)",
+                ((i, f"sessions/user_{i}.session") for i in range(rows)),
+            )
+            conn.commit()
+
+        legacy = _peak_kib(lambda: _legacy_list_users(db))
+        slotted = _peak_kib(db.list_users)
+        streamed = _peak_kib(lambda: sum(1 for user in db.iter_users() if user.session_path))
+        db.close()
+
+        print(f"{rows:>10}{legacy:>18.0f}{slotted:>16.0f}{streamed:>16.0f}")
+        assert slotted < legacy
+        assert streamed < slotted
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import os
+import resource
+import time
+from pathlib import Path
+
+import pytest
+
+from goetia_bot.client_manager import ClientManager
+from goetia_bot.config import Config
+from goetia_bot.context import AppContext
+from goetia_bot.db import AsyncDatabase, Database
+from goetia_bot.delivery import DeliveryQueue
+from goetia_bot.handlers import setup_router
+from goetia_bot.stats import percentile
+from test_client_manager import AGENT_PEER, FakeClient, FakeEvent
+
+# Масштаб: GOETIA_BENCH_ACCOUNTS=100,1000,10000 GOETIA_BENCH_MSG_RATE=2 GOETIA_BENCH_SECONDS=10 \
+#   GOETIA_BENCH_OUT=bench_relay.json pytest --bench -s tests/test_bench_relay.py
+ACCOUNTS = [int(n) for n in os.getenv("GOETIA_BENCH_ACCOUNTS", "100").split(",")]
+MSG_RATE = float(os.getenv("GOETIA_BENCH_MSG_RATE", "1"))  # сообщений агента в секунду на аккаунт
+SECONDS = float(os.getenv("GOETIA_BENCH_SECONDS", "2"))
+OUT = os.getenv("GOETIA_BENCH_OUT", "")
+# сравнение с прошлым прогоном: GOETIA_BENCH_BASELINE=bench_relay.json, допуск по p99 и пропускной способности
+BASELINE = os.getenv("GOETIA_BENCH_BASELINE", "")
+TOLERANCE = float(os.getenv("GOETIA_BENCH_TOLERANCE", "1.5"))
+SLACK_MS = float(os.getenv("GOETIA_BENCH_SLACK_MS", "5"))  # субмиллисекундный шум на малых прогонах
+TICK = 0.01
+
+pytestmark = pytest.mark.bench
+
+
+class TimedBot:
+    """Bot API без сети: запоминает момент доставки каждого сообщения."""
+
+    def __init__(self):
+        self.delivered = {}
+
+    async def send_message(self, chat_id, text):
+        self.delivered[text.rsplit(" ", 1)[-1]] = time.perf_counter()
+
+
+class LoopLag:
+    def __init__(self):
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(TICK)
+            self.samples.append(max(0.0, loop.time() - started - TICK))
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+
+def _latency_ms(latencies):
+    return {q: round(percentile(latencies, p) * 1000, 3) for q, p in (("p50", 50), ("p95", 95), ("p99", 99))}
+
+
+async def _setup(tmp_path: Path, accounts: int):
+    data = tmp_path / f"accounts{accounts}"
+    data.mkdir()
+    cfg = Config(bot_token="t", api_id=1, api_hash="h", data_dir=data, sessions_dir=data, session_store=False)
+    database = Database(data / "goetia.db")
+    for tg_id in range(accounts):
+        database.upsert_user(tg_id)
+        database.set_passthrough(tg_id, True)
+        # агент уже резолвлен: без ResolveUsername с лимитом частоты
+        database.set_agent_peer(tg_id, AGENT_PEER.user_id, AGENT_PEER.access_hash)
+    db = AsyncDatabase(database)
+    clients = ClientManager(cfg, db)
+    bot = TimedBot()
+    delivery = DeliveryQueue(bot, global_rate=0, chat_rate=0, max_queue=10**7, workers=32)
+    ctx = AppContext(config=cfg, db=db, clients=clients, scheduler=None, bot=bot, delivery=delivery)
+    setup_router(ctx)
+    for tg_id in range(accounts):
+        session = data / f"user_{tg_id}.session"
+        FakeClient.authorized_sessions.add(str(session))
+        await clients.start_from_session(tg_id, session)
+    return ctx, bot
+
+
+async def _relay(ctx: AppContext, bot: TimedBot, accounts: int) -> dict:
+    clients = [ctx.clients.clients[tg_id] for tg_id in range(accounts)]
+    total = int(accounts * MSG_RATE * SECONDS)
+    per_tick = max(1, int(accounts * MSG_RATE * TICK))
+    started_at = {}
+    tasks = []
+    began = time.perf_counter()
+    for i in range(total):
+        key = f"m{i}"
+        started_at[key] = time.perf_counter()
+        tasks.append(asyncio.create_task(clients[i % accounts].dispatch(FakeEvent(f"reply {key}"))))
+        if (i + 1) % per_tick == 0:
+            await asyncio.sleep(TICK)
+    await asyncio.gather(*tasks)
+    deadline = time.perf_counter() + 30
+    while ctx.delivery.depth and time.perf_counter() < deadline:
+        await asyncio.sleep(TICK)
+    elapsed = time.perf_counter() - began
+    latencies = [bot.delivered[key] - started for key, started in started_at.items() if key in bot.delivered]
+    return {
+        "messages": total,
+        "delivered": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "latency_ms": _latency_ms(latencies),
+    }
+
+
+async def _forward(ctx: AppContext, accounts: int) -> dict:
+    latencies = []
+
+    async def send(tg_id: int) -> bool:
+        started = time.perf_counter()
+        ok = await ctx.clients.send_to_agent(tg_id, "hello")
+        latencies.append(time.perf_counter() - started)
+        return ok
+
+    began = time.perf_counter()
+    results = await asyncio.gather(*(send(tg_id) for tg_id in range(accounts)))
+    elapsed = time.perf_counter() - began
+    return {
+        "messages": accounts,
+        "sent": sum(1 for result in results if result),
+        "throughput": round(accounts / elapsed, 1),
+        "latency_ms": _latency_ms(latencies),
+    }
+
+
+@pytest.mark.asyncio
+async def test_bench_relay_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setattr("goetia_bot.client_manager.TelegramClient", FakeClient)
+    results = []
+    for accounts in ACCOUNTS:
+        ctx, bot = await _setup(tmp_path, accounts)
+        with LoopLag() as lag:
+            relay = await _relay(ctx, bot, accounts)
+            forward = await _forward(ctx, accounts)
+        await ctx.delivery.close()
+        await ctx.clients.close()
+        ctx.db.close()
+        results.append(
+            {
+                "accounts": accounts,
+                "msg_rate": MSG_RATE,
+                "seconds": SECONDS,
+                "relay": relay,
+                "forward": forward,
+                "loop_lag_ms": {**_latency_ms(lag.samples), "max": round(max(lag.samples, default=0) * 1000, 3)},
+                # ru_maxrss — пик процесса целиком, на Linux в КиБ
+                "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            }
+        )
+        assert relay["delivered"] == relay["messages"]
+        assert forward["sent"] == accounts
+
+    out = Path(OUT) if OUT else tmp_path / "bench_relay.json"
+    out.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"\n{'accounts':>9}{'relay/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'fwd/s':>10}{'lag p99':>9}{'rss MiB':>9}")
+    for r in results:
+        print(
+            f"{r['accounts']:>9}{r['relay']['throughput']:>10.0f}{r['relay']['latency_ms']['p50']:>9.2f}"
+            f"{r['relay']['latency_ms']['p99']:>9.2f}{r['forward']['throughput']:>10.0f}"
+            f"{r['loop_lag_ms']['p99']:>9.2f}{r['peak_rss_mib']:>9.1f}"
+        )
+    print(f"results: {out}")
+
+    if BASELINE:
+        baseline = {r["accounts"]: r for r in json.loads(Path(BASELINE).read_text(encoding="utf-8"))}
+        for r in results:
+            before = baseline.get(r["accounts"])
+            if before is None:
+                continue
+            for path in ("relay", "forward"):
+                allowed = max(before[path]["latency_ms"]["p99"] * TOLERANCE, before[path]["latency_ms"]["p99"] + SLACK_MS)
+                assert r[path]["latency_ms"]["p99"] <= allowed, (r["accounts"], path)
+                assert r[path]["throughput"] * TOLERANCE >= before[path]["throughput"], (r["accounts"], path)
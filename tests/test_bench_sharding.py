@@ -0,0 +1,65 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from goetia_bot.client_manager import ClientManager
+from goetia_bot.config import Config
+from goetia_bot.db import AsyncDatabase, Database
+from goetia_bot.outbox import SendResult
+from goetia_bot.sharding import ShardedClientManager
+
+# Масштаб бенчмарка: GOETIA_BENCH_SENDS=5000 GOETIA_BENCH_BURN=200000 pytest --bench -s tests/test_bench_sharding.py
+SENDS = int(os.getenv("GOETIA_BENCH_SENDS", "200"))
+BURN = int(os.getenv("GOETIA_BENCH_BURN", "20000"))
+# Доля линейного ускорения, которую должен дать каждый шард на свободном ядре
+EFFICIENCY = float(os.getenv("GOETIA_BENCH_SHARD_EFFICIENCY", "0.5"))
+
+pytestmark = pytest.mark.bench
+
+
+class BurnManager(ClientManager):
+    """Имитирует CPU-работу на отправку: разбор апдейтов, шифрование MTProto."""
+
+    async def send_to_agent(self, tg_id, text):
+        acc = 0
+        for i in range(BURN):
+            acc ^= i * i
+        return SendResult.QUEUED
+
+    async def prewarm_agent_peers(self):
+        return 0
+
+
+async def _throughput(tmp_path, shards: int) -> float:
+    data = tmp_path / f"shards{shards}"
+    data.mkdir()
+    cfg = Config(bot_token="x", api_id=1, api_hash="h", data_dir=data, sessions_dir=data, logs_dir=data, shards=shards)
+    db = AsyncDatabase(Database(data / "goetia.db"))
+    manager = ShardedClientManager(cfg, db, manager_factory="test_bench_sharding:BurnManager")
+    await manager.start()
+    try:
+        # прогрев: дожидаемся подключения всех шардов
+        await asyncio.gather(*(manager.send_to_agent(tg_id, "warm") for tg_id in range(shards)))
+        started = time.perf_counter()
+        results = await asyncio.gather(*(manager.send_to_agent(tg_id, "/buff") for tg_id in range(SENDS)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await manager.close()
+        db.close()
+    assert results == [SendResult.QUEUED] * SENDS
+    return SENDS / elapsed if elapsed else float("inf")
+
+
+@pytest.mark.asyncio
+async def test_bench_sharding_throughput(tmp_path):
+    print(f"\n{'shards':<8}{'sends/s':>10}{'speedup':>10}  (cpu={os.cpu_count()})")
+    baseline = None
+    for shards in (1, 2, 4):
+        rate = await _throughput(tmp_path, shards)
+        baseline = baseline or rate
+        print(f"{shards:<8}{rate:>10.0f}{rate / baseline:>9.1f}x")
+        # шарды сверх числа ядер не ускоряют, но и IPC не должен съедать больше половины
+        expected = min(shards, os.cpu_count() or 1) * EFFICIENCY
+        assert rate / baseline >= expected, (shards, rate, baseline)
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from fake_bot_api import TOKEN, FakeBotAPI
+from goetia_bot.stats import percentile
+from goetia_bot.webhook import WebhookServer
+
+# Масштаб: GOETIA_BENCH_UPDATES=20000 GOETIA_BENCH_UPDATE_RATE=2000 GOETIA_BENCH_LATENCY_MS=30 \
+#   GOETIA_BENCH_OUT=bench_webhook.json pytest --bench -s tests/test_bench_webhook.py
+UPDATES = int(os.getenv("GOETIA_BENCH_UPDATES", "600"))
+UPDATE_RATE = float(os.getenv("GOETIA_BENCH_UPDATE_RATE", "600"))  # апдейтов в секунду
+LATENCY = float(os.getenv("GOETIA_BENCH_LATENCY_MS", "20")) / 1000  # задержка сети до Bot API
+HANDLER_MS = float(os.getenv("GOETIA_BENCH_HANDLER_MS", "5")) / 1000
+CONCURRENCY = int(os.getenv("GOETIA_BENCH_CONCURRENCY", "100"))
+MAX_CONNECTIONS = int(os.getenv("GOETIA_BENCH_MAX_CONNECTIONS", "40"))
+OUT = os.getenv("GOETIA_BENCH_OUT", "")
+TICK = 0.01
+
+pytestmark = pytest.mark.bench
+
+
+def _dispatcher(api: FakeBotAPI, done: dict) -> Dispatcher:
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message):
+        await asyncio.sleep(HANDLER_MS)
+
+    @dp.update.outer_middleware()
+    async def mark_done(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            done[event.update_id] = time.perf_counter() - api.fed_at[event.update_id]
+
+    return dp
+
+
+async def _feed(api: FakeBotAPI, done: dict) -> float:
+    per_tick = max(1, int(UPDATE_RATE * TICK))
+    began = time.perf_counter()
+    for i in range(UPDATES):
+        api.push_message(i % 1000, f"m{i}")
+        if (i + 1) % per_tick == 0:
+            await asyncio.sleep(TICK)
+    deadline = time.perf_counter() + 60
+    while len(done) < UPDATES and time.perf_counter() < deadline:
+        await asyncio.sleep(TICK)
+    return time.perf_counter() - began
+
+
+async def _run(mode: str) -> dict:
+    api = FakeBotAPI(latency=LATENCY)
+    await api.start()
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.url)))
+    done: dict = {}
+    dp = _dispatcher(api, done)
+    server = None
+    polling = None
+    try:
+        if mode == "webhook":
+            server = WebhookServer(dp, bot, port=0, concurrency=CONCURRENCY, max_connections=MAX_CONNECTIONS)
+            await server.start()
+        else:
+            polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+        elapsed = await _feed(api, done)
+    finally:
+        if server is not None:
+            await server.close()
+        if polling is not None:
+            await dp.stop_polling()
+            await asyncio.gather(polling, return_exceptions=True)
+        await bot.session.close()
+        await api.close()
+    latencies = list(done.values())
+    return {
+        "mode": mode,
+        "updates": UPDATES,
+        "handled": len(done),
+        "throughput": round(len(done) / elapsed, 1),
+        "latency_ms": {q: round(percentile(latencies, p) * 1000, 3) for q, p in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "bot_api_requests": dict(api.requests),
+    }
+
+
+@pytest.mark.asyncio
+async def test_bench_webhook_vs_polling(tmp_path):
+    results = [await _run("polling"), await _run("webhook")]
+    out = Path(OUT) if OUT else tmp_path / "bench_webhook.json"
+    out.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"\n{'mode':>9}{'upd/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for r in results:
+        print(
+            f"{r['mode']:>9}{r['throughput']:>10.0f}{r['latency_ms']['p50']:>9.2f}"
+            f"{r['latency_ms']['p95']:>9.2f}{r['latency_ms']['p99']:>9.2f}"
+        )
+    print(f"results: {out}")
+
+    for r in results:
+        assert r["handled"] == r["updates"], r["mode"]
@@ -1,27 +1,41 @@
 import asyncio
-from pathlib import Path
 
 import pytest
 
-from goetia_bot.client_manager import ClientManager
+from goetia_bot.client_manager import ClientManager, ClientState
 from goetia_bot.config import Config
-from goetia_bot.db import Database
-from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError
+from goetia_bot.db import AsyncDatabase, Database
+from goetia_bot.outbox import SendResult
+from telethon.errors import AuthKeyUnregisteredError, SessionPasswordNeededError, PhoneCodeInvalidError
+from telethon.tl.types import InputPeerUser
+
+
+AGENT_PEER_ID = 777
+AGENT_PEER = InputPeerUser(AGENT_PEER_ID, 42)
 
 
 class FakeEvent:
-    def __init__(self, text, out=False, username="agent"):
+    def __init__(self, text, out=False, chat_id=AGENT_PEER_ID):
         self.out = out
-        self.message = type("msg", (), {"message": text})
-        self._username = username
+        self.chat_id = chat_id
+        self.message = type("msg", (), {"message": text, "out": out})
+
 
-    async def get_sender(self):
-        return type("sender", (), {"username": self._username})
+class FakeSession:
+    def __init__(self, name):
+        self.name = name
+
+    def get_input_entity(self, key):
+        raise ValueError("not cached")
 
 
 class FakeClient:
-    def __init__(self, *args, **kwargs):
-        self._authorized = False
+    authorized_sessions = set()
+
+    def __init__(self, session=None, *args, **kwargs):
+        self.session = FakeSession(session)
+        self._authorized = session in self.authorized_sessions
+        self.resolve_calls = 0
         self.sent_messages = []
         self.handlers = []
         self.require_password = False
@@ -51,17 +65,31 @@ class FakeClient:
             self._authorized = True
         else:
             self._authorized = True
+        self.authorized_sessions.add(self.session.name)
 
     async def send_message(self, user, text):
+        if not self._authorized:
+            raise AuthKeyUnregisteredError(request=None)
         self.sent_messages.append((user, text))
 
-    def on(self, *args, **kwargs):
+    async def get_input_entity(self, peer):
+        self.resolve_calls += 1
+        return AGENT_PEER
+
+    def on(self, builder):
         def decorator(func):
-            self.handlers.append(func)
+            self.handlers.append((builder, func))
             return func
 
         return decorator
 
+    async def dispatch(self, event):
+        # повторяем логику Telethon: resolve -> filter -> handler
+        for builder, func in self.handlers:
+            await builder.resolve(self)
+            if builder.filter(event):
+                await func(event)
+
     async def disconnect(self):
         self.connected = False
 
@@ -69,10 +97,13 @@ class FakeClient:
 @pytest.fixture()
 def manager(tmp_path, monkeypatch, temp_dirs):
     data_dir, sessions_dir = temp_dirs
-    cfg = Config(bot_token="t", api_id=1, api_hash="h", data_dir=data_dir, sessions_dir=sessions_dir)
-    db = Database(data_dir / "db.sqlite3")
+    cfg = Config(
+        bot_token="t", api_id=1, api_hash="h", data_dir=data_dir, sessions_dir=sessions_dir, session_store=False
+    )
+    db = AsyncDatabase(Database(data_dir / "db.sqlite3"))
     monkeypatch.setattr("goetia_bot.client_manager.TelegramClient", FakeClient)
-    return ClientManager(cfg, db)
+    yield ClientManager(cfg, db)
+    db.close()
 
 
 @pytest.mark.asyncio
@@ -89,7 +120,7 @@ async def test_finish_sign_in(manager: ClientManager):
 
 @pytest.mark.asyncio
 async def test_finish_sign_in_with_password(manager: ClientManager):
-    manager.db.upsert_user(11)
+    await manager.db.upsert_user(11)
     client, phone_code_hash = await manager.start_with_code(tg_id=11, phone="+7000")
     client.require_password = True
     ok, password_needed = await manager.finish_sign_in(
@@ -108,8 +139,9 @@ async def test_send_to_agent(manager: ClientManager):
         tg_id=12, client=client, phone="+7000", code="123456", phone_code_hash=phone_code_hash
     )
     sent = await manager.send_to_agent(12, "ping")
-    assert sent is True
-    assert ("Agent_essence_bot", "ping") in client.sent_messages
+    assert sent is SendResult.QUEUED
+    await manager._outboxes[12].join()
+    assert (AGENT_PEER, "ping") in client.sent_messages
 
 
 @pytest.mark.asyncio
@@ -120,15 +152,15 @@ async def test_handler_passthrough(manager: ClientManager):
         received.append((tg_id, sender, text))
 
     manager.set_message_callback(cb)
-    manager.db.upsert_user(13)
+    await manager.db.upsert_user(13)
     client, phone_code_hash = await manager.start_with_code(tg_id=13, phone="+7000")
     await manager.finish_sign_in(
         tg_id=13, client=client, phone="+7000", code="123456", phone_code_hash=phone_code_hash
     )
-    manager.db.set_passthrough(13, True)
-    handler = client.handlers[0]
-    await handler(FakeEvent("hello", username="Agent_essence_bot"))
+    await manager.db.set_passthrough(13, True)
+    await client.dispatch(FakeEvent("hello"))
     assert received == [(13, "agent_essence_bot", "hello")]
+    assert manager.relay_stats.handled == 1
 
 
 @pytest.mark.asyncio
@@ -139,12 +171,137 @@ async def test_non_agent_ignored(manager: ClientManager):
         received.append((tg_id, sender, text))
 
     manager.set_message_callback(cb)
-    manager.db.upsert_user(14)
-    manager.db.set_passthrough(14, True)
+    await manager.db.upsert_user(14)
+    await manager.db.set_passthrough(14, True)
     client, phone_code_hash = await manager.start_with_code(tg_id=14, phone="+7000")
     await manager.finish_sign_in(
         tg_id=14, client=client, phone="+7000", code="123456", phone_code_hash=phone_code_hash
     )
-    handler = client.handlers[0]
-    await handler(FakeEvent("hello", username="someone_else"))
+    await client.dispatch(FakeEvent("hello", chat_id=555))
+    await client.dispatch(FakeEvent("echo", out=True))
     assert received == []
+    assert manager.relay_stats.dropped == 2
+    assert manager.relay_stats.handled == 0
+
+
+@pytest.mark.asyncio
+async def test_hibernate_and_wake(manager: ClientManager):
+    await manager.db.upsert_user(15)
+    client, phone_code_hash = await manager.start_with_code(tg_id=15, phone="+7000")
+    await manager.finish_sign_in(
+        tg_id=15, client=client, phone="+7000", code="123456", phone_code_hash=phone_code_hash
+    )
+    # ни passthrough, ни расписания — клиент усыпляется
+    assert await manager.hibernate_idle() == 1
+    assert client.connected is False
+    assert manager.client_state(15) is ClientState.HIBERNATED
+    assert manager.has_client(15)
+
+    assert await manager.send_to_agent(15, "/buff") is SendResult.QUEUED
+    assert manager.client_state(15) is ClientState.CONNECTED
+    woken = manager.clients[15]
+    await manager._outboxes[15].join()
+    assert woken is not client
+    assert (AGENT_PEER, "/buff") in woken.sent_messages
+    # peer агента взят из goetia.db, повторного ResolveUsername нет
+    assert woken.resolve_calls == 0
+
+    await manager.stop(15)
+    assert manager.client_state(15) is ClientState.ABSENT
+
+
+@pytest.mark.asyncio
+async def test_agent_peer_prewarm(manager: ClientManager, temp_dirs):
+    await manager.db.upsert_user(16)
+    _, sessions_dir = temp_dirs
+    session_path = sessions_dir / "user_16.session"
+    FakeClient.authorized_sessions.add(str(session_path))
+    client = await manager.start_from_session(16, session_path, resolve_peer=False)
+    assert client.resolve_calls == 0
+    # до резолва фильтр ничего не пропускает
+    await client.dispatch(FakeEvent("early"))
+    assert manager.relay_stats.dropped == 1
+
+    assert await manager.prewarm_agent_peers() == 1
+    user = await manager.db.get_user(16)
+    assert (user.agent_peer_id, user.agent_access_hash) == (AGENT_PEER_ID, 42)
+    assert await manager.send_to_agent(16, "hi") is SendResult.QUEUED
+    await manager._outboxes[16].join()
+    assert client.sent_messages == [(AGENT_PEER, "hi")]
+    assert client.resolve_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_revoked_session_stops_client(manager: ClientManager):
+    await manager.db.upsert_user(17)
+    client, phone_code_hash = await manager.start_with_code(tg_id=17, phone="+7000")
+    await manager.finish_sign_in(
+        tg_id=17, client=client, phone="+7000", code="123456", phone_code_hash=phone_code_hash
+    )
+    session_path = manager._session_path_for(17)
+    session_path.touch()
+    # сессию отозвали с другого устройства
+    client._authorized = False
+    outbox = manager._outboxes[17]
+    assert await manager.send_to_agent(17, "hi") is SendResult.QUEUED
+    await outbox.join()
+
+    assert manager.client_state(17) is ClientState.ABSENT
+    assert client.connected is False
+    assert (await manager.db.get_user(17)).session_path is None
+    assert not session_path.exists()
+    assert await manager.send_to_agent(17, "again") is SendResult.FAILED
+
+
+@pytest.mark.asyncio
+async def test_failed_wake_reports_send_failure(manager: ClientManager, monkeypatch):
+    manager.register_hibernated(18, manager._session_path_for(18))
+
+    async def unreachable(*args, **kwargs):
+        raise ConnectionError("DC недоступен")
+
+    monkeypatch.setattr(manager, "start_from_session", unreachable)
+    assert await manager.wake(18) is None
+    assert await manager.send_to_agent(18, "hi") is SendResult.FAILED
+    assert manager.client_state(18) is ClientState.HIBERNATED
+    assert manager._wake_locks == {}
+
+
+@pytest.mark.asyncio
+async def test_failed_code_request_disconnects_client(manager: ClientManager, monkeypatch):
+    created = []
+
+    class FailingClient(FakeClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self)
+
+        async def send_code_request(self, phone, force_sms=False):
+            raise ValueError("PHONE_NUMBER_INVALID")
+
+    monkeypatch.setattr("goetia_bot.client_manager.TelegramClient", FailingClient)
+    with pytest.raises(ValueError):
+        await manager.start_with_code(tg_id=19, phone="+7000")
+    assert created and created[0].connected is False
+
+
+@pytest.mark.asyncio
+async def test_restore_timeout_during_activate_disconnects_client(manager: ClientManager, monkeypatch, temp_dirs):
+    _, sessions_dir = temp_dirs
+    session_path = sessions_dir / "user_20.session"
+    FakeClient.authorized_sessions.add(str(session_path))
+    created = []
+
+    class SlowResolveClient(FakeClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self)
+
+        async def get_input_entity(self, peer):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr("goetia_bot.client_manager.TelegramClient", SlowResolveClient)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(manager.start_from_session(20, session_path), timeout=0.05)
+    assert created and created[0].connected is False
+    assert not manager.has_client(20)
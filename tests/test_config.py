@@ -29,3 +29,19 @@ def test_load_config_missing_api(tmp_path):
     env_path.write_text("BOT_TOKEN=test\n", encoding="utf-8")
     with pytest.raises(RuntimeError):
         load_config(str(env_path))
+
+
+def test_load_config_bot_mode(tmp_path, monkeypatch):
+    env_path = tmp_path / ".env"
+    env_path.write_text("BOT_TOKEN=t\nAPI_ID=1\nAPI_HASH=h\n", encoding="utf-8")
+    monkeypatch.setenv("BOT_MODE", "webhook")
+    monkeypatch.setenv("WEBHOOK_PATH", "hook")
+    monkeypatch.setenv("WEBHOOK_MAX_CONNECTIONS", "500")
+    cfg = load_config(str(env_path))
+    assert cfg.bot_mode == "webhook"
+    assert cfg.webhook_path == "/hook"
+    assert cfg.webhook_max_connections == 100
+
+    monkeypatch.setenv("BOT_MODE", "push")
+    with pytest.raises(RuntimeError):
+        load_config(str(env_path))
@@ -1,4 +1,15 @@
-from goetia_bot.db import Database
+import sqlite3
+
+import pytest
+
+from goetia_bot.db import (
+    MIGRATIONS,
+    MIN_TG_ID,
+    SELECT_SCHEDULED_USERS,
+    SELECT_SESSION_USERS_PAGE,
+    AsyncDatabase,
+    Database,
+)
 
 
 def test_db_crud(tmp_path):
@@ -23,3 +34,114 @@ def test_db_crud(tmp_path):
     assert user3.passthrough is False
     assert user3.schedule_enabled is False
     assert user3.session_path is None
+
+
+def test_db_user_cache(tmp_path):
+    db = Database(tmp_path / "db.sqlite3", cache_size=2)
+    db.upsert_user(1)
+    db.get_user(1)
+    assert db.cache_stats.hits >= 1
+
+    db.set_passthrough(1, True)
+    db.set_schedule(1, True, "07:45")
+    cached = db.get_user(1)
+    assert cached.passthrough is True
+    assert cached.schedule_time == "07:45"
+
+    db.clear_user(1)
+    assert db.get_user(1).passthrough is False
+
+    db.upsert_user(2)
+    db.upsert_user(3)
+    assert db.cache_stats.evictions == 1
+    # после вытеснения запись читается из БД заново
+    misses = db.cache_stats.misses
+    assert db.get_user(1).session_path is None
+    assert db.cache_stats.misses == misses + 1
+
+
+@pytest.mark.asyncio
+async def test_async_db(tmp_path):
+    db = AsyncDatabase(Database(tmp_path / "db.sqlite3"))
+    user = await db.upsert_user(200)
+    assert user.tg_id == 200
+    await db.set_passthrough(200, True)
+    await db.set_schedule_time(200, "11:15")
+    user = await db.get_user(200)
+    assert user.passthrough is True
+    assert user.schedule_time == "11:15"
+    assert list((await db.list_users()).keys()) == [200]
+    assert await db.get_user(201) is None
+    db.close()
+
+
+def test_db_migrates_legacy_schema(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    # схема до версионирования: без agent_peer_* и user_version = 0
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id INTEGER UNIQUE NOT NULL, "
+        "passthrough INTEGER DEFAULT 0, schedule_enabled INTEGER DEFAULT 0, schedule_time TEXT DEFAULT '10:00', "
+        "session_path TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP, updated_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+    )
+    conn.execute("INSERT INTO users (tg_id, session_path) VALUES (7, 'sessions/user_7.session')")
+    conn.commit()
+    conn.close()
+
+    db = Database(path)
+    assert db.schema_version == len(MIGRATIONS)
+    db.set_agent_peer(7, 1, 2)
+    assert db.get_user(7).agent_access_hash == 2
+    db.close()
+    # повторное открытие ничего не применяет заново
+    db = Database(path)
+    assert db.schema_version == len(MIGRATIONS)
+    assert db.get_user(7).session_path == "sessions/user_7.session"
+    db.close()
+
+
+def test_db_targeted_queries_use_indexes(tmp_path):
+    db = Database(tmp_path / "db.sqlite3")
+    for tg_id in range(1, 7):
+        db.upsert_user(tg_id)
+    db.set_session_path(2, "s2")
+    db.set_session_path(3, "s3")
+    db.set_schedule(4, True, "09:30")
+    db.set_schedule(5, True, "10:00")
+    db.set_schedule(6, False, "09:30")
+
+    assert [u.tg_id for u in db.session_users_page()] == [2, 3]
+    assert [u.tg_id for u in db.session_users_page(shards=2, shard=1)] == [3]
+    assert sorted(u.tg_id for u in db.scheduled_users()) == [4, 5]
+
+    conn = db._connect()
+    for query, args, index in (
+        (SELECT_SESSION_USERS_PAGE, (MIN_TG_ID, 1, 0, 100), "idx_users_session"),
+        (SELECT_SCHEDULED_USERS, (), "idx_users_schedule"),
+    ):
+        plan = " ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", args))
+        assert index in plan, plan
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_iter_users_pages_through_table(tmp_path):
+    db = Database(tmp_path / "db.sqlite3")
+    for tg_id in (5, 1, 9, 3, 7):
+        db.upsert_user(tg_id)
+    assert [u.tg_id for u in db.iter_users(page_size=2)] == [1, 3, 5, 7, 9]
+    assert list(db.list_users()) == [1, 3, 5, 7, 9]
+    assert not hasattr(db.get_user(1), "__dict__")
+
+    for tg_id in (3, 5, 9):
+        db.set_session_path(tg_id, f"s{tg_id}")
+    adb = AsyncDatabase(db)
+    pages = []
+    async for page in adb.iter_user_pages(page_size=2, with_session=True):
+        # запись посреди обхода не ломает пагинацию
+        for user in page:
+            await adb.set_passthrough(user.tg_id, True)
+        pages.append([u.tg_id for u in page])
+    assert pages == [[3, 5], [9]]
+    assert [u.tg_id for u in db.iter_users() if u.passthrough] == [3, 5, 9]
+    adb.close()
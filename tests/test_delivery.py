@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from goetia_bot.delivery import DeliveryQueue, pack_messages
+
+
+class FakeBot:
+    def __init__(self, fail_first=None):
+        self.sent = []
+        self.fail_first = fail_first
+
+    async def send_message(self, chat_id, text):
+        if self.fail_first is not None:
+            exc, self.fail_first = self.fail_first, None
+            raise exc
+        self.sent.append((chat_id, text))
+
+
+async def wait_drained(queue: DeliveryQueue, timeout: float = 2.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while queue.depth and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_delivery_keeps_per_chat_order():
+    bot = FakeBot()
+    queue = DeliveryQueue(bot, global_rate=0, chat_rate=100)
+    for i in range(5):
+        queue.enqueue(1, f"a{i}")
+        queue.enqueue(2, f"b{i}")
+    await wait_drained(queue)
+    assert [t for c, t in bot.sent if c == 1] == [f"a{i}" for i in range(5)]
+    assert [t for c, t in bot.sent if c == 2] == [f"b{i}" for i in range(5)]
+    assert queue.stats.sent == 10
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_delivery_honors_retry_after():
+    method = SendMessage(chat_id=1, text="x")
+    bot = FakeBot(fail_first=TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=0))
+    queue = DeliveryQueue(bot, global_rate=0, chat_rate=0)
+    queue.enqueue(1, "hello")
+    await wait_drained(queue)
+    assert bot.sent == [(1, "hello")]
+    assert queue.stats.retry_after == 1
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_delivery_drops_on_overflow():
+    queue = DeliveryQueue(FakeBot(), global_rate=0, chat_rate=0, max_queue=2)
+    assert queue.enqueue(1, "a") is True
+    assert queue.enqueue(1, "b") is True
+    assert queue.enqueue(1, "c") is False
+    assert queue.stats.dropped == 1
+    await wait_drained(queue)
+    await queue.close()
+
+
+def test_pack_messages_splits_on_limit():
+    assert pack_messages(["a", "b"], header="[x] ") == ["[x] a\n\nb"]
+    packed = pack_messages(["a" * 6, "b" * 6, "c" * 20], header="> ", limit=16)
+    assert packed == ["> aaaaaa\n\nbbbbbb", "> cccccccccccccc", "> cccccc"]
+    assert all(len(m) <= 16 for m in packed)
+
+
+@pytest.mark.asyncio
+async def test_delivery_coalesces_burst():
+    bot = FakeBot()
+    queue = DeliveryQueue(bot, global_rate=0, chat_rate=0, coalesce_window=0.05)
+    for text in ("one", "two", "three"):
+        queue.submit(1, text, header="[agent] ")
+    queue.submit(2, "solo", header="[agent] ")
+    await asyncio.sleep(0.1)
+    await wait_drained(queue)
+    assert sorted(bot.sent) == [(1, "[agent] one\n\ntwo\n\nthree"), (2, "[agent] solo")]
+    assert queue.stats.merged == 2
+    await queue.close()
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from goetia_bot.db import AsyncDatabase, Database
+from goetia_bot.fsm_storage import SQLiteStorage
+from goetia_bot.states import ConnectStates
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+
+@pytest.mark.asyncio
+async def test_state_survives_restart(temp_dirs):
+    data_dir, _ = temp_dirs
+    db = AsyncDatabase(Database(data_dir / "goetia.db"))
+    storage = SQLiteStorage(db)
+    await storage.set_state(KEY, ConnectStates.waiting_code)
+    await storage.update_data(KEY, {"phone": "+7999"})
+    db.close()
+
+    db = AsyncDatabase(Database(data_dir / "goetia.db"))
+    storage = SQLiteStorage(db)
+    await storage.load()
+    assert await storage.get_state(KEY) == ConnectStates.waiting_code.state
+    assert await storage.get_data(KEY) == {"phone": "+7999"}
+
+    await storage.set_state(KEY, None)
+    await storage.set_data(KEY, {})
+    assert storage.size == 0
+    assert await db.load_fsm(0) == []
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_clear_without_state_does_not_touch_db(temp_dirs, monkeypatch):
+    data_dir, _ = temp_dirs
+    db = AsyncDatabase(Database(data_dir / "goetia.db"))
+    storage = SQLiteStorage(db)
+
+    async def fail(*args):
+        raise AssertionError("лишняя запись в БД")
+
+    monkeypatch.setattr(db, "save_fsm", fail)
+    monkeypatch.setattr(db, "delete_fsm", fail)
+    await storage.set_state(KEY, None)
+    await storage.set_data(KEY, {})
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_ttl_eviction(temp_dirs, monkeypatch):
+    data_dir, _ = temp_dirs
+    db = AsyncDatabase(Database(data_dir / "goetia.db"))
+    storage = SQLiteStorage(db, ttl=60)
+    await storage.set_state(KEY, ConnectStates.waiting_phone)
+    await storage.set_state(StorageKey(bot_id=1, chat_id=7, user_id=7), ConnectStates.waiting_phone)
+
+    now = time.time()
+    monkeypatch.setattr("goetia_bot.fsm_storage.time.time", lambda: now + 120)
+    assert await storage.get_state(KEY) is None
+    assert await storage.evict_expired() == 1
+    assert storage.size == 0
+    assert storage.expired == 2
+    assert await db.load_fsm(0) == []
+    db.close()
@@ -0,0 +1,126 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Chat, Message, Update, User
+
+from goetia_bot.lanes import UpdateLimitMiddleware, UserLanes
+from goetia_bot.metrics import UPDATE_WAIT_SECONDS
+from goetia_bot.states import TimeState
+
+
+class Recorder:
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.log = []
+        self.running = 0
+        self.peak = 0
+
+    async def __call__(self, event, data):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        self.log.append(("start", event))
+        await asyncio.sleep(self.delay)
+        self.log.append(("end", event))
+        self.running -= 1
+        return event
+
+
+def _key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def _in_lane(lanes, user_id, handler, event):
+    async with lanes.lock(_key(user_id)):
+        return await handler(event, {})
+
+
+@pytest.mark.asyncio
+async def test_same_user_is_serialized_in_order():
+    lanes = UserLanes()
+    handler = Recorder()
+    tasks = [asyncio.create_task(_in_lane(lanes, 1, handler, f"u1-{i}")) for i in range(5)]
+    await asyncio.sleep(0.001)
+    assert lanes.lanes == 1
+    assert lanes.waiting == 4
+    assert await asyncio.gather(*tasks) == [f"u1-{i}" for i in range(5)]
+    assert handler.peak == 1
+    assert [event for kind, event in handler.log if kind == "start"] == [f"u1-{i}" for i in range(5)]
+    assert lanes.lanes == 0
+    assert lanes.waiting == 0
+
+
+@pytest.mark.asyncio
+async def test_users_run_concurrently_under_global_cap():
+    limit = UpdateLimitMiddleware(concurrency=3)
+    handler = Recorder(delay=0.02)
+    before = UPDATE_WAIT_SECONDS.count(stage="global")
+    tasks = [asyncio.create_task(limit(handler, f"u{i}", {})) for i in range(9)]
+    await asyncio.sleep(0.005)
+    assert limit.inflight == 3
+    assert limit.waiting == 6
+    await asyncio.gather(*tasks)
+    assert handler.peak == 3
+    assert limit.waiting == 0
+    assert UPDATE_WAIT_SECONDS.count(stage="global") - before == 9
+
+
+@pytest.mark.asyncio
+async def test_slow_user_does_not_block_others():
+    lanes = UserLanes()
+    slow = asyncio.Event()
+    order = []
+
+    async def handler(event, data):
+        if event == "slow":
+            await slow.wait()
+        order.append(event)
+
+    first = asyncio.create_task(_in_lane(lanes, 1, handler, "slow"))
+    second = asyncio.create_task(_in_lane(lanes, 1, handler, "after-slow"))
+    await _in_lane(lanes, 2, handler, "other")
+    assert order == ["other"]
+    slow.set()
+    await asyncio.gather(first, second)
+    assert order == ["other", "slow", "after-slow"]
+
+
+def _update(update_id: int, text: str) -> Update:
+    user = User(id=1, is_bot=False, first_name="u")
+    message = Message(
+        message_id=update_id, date=datetime.now(), chat=Chat(id=1, type="private"), from_user=user, text=text
+    )
+    return Update(update_id=update_id, message=message)
+
+
+@pytest.mark.asyncio
+async def test_queued_update_sees_state_left_by_previous_one():
+    # как в handlers: ввод времени сбрасывает состояние, остальной текст уходит агенту
+    routed = []
+    router = Router()
+
+    @router.message(TimeState.waiting_time)
+    async def got_time(message: Message, state: FSMContext) -> None:
+        await asyncio.sleep(0.01)
+        routed.append(("got_time", message.text))
+        await state.clear()
+
+    @router.message(F.text)
+    async def forward_to_agent(message: Message) -> None:
+        routed.append(("forward_to_agent", message.text))
+
+    lanes = UserLanes()
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=lanes)
+    dp.update.outer_middleware(UpdateLimitMiddleware(10))
+    dp.include_router(router)
+    bot = Bot("42:TEST")
+    await dp.fsm.get_context(bot, chat_id=1, user_id=1).set_state(TimeState.waiting_time)
+
+    await asyncio.gather(dp.feed_update(bot, _update(1, "10:30")), dp.feed_update(bot, _update(2, "hello agent")))
+    assert routed == [("got_time", "10:30"), ("forward_to_agent", "hello agent")]
+    assert lanes.lanes == 0
+    await bot.session.close()
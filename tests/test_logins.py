@@ -0,0 +1,71 @@
+import pytest
+
+from goetia_bot.logins import PendingLogins, TooManyLogins
+
+
+class Canceller:
+    def __init__(self):
+        self.cancelled = []
+
+    async def __call__(self, tg_id, client):
+        self.cancelled.append((tg_id, client))
+
+
+@pytest.mark.asyncio
+async def test_cap_and_replacement():
+    cancel = Canceller()
+    logins = PendingLogins(cancel, max_pending=2)
+    logins.reserve(1)
+    await logins.add(1, "c1")
+    await logins.add(2, "c2")
+    with pytest.raises(TooManyLogins):
+        logins.reserve(3)
+    # повторный вход того же пользователя не упирается в лимит и закрывает прежний клиент
+    logins.reserve(1)
+    await logins.add(1, "c1b")
+    assert cancel.cancelled == [(1, "c1")]
+    assert logins.get(1) == "c1b"
+
+    logins.complete(1)
+    await logins.discard(2)
+    assert len(logins) == 0
+    assert cancel.cancelled == [(1, "c1"), (2, "c2")]
+    assert (logins.stats.completed, logins.stats.rejected) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_idle_clients_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("goetia_bot.logins.time.monotonic", lambda: now[0])
+    cancel = Canceller()
+    logins = PendingLogins(cancel, ttl=60)
+    await logins.add(1, "c1")
+    await logins.add(2, "c2")
+    now[0] += 50
+    logins.get(1)  # ввод кода продлевает вход
+    now[0] += 20
+    assert await logins.evict_expired() == 1
+    assert cancel.cancelled == [(2, "c2")]
+    assert 1 in logins
+
+    await logins.close()
+    assert cancel.cancelled == [(2, "c2"), (1, "c1")]
+    assert logins.stats.evicted == 1
+
+
+@pytest.mark.asyncio
+async def test_reserve_claims_slot_before_client_exists():
+    logins = PendingLogins(Canceller(), max_pending=2)
+    # два пользователя ещё ждут send_code_request, третий уже не проходит
+    logins.reserve(1)
+    logins.reserve(2)
+    with pytest.raises(TooManyLogins):
+        logins.reserve(3)
+    assert len(logins) == 2
+
+    logins.release(2)  # отправка кода не удалась
+    await logins.add(1, "c1")
+    logins.release(1)  # после add ничего не меняет
+    assert len(logins) == 1
+    logins.reserve(3)
+    assert len(logins) == 2
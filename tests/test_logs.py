@@ -0,0 +1,73 @@
+import json
+import logging
+
+import pytest
+
+from goetia_bot.config import load_config
+from goetia_bot.logs import ThrottleFilter, log_stats, setup_logging, stop_logging
+
+
+@pytest.fixture()
+def restore_root():
+    level = logging.root.level
+    handlers = logging.root.handlers[:]
+    yield
+    stop_logging()
+    logging.root.handlers[:] = handlers
+    logging.root.setLevel(level)
+
+
+def _record(name: str, level: int = logging.INFO, msg: str = "x") -> logging.LogRecord:
+    return logging.LogRecord(name, level, __file__, 1, msg, None, None)
+
+
+def test_rate_limit_shares_bucket_with_child_loggers():
+    throttle = ThrottleFilter({"goetia_bot.scheduler": 2}, {})
+    passed = [throttle.filter(_record("goetia_bot.scheduler.jobs")) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert throttle.filter(_record("goetia_bot.client_manager"))
+    assert throttle.suppressed == 3
+
+
+def test_sampling_keeps_warnings():
+    throttle = ThrottleFilter({}, {"goetia_bot": 0.0})
+    assert not throttle.filter(_record("goetia_bot.scheduler"))
+    assert throttle.filter(_record("goetia_bot.scheduler", logging.WARNING))
+    assert throttle.filter(_record("telethon"))
+
+
+def test_queue_logging_json(tmp_path, restore_root):
+    setup_logging("INFO", tmp_path, json_format=True, rate_limits={"burst": 1})
+    log = logging.getLogger("goetia_bot.test")
+    log.info("привет %s", "мир", extra={"tg_id": 42})
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.exception("упало")
+    for _ in range(3):
+        logging.getLogger("burst").warning("шум")
+    stop_logging()
+
+    lines = [json.loads(line) for line in (tmp_path / "bot.log").read_text(encoding="utf-8").splitlines()]
+    assert lines[0]["msg"] == "привет мир"
+    assert lines[0]["tg_id"] == 42
+    assert lines[1]["level"] == "ERROR"
+    assert "ValueError: boom" in lines[1]["exc"]
+    assert [line["logger"] for line in lines].count("burst") == 1
+
+
+def test_stats_without_logging(restore_root):
+    stop_logging()
+    assert log_stats() == {"dropped": 0, "suppressed": 0}
+
+
+def test_load_config_log_rules(tmp_path, monkeypatch):
+    env_path = tmp_path / ".env"
+    env_path.write_text("BOT_TOKEN=t\nAPI_ID=1\nAPI_HASH=h\n", encoding="utf-8")
+    monkeypatch.setenv("LOG_JSON", "1")
+    monkeypatch.setenv("LOG_RATE_LIMITS", "goetia_bot.scheduler=20, telethon=5")
+    monkeypatch.setenv("LOG_SAMPLE", "goetia_bot=0.1")
+    cfg = load_config(str(env_path))
+    assert cfg.log_json
+    assert cfg.log_rate_limits == {"goetia_bot.scheduler": 20.0, "telethon": 5.0}
+    assert cfg.log_sample == {"goetia_bot": 0.1}
@@ -0,0 +1,50 @@
+import socket
+
+import aiohttp
+import pytest
+
+from goetia_bot.metrics import Registry
+from goetia_bot.metrics_server import MetricsServer
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    buff = registry.counter("goetia_buff_total", "buff", labels=("result",))
+    latency = registry.histogram("goetia_send_seconds", "send", buckets=(0.1, 1.0))
+    registry.gauge_func("goetia_clients_connected", "clients", lambda: 3)
+
+    buff.inc(result="ok")
+    buff.inc(result="ok")
+    buff.inc(result="failed")
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value)
+
+    text = registry.render()
+    assert "# TYPE goetia_buff_total counter" in text
+    assert 'goetia_buff_total{result="ok"} 2' in text
+    assert 'goetia_buff_total{result="failed"} 1' in text
+    assert 'goetia_send_seconds_bucket{le="0.1"} 1' in text
+    assert 'goetia_send_seconds_bucket{le="1"} 2' in text
+    assert 'goetia_send_seconds_bucket{le="+Inf"} 3' in text
+    assert "goetia_send_seconds_count 3" in text
+    assert "goetia_send_seconds_sum 5.55" in text
+    assert "goetia_clients_connected 3" in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    registry = Registry()
+    registry.counter("goetia_relay_forwarded_total", "relay").inc(5)
+    server = MetricsServer("127.0.0.1", port, registry)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                assert resp.status == 200
+                body = await resp.text()
+    finally:
+        await server.close()
+    assert "goetia_relay_forwarded_total 5" in body
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from telethon.errors import AuthKeyUnregisteredError, FloodWaitError
+
+from goetia_bot.outbox import AccountOutbox, OutboxStats, SendResult
+
+
+class FakeClient:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def send_message(self, peer, text):
+        await asyncio.sleep(0)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((peer, text))
+
+
+@pytest.mark.asyncio
+async def test_outbox_parks_on_flood_wait_and_dedups_buff():
+    stats = OutboxStats()
+    client = FakeClient(errors=[FloodWaitError(request=None, capture=0)])
+    outbox = AccountOutbox(1, client, "agent", stats)
+    results = [outbox.submit("hi"), outbox.submit("/buff"), outbox.submit("/buff")]
+    assert results == [SendResult.QUEUED] * 3
+    await outbox.join()
+    assert client.sent == [("agent", "hi"), ("agent", "/buff")]
+    assert stats.flood_waits == 1
+    assert stats.deduplicated == 1
+    assert outbox.backlog == 0
+
+
+@pytest.mark.asyncio
+async def test_outbox_submit_does_not_wait_for_flood_wait():
+    stats = OutboxStats()
+    error = FloodWaitError(request=None, capture=0)
+    error.seconds = 3600
+    outbox = AccountOutbox(1, FakeClient(errors=[error]), "agent", stats)
+    assert outbox.submit("hi") is SendResult.QUEUED
+    await asyncio.sleep(0.01)
+    # очередь стоит на FloodWait, но постановка по-прежнему мгновенная
+    assert outbox.flood_wait_left() > 3000
+    assert outbox.submit("/buff") is SendResult.PARKED
+    assert outbox.backlog == 2
+    outbox.cancel()
+    assert outbox.backlog == 0
+
+
+@pytest.mark.asyncio
+async def test_outbox_unauthorized_fails_queue():
+    stats = OutboxStats()
+    revoked = []
+
+    async def on_unauthorized(tg_id):
+        revoked.append(tg_id)
+
+    client = FakeClient(errors=[AuthKeyUnregisteredError(request=None)])
+    outbox = AccountOutbox(1, client, "agent", stats, on_unauthorized=on_unauthorized)
+    assert outbox.submit("a") and outbox.submit("b")
+    await outbox.join()
+    assert outbox.authorized is False
+    assert outbox.backlog == 0
+    assert revoked == [1]
+    assert outbox.submit("c") is SendResult.FAILED
+    assert client.sent == []
@@ -0,0 +1,25 @@
+import pytest
+
+from goetia_bot.ratelimit import TokenBucket
+
+
+def test_token_bucket_burst_and_wait():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    wait = bucket.try_acquire()
+    assert 0 < wait <= 0.1
+    assert not bucket.is_full()
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(rate=0)
+    assert all(bucket.try_acquire() == 0 for _ in range(1000))
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_acquire():
+    bucket = TokenBucket(rate=100, burst=1)
+    await bucket.acquire()
+    await bucket.acquire()
+    assert bucket.tokens < 1
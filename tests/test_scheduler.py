@@ -2,7 +2,9 @@ import pytest
 
 from goetia_bot.scheduler import BuffScheduler, parse_time
 from goetia_bot.config import Config
-from goetia_bot.db import Database, UserRecord
+from goetia_bot.db import AsyncDatabase, Database, UserRecord
+from goetia_bot.metrics import BUFF_TOTAL
+from goetia_bot.outbox import SendResult
 
 
 def test_parse_time_ok():
@@ -16,42 +18,85 @@ def test_parse_time_bad(value):
         parse_time(value)
 
 
-def test_schedule_user(monkeypatch, tmp_path):
-    cfg = Config(bot_token="t", api_id=1, api_hash="h", timezone="Europe/Moscow")
-    db = Database(tmp_path / "db.sqlite3")
+class DummyScheduler:
+    running = False
+
+    def __init__(self):
+        self.jobs = {}
 
-    added_jobs = {}
+    def start(self):
+        self.running = True
 
-    class DummyScheduler:
-        running = False
+    def shutdown(self, wait=False):
+        self.running = False
 
-        def start(self):
-            self.running = True
+    def add_job(self, func, trigger, id, **kwargs):
+        self.jobs[id] = (func, trigger)
 
-        def shutdown(self, wait=False):
-            self.running = False
 
-        def add_job(self, func, trigger, id, args, replace_existing, misfire_grace_time):
-            added_jobs[id] = (trigger, args)
+class DummyClients:
+    def __init__(self):
+        self.sent = []
+        self.results = {}
 
-        def get_job(self, job_id):
-            return added_jobs.get(job_id)
+    async def send_to_agent(self, tg_id, text):
+        self.sent.append((tg_id, text))
+        return self.results.get(tg_id, SendResult.QUEUED)
 
-        def remove_job(self, job_id):
-            added_jobs.pop(job_id, None)
 
+def make_scheduler(monkeypatch, tmp_path, **overrides):
+    cfg = Config(bot_token="t", api_id=1, api_hash="h", timezone="Europe/Moscow", **overrides)
+    db = AsyncDatabase(Database(tmp_path / "db.sqlite3"))
     dummy = DummyScheduler()
     monkeypatch.setattr("goetia_bot.scheduler.AsyncIOScheduler", lambda timezone=None: dummy)
+    return BuffScheduler(cfg, db, DummyClients()), dummy, db
 
-    class DummyClients:
-        async def send_to_agent(self, tg_id, text):
-            return True
 
-    scheduler = BuffScheduler(cfg, db, DummyClients())
+def test_schedule_user(monkeypatch, tmp_path):
+    scheduler, dummy, db = make_scheduler(monkeypatch, tmp_path)
     scheduler.start()
+    # один общий тик вместо задачи на каждого пользователя
+    assert list(dummy.jobs) == ["buff_dispatcher"]
+
     user = UserRecord(tg_id=123, schedule_enabled=True, schedule_time="10:00")
     scheduler.schedule_user(user)
+    assert scheduler._buckets == {600: {123}}
+
+    scheduler.schedule_user(UserRecord(tg_id=123, schedule_enabled=True, schedule_time="10:05"))
+    assert scheduler._buckets == {605: {123}}
 
-    assert "123" in added_jobs
     scheduler.remove_job(123)
-    assert "123" not in added_jobs
+    assert scheduler._buckets == {}
+    assert scheduler.scheduled_count() == 0
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_dispatch_minute(monkeypatch, tmp_path):
+    scheduler, dummy, db = make_scheduler(monkeypatch, tmp_path, buff_jitter=0, buff_rate=0, buff_concurrency=2)
+    for tg_id in (1, 2, 3):
+        scheduler.schedule_user(UserRecord(tg_id=tg_id, schedule_enabled=True, schedule_time="08:15"))
+    scheduler.schedule_user(UserRecord(tg_id=4, schedule_enabled=True, schedule_time="08:16"))
+
+    await scheduler._dispatch(8 * 60 + 15)
+    await scheduler._queue.join()
+    assert sorted(scheduler.clients.sent) == [(1, "/buff"), (2, "/buff"), (3, "/buff")]
+    assert len(scheduler._workers) == 2
+    scheduler.shutdown()
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_buff_result_labels(monkeypatch, tmp_path):
+    scheduler, _, db = make_scheduler(monkeypatch, tmp_path)
+    scheduler.clients.results = {2: SendResult.PARKED, 3: SendResult.FAILED}
+    before = {result: BUFF_TOTAL.value(result=result) for result in ("ok", "parked", "failed")}
+    for tg_id in (1, 2, 3):
+        await scheduler._buff_job(tg_id)
+    # /buff на FloodWait ещё не отправлен и не считается успешным
+    assert {result: BUFF_TOTAL.value(result=result) - before[result] for result in before} == {
+        "ok": 1,
+        "parked": 1,
+        "failed": 1,
+    }
+    db.close()
@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from goetia_bot.session_store import SessionStore
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession
+from telethon.tl import types
+
+
+def _user(user_id, access_hash=1, username=None):
+    return types.contacts.ResolvedPeer(
+        peer=None, chats=[], users=[types.User(id=user_id, access_hash=access_hash, username=username)]
+    )
+
+
+def _state(pts):
+    return types.updates.State(pts, 0, datetime.datetime.now(datetime.timezone.utc), 1, unread_count=0)
+
+
+def test_write_behind_flush(tmp_path):
+    store = SessionStore(tmp_path / "sessions.db")
+    session = store.open(1)
+    session.auth_key = AuthKey(b"k" * 256)
+    # ключ авторизации пишется сразу, без flush
+    assert SessionStore(tmp_path / "sessions.db").has(1)
+
+    session.process_entities(_user(777, 42, "Agent_essence_bot"))
+    session.set_update_state(0, _state(10))
+    assert store.dirty_count == 1
+    assert SessionStore(tmp_path / "sessions.db").open(1).get_update_state(0) is None
+
+    assert store.flush() == 1
+    reopened = SessionStore(tmp_path / "sessions.db").open(1)
+    assert reopened.auth_key.key == b"k" * 256
+    assert reopened.get_input_entity("agent_essence_bot") == types.InputPeerUser(777, 42)
+    assert reopened.get_update_state(0).pts == 10
+
+    # Telethon периодически пересохраняет те же сущности: это не должно давать записей
+    session.process_entities(_user(777, 42, "Agent_essence_bot"))
+    session.set_update_state(0, session.get_update_state(0))
+    assert store.dirty_count == 0
+
+    session.close()
+    store.close()
+
+
+def test_import_session_file(tmp_path):
+    legacy = SQLiteSession(str(tmp_path / "user_5"))
+    legacy.set_dc(2, "149.154.167.51", 443)
+    legacy.auth_key = AuthKey(b"a" * 256)
+    legacy.process_entities(_user(777, 42, "agent_essence_bot"))
+    legacy.set_update_state(0, _state(7))
+    legacy.close()
+
+    store = SessionStore(tmp_path / "sessions.db")
+    assert store.import_file(5, tmp_path / "user_5.session")
+    assert not store.import_file(6, tmp_path / "missing.session")
+
+    session = store.open(5)
+    assert (session.dc_id, session.server_address, session.port) == (2, "149.154.167.51", 443)
+    assert session.auth_key.key == b"a" * 256
+    assert session.get_input_entity(777) == types.InputPeerUser(777, 42)
+    assert session.get_update_state(0).pts == 7
+
+    session.delete()
+    assert not store.has(5)
+    store.close()
+
+
+def test_telethon_callbacks_write_on_executor_thread(tmp_path):
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="goetia-db")
+    store = SessionStore(tmp_path / "sessions.db", executor=executor)
+    threads = []
+    write = store._write
+
+    def recording_write(batch):
+        threads.append(threading.current_thread().name)
+        write(batch)
+
+    store._write = recording_write
+    session = executor.submit(store.open, 1).result()
+    session.auth_key = AuthKey(b"k" * 256)
+    session.process_entities(_user(777, 42))
+    session.close()
+    # поток один, поэтому чтение после записей видит их
+    assert executor.submit(store.has, 1).result()
+    assert threads and all(name.startswith("goetia-db") for name in threads)
+    session.delete()
+    assert not executor.submit(store.has, 1).result()
+    executor.submit(store.close).result()
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_flusher_survives_write_errors(tmp_path):
+    store = SessionStore(tmp_path / "sessions.db", flush_interval=0.01)
+    session = store.open(1)
+    session.set_update_state(0, _state(10))
+    write, failures = store._write, []
+
+    def failing_write(batch):
+        if not failures:
+            failures.append(batch)
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        write(batch)
+
+    store._write = failing_write
+    flusher = asyncio.create_task(store.run_flusher())
+    while store.stats.flushes == 0:
+        await asyncio.sleep(0.01)
+    flusher.cancel()
+    assert failures
+    # изменения вернулись в очередь и ушли следующим сбросом
+    assert SessionStore(tmp_path / "sessions.db").open(1).get_update_state(0).pts == 10
+    store.close()
+
+
+def test_batch_taken_before_delete_is_dropped(tmp_path):
+    store = SessionStore(tmp_path / "sessions.db")
+    session = store.open(1)
+    session.auth_key = AuthKey(b"k" * 256)
+    session.process_entities(_user(777, 42))
+    batch = store._take_dirty([session])
+    session.delete()
+    store._write(batch)
+    assert not store.has(1)
+    assert store._conn.execute("SELECT COUNT(*) FROM telethon_entities").fetchone()[0] == 0
+    store.close()
@@ -0,0 +1,137 @@
+import asyncio
+import os
+
+import pytest
+
+from goetia_bot.client_manager import ClientManager, ClientState
+from goetia_bot.config import Config
+from goetia_bot.db import AsyncDatabase, Database
+from goetia_bot.logins import PendingLogins
+from goetia_bot.outbox import SendResult
+from goetia_bot.sharding import ShardedClientManager, ShardUnavailable
+
+
+class FakeTelethon:
+    def __init__(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+
+class FakeManager(ClientManager):
+    """ClientManager без сети: живёт в процессе шарда, подгружается по имени."""
+
+    async def start_from_session(self, tg_id, session_path, resolve_peer=True):
+        client = FakeTelethon()
+        self.clients[tg_id] = client
+        self._session_paths[tg_id] = session_path
+        self._notify(tg_id)
+        return client
+
+    async def send_to_agent(self, tg_id, text):
+        if text == "crash":
+            os._exit(3)
+        if tg_id not in self.clients:
+            return SendResult.FAILED
+        await self._message_callback(tg_id, "agent_essence_bot", f"echo {text}")
+        return SendResult.QUEUED
+
+    async def start_with_code(self, tg_id, phone):
+        return FakeTelethon(), f"hash-{phone}"
+
+    async def finish_sign_in(self, tg_id, client, phone, code, phone_code_hash=None, password=None):
+        # отключённый клиент — значит, отменили не тот вход
+        return client.connected and phone_code_hash == f"hash-{phone}", False
+
+    async def prewarm_agent_peers(self):
+        return 0
+
+
+async def _wait_for(predicate, timeout=30.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "условие не выполнилось вовремя"
+        await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_shard_crash_is_isolated_and_restarted(temp_dirs):
+    data, sessions = temp_dirs
+    cfg = Config(bot_token="x", api_id=1, api_hash="h", data_dir=data, sessions_dir=sessions, logs_dir=data, shards=2, session_store=False)
+    db = AsyncDatabase(Database(data / "goetia.db"))
+    for tg_id in (10, 11):
+        session = sessions / f"user_{tg_id}.session"
+        session.write_text("")
+        await db.upsert_user(tg_id)
+        await db.set_session_path(tg_id, str(session))
+        await db.set_passthrough(tg_id, True)
+
+    manager = ShardedClientManager(cfg, db, manager_factory="test_sharding:FakeManager")
+    received = []
+
+    async def on_message(tg_id, sender, text):
+        received.append((tg_id, text))
+
+    manager.set_message_callback(on_message)
+    await manager.start()
+    try:
+        await _wait_for(lambda: manager.has_client(10) and manager.has_client(11))
+        assert await manager.send_to_agent(10, "hi")
+        assert await manager.send_to_agent(11, "hi")
+        await _wait_for(lambda: len(received) == 2)
+
+        # падение шарда 0 не задевает аккаунты шарда 1
+        assert not await manager.send_to_agent(10, "crash")
+        assert manager.client_state(10) is ClientState.RESTORING
+        assert await manager.send_to_agent(11, "still here")
+
+        await _wait_for(lambda: manager.client_state(10) is ClientState.CONNECTED)
+        assert manager.restarts == 1
+        assert await manager.send_to_agent(10, "back")
+        await _wait_for(lambda: (10, "echo back") in received)
+    finally:
+        await manager.close()
+        db.close()
+    assert not (data / "shards.sock").exists()
+
+
+@pytest.mark.asyncio
+async def test_calls_to_missing_shard_link_fail_cleanly(temp_dirs):
+    data, sessions = temp_dirs
+    cfg = Config(bot_token="x", api_id=1, api_hash="h", data_dir=data, sessions_dir=sessions, shards=2, session_store=False)
+    db = AsyncDatabase(Database(data / "goetia.db"))
+    manager = ShardedClientManager(cfg, db)
+    # шард помечен готовым, но связь уже оборвалась
+    manager._ready[1] = asyncio.Event()
+    manager._ready[1].set()
+    with pytest.raises(ShardUnavailable):
+        await manager._call(11, "wake")
+    # отключение в handlers не должно падать из-за недоступного шарда
+    await manager.stop(11)
+    await manager.forget_session(11)
+    await manager.forget_session(10)
+    assert await manager.send_to_agent(11, "hi") is SendResult.FAILED
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_second_phone_entry_keeps_new_login(temp_dirs):
+    data, sessions = temp_dirs
+    cfg = Config(bot_token="x", api_id=1, api_hash="h", data_dir=data, sessions_dir=sessions, logs_dir=data, shards=2, session_store=False)
+    db = AsyncDatabase(Database(data / "goetia.db"))
+    manager = ShardedClientManager(cfg, db, manager_factory="test_sharding:FakeManager")
+    logins = PendingLogins(manager.cancel_login)
+    await manager.start()
+    try:
+        # как got_phone: пользователь дважды вводит номер, затем код
+        for phone in ("+100", "+200"):
+            logins.reserve(11)
+            client, phone_code_hash = await manager.start_with_code(11, phone)
+            await logins.add(11, client)
+            logins.release(11)
+        ok, _ = await manager.finish_sign_in(11, logins.get(11), "+200", "12345", phone_code_hash=phone_code_hash)
+        assert ok
+    finally:
+        await manager.close()
+        db.close()
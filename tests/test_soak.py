@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import random
+import time
+import weakref
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from fake_bot_api import TOKEN, FakeBotAPI
+from goetia_bot.app import create_app
+from goetia_bot.client_manager import ClientState
+from goetia_bot.config import Config
+from goetia_bot.logs import stop_logging
+from goetia_bot.outbox import SendResult
+
+# Многочасовой прогон: GOETIA_SOAK_USERS=5000 GOETIA_SOAK_SECONDS=14400 GOETIA_SOAK_RATE=500 \
+#   GOETIA_SOAK_OUT=soak.json pytest --bench -s tests/test_soak.py
+USERS = int(os.getenv("GOETIA_SOAK_USERS", "200"))
+SECONDS = float(os.getenv("GOETIA_SOAK_SECONDS", "3"))
+RATE = float(os.getenv("GOETIA_SOAK_RATE", "200"))  # апдейтов в секунду на всех пользователей
+SAMPLE = float(os.getenv("GOETIA_SOAK_SAMPLE", "1"))
+LATENCY = float(os.getenv("GOETIA_SOAK_LATENCY_MS", "5")) / 1000
+THROTTLE = float(os.getenv("GOETIA_SOAK_THROTTLE", "0.05"))  # доля sendMessage, получающих 429
+RETRY_AFTER = int(os.getenv("GOETIA_SOAK_RETRY_AFTER", "1"))
+LOGIN_TTL = float(os.getenv("GOETIA_SOAK_LOGIN_TTL", "1"))  # брошенные входы закрываются через столько секунд
+FSM_TTL = float(os.getenv("GOETIA_SOAK_FSM_TTL", "2"))
+OUT = os.getenv("GOETIA_SOAK_OUT", "")
+TICK = 0.05
+
+pytestmark = pytest.mark.slow
+
+# сценарии пользователя: шаги уходят по одному за тик, чтобы не гоняться с FSM
+SCRIPTS = [
+    (30, [("message", "/start")]),
+    (15, [("callback", "status")]),
+    (10, [("callback", "toggle_passthrough")]),
+    (5, [("callback", "toggle_schedule")]),
+    (25, [("message", "привет агенту")]),
+    # вход брошен на вводе кода: клиент висит в PendingLogins до LOGIN_TTL
+    (10, [("callback", "connect"), ("message", "+79990000000")]),
+    (5, [("callback", "connect"), ("message", "+79990000000"), ("message", "12345")]),
+]
+
+
+class LoginClient:
+    async def disconnect(self):
+        pass
+
+
+class OfflineClients:
+    """ClientManager без Telethon: аккаунты «подключены», агент отвечает эхом."""
+
+    def __init__(self, message_callback):
+        self.connected = set(range(0, USERS, 2))
+        self.login_clients = weakref.WeakSet()
+        self._callback = message_callback
+        self._tasks = set()
+
+    def has_client(self, tg_id):
+        return tg_id in self.connected
+
+    def client_state(self, tg_id):
+        return ClientState.CONNECTED if tg_id in self.connected else ClientState.ABSENT
+
+    def state_counts(self):
+        return {ClientState.CONNECTED: len(self.connected), ClientState.HIBERNATED: 0}
+
+    def is_restoring(self, tg_id):
+        return False
+
+    async def send_to_agent(self, tg_id, text):
+        task = asyncio.create_task(self._callback(tg_id, "agent_essence_bot", f"echo: {text}"))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return SendResult.QUEUED
+
+    async def wake(self, tg_id):
+        return None
+
+    async def stop(self, tg_id):
+        self.connected.discard(tg_id)
+
+    async def forget_session(self, tg_id):
+        pass
+
+    async def start_with_code(self, tg_id, phone):
+        client = LoginClient()
+        self.login_clients.add(client)
+        return client, "hash"
+
+    async def request_new_code(self, client, tg_id, phone, force_sms=False):
+        return "hash"
+
+    async def finish_sign_in(self, tg_id, client, phone, code, phone_code_hash=None, password=None):
+        self.connected.add(tg_id)
+        return True, False
+
+    async def complete_with_password(self, tg_id, client, password):
+        return True
+
+    async def cancel_login(self, tg_id, client):
+        await client.disconnect()
+
+    async def close(self):
+        pass
+
+
+class UpdateCounter:
+    def __init__(self):
+        self.handled = 0
+        self.errors = Counter()
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            raise
+        finally:
+            self.handled += 1
+
+
+def _rss_mib() -> float:
+    with open("/proc/self/status", encoding="ascii") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _feed(api: FakeBotAPI, plans: dict, count: int) -> None:
+    weights = [w for w, _ in SCRIPTS]
+    for _ in range(count):
+        user_id = random.randrange(USERS)
+        plan = plans.get(user_id)
+        if not plan:
+            plan = plans[user_id] = list(random.choices(SCRIPTS, weights)[0][1])
+        kind, payload = plan.pop(0)
+        if kind == "message":
+            api.push_message(user_id, payload)
+        else:
+            api.push_callback(user_id, payload)
+
+
+@pytest.mark.asyncio
+async def test_soak_against_fake_bot_api(temp_dirs, tmp_path):
+    data_dir, sessions_dir = temp_dirs
+    api = FakeBotAPI(latency=LATENCY, throttle_ratio=THROTTLE, retry_after=RETRY_AFTER)
+    await api.start()
+    config = Config(
+        bot_token=TOKEN,
+        api_id=1,
+        api_hash="h",
+        data_dir=data_dir,
+        sessions_dir=sessions_dir,
+        logs_dir=tmp_path / "logs",
+        log_level="ERROR",
+        bot_api_url=api.url,
+        delivery_chat_rate=0,
+        login_ttl=LOGIN_TTL,
+        fsm_ttl=FSM_TTL,
+    )
+    dp, ctx = await create_app(config)
+    real_clients = ctx.clients
+    clients = ctx.clients = OfflineClients(real_clients._message_callback)
+    counter = UpdateCounter()
+    dp.update.outer_middleware(counter)
+    polling = asyncio.create_task(dp.start_polling(ctx.bot, handle_signals=False, close_bot_session=False))
+    evictions = [
+        asyncio.create_task(ctx.logins.run_eviction(SAMPLE)),
+        asyncio.create_task(dp.storage.run_eviction(SAMPLE)),
+    ]
+
+    samples = []
+    plans: dict = {}
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    next_sample = started + SAMPLE
+    last_handled, last_time = 0, started
+    try:
+        while loop.time() - started < SECONDS:
+            _feed(api, plans, max(1, int(RATE * TICK)))
+            await asyncio.sleep(TICK)
+            now = loop.time()
+            if now >= next_sample:
+                samples.append(
+                    {
+                        "t": round(now - started, 2),
+                        "handled": counter.handled,
+                        "rate": round((counter.handled - last_handled) / (now - last_time), 1),
+                        "backlog": api.backlog,
+                        "rss_mib": round(_rss_mib(), 1),
+                        "fsm_keys": dp.storage.size,
+                        "pending_logins": len(ctx.logins),
+                        "login_clients_alive": len(clients.login_clients),
+                        "delivery_depth": ctx.delivery.depth,
+                    }
+                )
+                last_handled, last_time = counter.handled, now
+                next_sample = now + SAMPLE
+        # даём дочитать хвост апдейтов и очередь доставки
+        deadline = loop.time() + 30
+        while (counter.handled < api.updates_fed or ctx.delivery.depth) and loop.time() < deadline:
+            await asyncio.sleep(TICK)
+    finally:
+        for task in evictions:
+            task.cancel()
+        await asyncio.gather(*evictions, return_exceptions=True)
+        await dp.stop_polling()
+        await asyncio.gather(polling, return_exceptions=True)
+        await ctx.delivery.close()
+        await ctx.bot.session.close()
+        ctx.scheduler.shutdown()
+        await ctx.logins.close()
+        await real_clients.close()
+        ctx.db.close()
+        await api.close()
+        # create_app настроил корневой логгер на файлы во временном каталоге
+        stop_logging()
+
+    elapsed = loop.time() - started
+    report = {
+        "users": USERS,
+        "seconds": round(elapsed, 1),
+        "updates_fed": api.updates_fed,
+        "updates_handled": counter.handled,
+        "update_rate": round(counter.handled / elapsed, 1),
+        "handler_errors": dict(counter.errors),
+        "bot_api_requests": dict(api.requests),
+        "bot_api_throttled": api.throttled,
+        "delivery": vars(ctx.delivery.stats),
+        "logins": vars(ctx.logins.stats),
+        "rss_growth_mib": round(samples[-1]["rss_mib"] - samples[0]["rss_mib"], 1) if samples else 0.0,
+        "samples": samples,
+    }
+    out = Path(OUT) if OUT else tmp_path / "soak.json"
+    out.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nsoak: {json.dumps({k: v for k, v in report.items() if k != 'samples'}, ensure_ascii=False)}")
+    print(f"results: {out}")
+
+    assert counter.handled == api.updates_fed
+    assert max(s["pending_logins"] for s in samples) <= config.login_max_pending
+    assert ctx.delivery.stats.sent > 0
+    if THROTTLE:
+        assert ctx.delivery.stats.retry_after > 0
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from goetia_bot.delivery import DeliveryQueue
+from goetia_bot.tracing import Tracer, current_trace, span
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(0.01)
+        self.sent.append((chat_id, text))
+
+
+def test_sampling_disabled_is_noop():
+    tracer = Tracer(sample_rate=0)
+    with tracer.trace("agent_to_user") as trace, span("telethon.event"):
+        assert trace is None
+        assert current_trace() is None
+    assert not tracer.finished
+
+
+@pytest.mark.asyncio
+async def test_trace_spans_until_bot_delivery():
+    tracer = Tracer(sample_rate=1)
+    bot = FakeBot()
+    queue = DeliveryQueue(bot, global_rate=0, chat_rate=100, coalesce_window=0.02)
+    for text in ("a", "b"):
+        with tracer.trace("agent_to_user", tg_id=1), span("telethon.event"):
+            with span("message_callback"):
+                queue.submit(1, text, header="[agent] ")
+    # корневой блок закрыт, но сообщение ещё в очереди: трасса не завершена
+    assert not tracer.finished
+
+    await asyncio.sleep(0.1)
+    assert bot.sent == [(1, "[agent] a\n\nb")]
+    assert len(tracer.finished) == 2
+    trace = tracer.finished[0]
+    names = [s.name for s in trace.spans]
+    assert names[:2] == ["message_callback", "telethon.event"]
+    assert {"delivery.coalesce", "delivery.queue", "bot.send_message"} <= set(names)
+    assert trace.duration >= 0.03
+
+    summary = tracer.summary()
+    assert summary["agent_to_user"]["count"] == 2
+    assert summary["agent_to_user/bot.send_message"]["p99_ms"] >= 10
+    events = tracer.to_trace_events()["traceEvents"]
+    assert {e["tid"] for e in events} == {trace.id for trace in tracer.finished}
+    assert all(e["ph"] == "X" for e in events)
+    await queue.close()
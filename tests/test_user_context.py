@@ -0,0 +1,74 @@
+import pytest
+
+from goetia_bot.client_manager import ClientState
+from goetia_bot.db import AsyncDatabase, Database
+from goetia_bot.keyboards import _main_menu_rows, _status_text, main_menu_markup, menu
+from goetia_bot.user_context import Profile
+
+
+class CountingDatabase(AsyncDatabase):
+    def __init__(self, db: Database):
+        super().__init__(db)
+        self.reads = 0
+
+    async def get_user(self, tg_id):
+        self.reads += 1
+        return await super().get_user(tg_id)
+
+
+@pytest.mark.asyncio
+async def test_profile_reads_once_and_tracks_changes(temp_dirs):
+    data_dir, _ = temp_dirs
+    db = CountingDatabase(Database(data_dir / "goetia.db"))
+    profile = Profile(db, 1)
+    assert await profile.get() is None
+    user = await profile.ensure()
+    assert user.tg_id == 1 and not profile.changed
+
+    await profile.set_schedule(True)
+    await profile.set_schedule_time("09:15")
+    await profile.set_passthrough(True)
+    assert db.reads == 1
+    assert profile.changed
+    assert profile.record.schedule_enabled and profile.record.passthrough
+    assert profile.record.schedule_time == "09:15"
+    # локальная копия совпадает с тем, что записано в базу
+    assert await db.get_user(1) == profile.record
+
+    await profile.clear()
+    assert not profile.record.passthrough and not profile.record.schedule_enabled
+    assert await db.get_user(1) == profile.record
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_profile_of_unknown_user_is_never_created_by_reads(temp_dirs):
+    data_dir, _ = temp_dirs
+    db = CountingDatabase(Database(data_dir / "goetia.db"))
+    profile = Profile(db, 2)
+    await profile.set_schedule_time("10:00")
+    assert profile.record is None
+    assert await db.get_user(2) is None
+    db.close()
+
+
+def test_menu_is_memoized(temp_dirs):
+    data_dir, _ = temp_dirs
+    db = Database(data_dir / "goetia.db")
+    user = db.upsert_user(1)
+    _status_text.cache_clear()
+    _main_menu_rows.cache_clear()
+    text, markup = menu(ClientState.CONNECTED, user)
+    again_text, again_markup = menu(ClientState.CONNECTED, user)
+    assert again_text is text
+    assert _status_text.cache_info().hits == 1
+    assert _main_menu_rows.cache_info().hits == 1
+    # разметка каждый раз своя: правка одной не видна в других сообщениях
+    assert again_markup == markup and again_markup is not markup
+    markup.inline_keyboard[0][0].text = "changed"
+    assert main_menu_markup(False, False) == again_markup
+    assert "Статус подключения: ✅" in text
+
+    text, _ = menu(ClientState.ABSENT, None)
+    assert "Профиль ещё не создан" in text and "❌" in text
+    db.close()
@@ -0,0 +1,58 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from fake_bot_api import TOKEN, FakeBotAPI
+from goetia_bot.webhook import WebhookServer
+
+
+async def _wait(predicate, timeout: float = 5.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_webhook_receives_updates_with_concurrency_limit():
+    api = FakeBotAPI()
+    await api.start()
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.url)))
+    dp = Dispatcher()
+    handled = []
+    running = 0
+    peak = 0
+
+    @dp.message()
+    async def on_message(message):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        handled.append(message.text)
+        running -= 1
+
+    server = WebhookServer(dp, bot, port=0, secret="s3cret", concurrency=2, max_connections=10)
+    await server.start()
+    try:
+        assert api._webhook == {"url": server.url, "secret": "s3cret"}
+        for i in range(10):
+            api.push_message(1, f"m{i}")
+        await _wait(lambda: len(handled) == 10)
+
+        async with aiohttp.ClientSession() as http:
+            async with http.post(server.url, json={"update_id": 999}, headers={"X-Telegram-Bot-Api-Secret-Token": "x"}) as resp:
+                assert resp.status == 401
+    finally:
+        await server.close()
+        await bot.session.close()
+        await api.close()
+
+    assert sorted(handled) == sorted(f"m{i}" for i in range(10))
+    assert peak == 2
+    assert api._webhook is None
+    assert api.requests["deleteWebhook"] == 1